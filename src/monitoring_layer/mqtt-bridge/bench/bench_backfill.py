@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""Measure src/backfill.py on generated Pi archives.
+
+Writes --devices device directories the way the Pi client leaves them,
+with --days of readings every --interval seconds: gzip compressed
+daily_*.ndjson for all days but the last, a plain NDJSON file for the last
+one, an events_*.ndjson file of motion events, legacy daily_*.json arrays
+(indent=2, as older clients wrote them) for --legacy-days before that and
+a sensor_log.txt. Then runs backfill.py on them and reports rows per
+minute, parse only unless DB_HOST is set:
+
+    python3 bench/bench_backfill.py --devices 20 --days 7 --jobs 8
+    DB_HOST=localhost python3 bench/bench_backfill.py --devices 20 --days 7 --jobs 8
+
+With a database it runs twice, the second time without a checkpoint, so
+every row is a duplicate and the time is what re-loading an archive costs.
+"""
+import argparse
+import datetime
+import gzip
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKFILL = os.path.join(BENCH_DIR, '..', 'src', 'backfill.py')
+
+
+def reading(rng, when):
+    return {
+        "timestamp": when.strftime("%Y-%m-%d %H:%M:%S.") + f"{when.microsecond // 1000:03d}",
+        "event": "regular_reading",
+        "sensor_data": {
+            "temperature_c": round(rng.gauss(21, 0.5), 1),
+            "temperature_f": 70.0,
+            "pressure_hpa": round(rng.gauss(1013, 1), 1),
+            "altitude_m": 133.26,
+            "humidity": round(rng.gauss(45, 2), 1),
+        },
+    }
+
+
+def write_device(directory, device, args, start):
+    """One device's archive, returns the number of sensor_data rows in it"""
+    rng = random.Random(device)
+    data_dir = os.path.join(directory, device, 'sensor_data')
+    os.makedirs(data_dir)
+    per_day = int(86400 / args.interval)
+    rows = 0
+    log = open(os.path.join(directory, device, 'sensor_log.txt'), 'w')
+    for day in range(args.legacy_days + args.days):
+        date = start + datetime.timedelta(days=day)
+        stamps = [date + datetime.timedelta(seconds=i * args.interval + rng.random()) for i in range(per_day)]
+        records = [reading(rng, when) for when in stamps]
+        rows += len(records) * 4
+        name = date.strftime('%Y-%m-%d')
+        if day < args.legacy_days:
+            with open(os.path.join(data_dir, f"daily_{name}.json"), 'w') as f:
+                json.dump(records, f, indent=2)
+            continue
+        lines = ''.join(json.dumps(record, separators=(",", ":")) + "\n" for record in records)
+        if day < args.legacy_days + args.days - 1:
+            with gzip.open(os.path.join(data_dir, f"daily_{name}.ndjson.gz"), 'wt') as f:
+                f.write(lines)
+        else:
+            with open(os.path.join(data_dir, f"daily_{name}.ndjson"), 'w') as f:
+                f.write(lines)
+        events = [dict(record, event="motion_detected") for record in records[::200]]
+        rows += len(events) * 4
+        with open(os.path.join(data_dir, f"events_{name}.ndjson"), 'w') as f:
+            f.writelines(json.dumps(event, separators=(",", ":")) + "\n" for event in events)
+        # The log repeats the last day's readings, which are duplicates of the NDJSON rows
+        if day == args.legacy_days + args.days - 1:
+            rows += len(records) * 4
+            for when, record in zip(stamps, records):
+                log.write(f"{when.strftime('%Y-%m-%d %H:%M:%S')},{when.microsecond // 1000:03d} - INFO - "
+                          f"Temperature reading: {record['sensor_data']!r}\n")
+                log.write(f"{when.strftime('%Y-%m-%d %H:%M:%S')},{when.microsecond // 1000:03d} - INFO - "
+                          f"Published reading\n")
+    log.close()
+    return rows
+
+
+def run_backfill(directory, args, extra):
+    command = [sys.executable, BACKFILL, directory, '--jobs', str(args.jobs), '--checkpoint', ''] + extra
+    start = time.perf_counter()
+    result = subprocess.run(command, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr)
+        raise SystemExit(f"backfill.py exited with {result.returncode}")
+    summary = [line for line in result.stderr.splitlines() if 'Loaded ' in line]
+    return elapsed, summary[-1].split(' - ', 3)[-1] if summary else ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=20)
+    parser.add_argument('--days', type=int, default=7, help="Days of NDJSON archives per device")
+    parser.add_argument('--legacy-days', type=int, default=2, help="Days of legacy JSON arrays before them")
+    parser.add_argument('--interval', type=float, default=10.0, help="Seconds between readings")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--keep', help="Write the archives here and keep them, instead of a temp directory")
+    args = parser.parse_args()
+
+    directory = args.keep or tempfile.mkdtemp(prefix='backfill-bench-')
+    try:
+        start = datetime.datetime(2025, 3, 1)
+        begin = time.perf_counter()
+        rows = sum(write_device(directory, f"pi-{i:03d}", args, start) for i in range(args.devices))
+        size = sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(directory) for name in names)
+        print(f"{args.devices} devices, {rows} rows in {size / 1024 / 1024:.0f} MB of archives "
+              f"(generated in {time.perf_counter() - begin:.1f}s), {args.jobs} jobs")
+
+        runs = [('parse only', ['--dry-run'])]
+        if os.environ.get('DB_HOST'):
+            runs += [('load', []), ('reload, all duplicates', [])]
+        for label, extra in runs:
+            elapsed, summary = run_backfill(directory, args, extra)
+            print(f"{label:>24}: {elapsed:6.1f}s  {rows / elapsed * 60 / 1e6:6.2f}M rows/min")
+            print(f"{'':>26}{summary}")
+    finally:
+        if not args.keep:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
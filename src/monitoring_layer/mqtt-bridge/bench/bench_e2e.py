@@ -0,0 +1,499 @@
+#!/usr/bin/env python3
+"""End-to-end benchmark: simulated Pis -> MQTT broker -> bridge -> Postgres.
+
+Starts a throwaway mosquitto and Postgres (TimescaleDB when the extension
+is installed) from local binaries, runs the bridge as a subprocess in
+production mode against them, and drives --pis simulated Pis through the
+real pi_client MQTTClient (outbox, drainer, optional batching). Readings
+carry their send time as timestamp and sensor_data gets an ingested_at
+column defaulting to clock_timestamp(), so publish-to-row latency is read
+straight from the table afterwards.
+
+Records delivered messages/rows per second, p50/p99 publish-to-row
+latency and the bridge process's CPU and RSS, and writes them with the
+git commit and settings to a JSON file so runs can be compared:
+
+    python3 bench/bench_e2e.py --pis 50 --rate 2000 --duration 30
+    python3 bench/bench_e2e.py --pis 50 --rate 2000 --engine asyncio --baseline bench/results/e2e-<commit>.json
+
+Needs mosquitto and the Postgres server binaries (initdb, pg_ctl) on PATH
+or --pg-bindir; initdb refuses to run as root. Pass --broker and/or
+--db-host to use services that are already running instead.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import psycopg2
+import yaml
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(BENCH_DIR, '..', 'src')
+PI_CLIENT_DIR = os.path.join(BENCH_DIR, '..', '..', '..', 'pi_client')
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+sys.path.insert(0, PI_CLIENT_DIR)
+
+# Same table and index as timescaledb/configmap.yaml, plus the ingest timestamp
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sensor_data (
+  time TIMESTAMPTZ NOT NULL,
+  device_id TEXT,
+  sensor_type TEXT,
+  value DOUBLE PRECISION,
+  location_id TEXT,
+  ingested_at TIMESTAMPTZ DEFAULT clock_timestamp()
+);
+CREATE UNIQUE INDEX IF NOT EXISTS sensor_data_device_type_time_key ON sensor_data (device_id, sensor_type, time DESC);
+"""
+
+LATENCY_QUERY = """
+SELECT count(DISTINCT (device_id, time)),
+       count(*),
+       percentile_cont(0.5) WITHIN GROUP (ORDER BY extract(epoch FROM ingested_at - time)),
+       percentile_cont(0.99) WITHIN GROUP (ORDER BY extract(epoch FROM ingested_at - time)),
+       max(extract(epoch FROM ingested_at - time))::float8,
+       extract(epoch FROM max(ingested_at) - min(time))::float8
+FROM sensor_data
+WHERE device_id LIKE 'e2e-%'
+"""
+
+# Metrics checked against a baseline, and whether higher is better
+COMPARED = {
+    'messages_per_second': True,
+    'rows_per_second': True,
+    'latency_p50_ms': False,
+    'latency_p99_ms': False,
+    'bridge_cpu_percent': False,
+    'bridge_rss_peak_mb': False,
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout}s")
+
+
+class LocalMosquitto:
+    """mosquitto on a free port with an unlimited queue, killed on stop()"""
+
+    def __init__(self, directory, binary='mosquitto'):
+        self.binary = shutil.which(binary)
+        if self.binary is None:
+            raise RuntimeError("mosquitto not found on PATH, install it or pass --broker")
+        self.port = free_port()
+        self.conf = os.path.join(directory, 'mosquitto.conf')
+        with open(self.conf, 'w') as f:
+            f.write(f"listener {self.port} 127.0.0.1\n"
+                    "allow_anonymous true\n"
+                    "persistence false\n"
+                    "max_queued_messages 0\n"
+                    "max_inflight_messages 0\n")
+        self.process = None
+
+    def start(self):
+        self.process = subprocess.Popen([self.binary, '-c', self.conf],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_for_port(self.port)
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait(timeout=10)
+
+
+class LocalPostgres:
+    """Scratch Postgres cluster in ``directory`` on a free port, trust auth.
+    Loads TimescaleDB when the extension is installed."""
+
+    def __init__(self, directory, bindir=None):
+        bindir = bindir or self._find_bindir()
+        self.initdb = os.path.join(bindir, 'initdb')
+        self.pg_ctl = os.path.join(bindir, 'pg_ctl')
+        if not os.path.exists(self.initdb):
+            raise RuntimeError("Postgres server binaries not found, pass --pg-bindir or --db-host")
+        if os.geteuid() == 0:
+            raise RuntimeError("initdb refuses to run as root, run as another user or pass --db-host")
+        self.data_dir = os.path.join(directory, 'pgdata')
+        self.socket_dir = directory
+        self.port = free_port()
+        self.timescale = os.path.exists(os.path.join(self._sharedir(bindir), 'extension', 'timescaledb.control'))
+
+    @staticmethod
+    def _find_bindir():
+        pg_config = shutil.which('pg_config')
+        if pg_config:
+            return subprocess.check_output([pg_config, '--bindir'], text=True).strip()
+        initdb = shutil.which('initdb')
+        return os.path.dirname(initdb) if initdb else ''
+
+    @staticmethod
+    def _sharedir(bindir):
+        pg_config = os.path.join(bindir, 'pg_config')
+        if os.path.exists(pg_config):
+            return subprocess.check_output([pg_config, '--sharedir'], text=True).strip()
+        return os.path.join(bindir, '..', 'share')
+
+    def start(self):
+        subprocess.run([self.initdb, '-D', self.data_dir, '-U', 'postgres', '--auth=trust'],
+                       check=True, stdout=subprocess.DEVNULL)
+        options = f"-p {self.port} -k {self.socket_dir} -c listen_addresses=127.0.0.1 -c fsync=off"
+        if self.timescale:
+            options += " -c shared_preload_libraries=timescaledb"
+        subprocess.run([self.pg_ctl, '-D', self.data_dir, '-o', options, '-l',
+                        os.path.join(self.socket_dir, 'postgres.log'), '-w', 'start'],
+                       check=True, stdout=subprocess.DEVNULL)
+
+    def stop(self):
+        subprocess.run([self.pg_ctl, '-D', self.data_dir, '-m', 'immediate', 'stop'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def prepare_database(host, port, name, user, password):
+    """Create the scratch database if needed and a fresh sensor_data table"""
+    admin = psycopg2.connect(host=host, port=port, dbname='postgres', user=user, password=password)
+    admin.autocommit = True
+    cur = admin.cursor()
+    cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (name,))
+    if cur.fetchone() is None:
+        cur.execute(f'CREATE DATABASE "{name}"')
+    admin.close()
+
+    conn = psycopg2.connect(host=host, port=port, dbname=name, user=user, password=password)
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'timescaledb'")
+    timescale = cur.fetchone() is not None
+    cur.execute("DROP TABLE IF EXISTS sensor_data CASCADE")
+    cur.execute(SCHEMA)
+    if timescale:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS timescaledb")
+        cur.execute("SELECT create_hypertable('sensor_data', 'time', chunk_time_interval => INTERVAL '1 day')")
+    return conn, timescale
+
+
+class ProcessSampler:
+    """Samples a process's CPU time and RSS from /proc every ``interval`` seconds"""
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.ticks = os.sysconf('SC_CLK_TCK')
+        self.peak_rss = 0
+        self.rss = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._start = None
+
+    def cpu_seconds(self):
+        with open(f"/proc/{self.pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        # utime and stime are fields 14 and 15, counted from the state field (3)
+        return (int(fields[11]) + int(fields[12])) / self.ticks
+
+    def rss_bytes(self):
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def start(self):
+        self._start = (time.monotonic(), self.cpu_seconds())
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                rss = self.rss_bytes()
+            except OSError:
+                return
+            self.rss.append(rss)
+            self.peak_rss = max(self.peak_rss, rss)
+
+    def stop(self):
+        """Stop sampling and return (cpu_seconds, cpu_percent, mean_rss, peak_rss)"""
+        self._stop.set()
+        self._thread.join()
+        wall = time.monotonic() - self._start[0]
+        cpu = self.cpu_seconds() - self._start[1]
+        mean_rss = sum(self.rss) / len(self.rss) if self.rss else 0
+        return cpu, 100.0 * cpu / wall if wall > 0 else 0.0, mean_rss, self.peak_rss
+
+
+def bridge_config(args, broker_host, broker_port, db_host, db_port):
+    return {
+        'bridge': {
+            'mode': 'production',
+            'engine': args.engine,
+            'client_id': 'e2e-bridge',
+            'topics': ['sensors/+/data', 'sensors/+/motion', 'sensors/+/status'],
+            'qos': 1,
+            'broker': {'host': broker_host, 'port': broker_port, 'tls': False},
+            'workers': args.workers,
+            'stats_interval_seconds': 3600,
+        },
+        'database': {
+            'host': db_host,
+            'port': db_port,
+            'name': args.db_name,
+            'batch': {'size': args.db_batch_size, 'flush_interval_seconds': args.flush_interval},
+        },
+        'logging': {'level': 'warning'},
+    }
+
+
+def start_bridge(config, directory, db_user, db_password):
+    config_path = os.path.join(directory, 'bridge.yaml')
+    with open(config_path, 'w') as f:
+        yaml.safe_dump(config, f)
+    env = dict(os.environ, CONFIG_PATH=config_path, DB_USER=db_user, DB_PASSWORD=db_password)
+    log = open(os.path.join(directory, 'bridge.log'), 'w')
+    process = subprocess.Popen([sys.executable, os.path.join(SRC_DIR, 'mqtt-bridge.py')],
+                               cwd=SRC_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return process, log
+
+
+def make_pis(args, broker_host, broker_port, directory):
+    """MQTTClient instances configured through the environment, as on a Pi"""
+    import drivers
+    from mqtt_client import MQTTClient
+
+    pis = []
+    for i in range(args.pis):
+        device_id = f"e2e-{i:04d}"
+        os.environ.update({
+            'BROKER': broker_host,
+            'CLIENTID': device_id,
+            'DEVICE_ID': device_id,
+            'MQTT_TLS': 'false',
+            'OUTBOX_PATH': os.path.join(directory, f"outbox-{device_id}.db"),
+            'MQTT_BATCH_SIZE': str(args.pi_batch_size),
+            'MQTT_BATCH_MS': str(args.pi_batch_ms),
+        })
+        client = MQTTClient(port=broker_port)
+        client.connect()
+        driver = drivers.create(args.driver, simulated=True, seed=args.seed + i)
+        driver.open()
+        pis.append((client, driver))
+    return pis
+
+
+def drive(pis, rate, duration):
+    """Send readings round-robin across the Pis at ``rate`` messages/s (0 = flat out)"""
+    sent = 0
+    start = time.monotonic()
+    while True:
+        elapsed = time.monotonic() - start
+        if elapsed >= duration:
+            break
+        if rate:
+            due = int(elapsed * rate) - sent
+            if due <= 0:
+                time.sleep(min(0.005, 1.0 / rate))
+                continue
+        else:
+            due = len(pis)
+        for _ in range(due):
+            client, driver = pis[sent % len(pis)]
+            client.send({"timestamp": time.time(), "event": "regular_reading", "sensor_data": driver.read()})
+            sent += 1
+    return sent, time.monotonic() - start
+
+
+def wait_for_rows(conn, pis, expected_messages, settle):
+    """Wait until every outbox is drained and the row count stops changing"""
+    cur = conn.cursor()
+    last, last_change = -1, time.monotonic()
+    while time.monotonic() - last_change < settle:
+        cur.execute("SELECT count(*) FROM sensor_data WHERE sensor_type = 'temperature'")
+        count = cur.fetchone()[0]
+        outboxes = sum(len(client.outbox) for client, _ in pis)
+        if count != last or outboxes:
+            last, last_change = count, time.monotonic()
+        if count >= expected_messages and not outboxes:
+            break
+        time.sleep(0.2)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                                       text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(result, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    if baseline['settings'] != result['settings']:
+        print(f"\nNote: baseline ran with different settings: {baseline['settings']}")
+    regressions = []
+    print(f"\n{'metric':<24} {'baseline':>12} {'this run':>12} {'change':>8}  (baseline {baseline['commit']})")
+    for key, higher_is_better in COMPARED.items():
+        before, value = baseline['metrics'].get(key), result['metrics'][key]
+        if not before:
+            continue
+        change = (value - before) / before
+        worse = -change if higher_is_better else change
+        flag = '  REGRESSION' if worse > tolerance else ''
+        if flag:
+            regressions.append(key)
+        print(f"{key:<24} {before:>12.2f} {value:>12.2f} {change:>+7.1%}{flag}")
+    return regressions
+
+
+def run(args, directory):
+    services = []
+    try:
+        if args.broker:
+            broker_host, _, broker_port = args.broker.partition(':')
+            broker_port = int(broker_port or 1883)
+        else:
+            mosquitto = LocalMosquitto(directory)
+            mosquitto.start()
+            services.append(mosquitto)
+            broker_host, broker_port = '127.0.0.1', mosquitto.port
+
+        if args.db_host:
+            db_host, db_port = args.db_host, args.db_port
+        else:
+            postgres = LocalPostgres(directory, args.pg_bindir)
+            postgres.start()
+            services.append(postgres)
+            db_host, db_port = '127.0.0.1', postgres.port
+
+        db_user = os.environ.get('DB_USER', 'postgres')
+        db_password = os.environ.get('DB_PASSWORD', 'postgres')
+        conn, timescale = prepare_database(db_host, db_port, args.db_name, db_user, db_password)
+
+        bridge, bridge_log = start_bridge(bridge_config(args, broker_host, broker_port, db_host, db_port),
+                                          directory, db_user, db_password)
+        try:
+            time.sleep(args.bridge_warmup)
+            if bridge.poll() is not None:
+                with open(bridge_log.name) as f:
+                    tail = f.readlines()[-20:]
+                raise RuntimeError(f"Bridge exited with {bridge.returncode}:\n{''.join(tail)}")
+            pis = make_pis(args, broker_host, broker_port, directory)
+            sampler = ProcessSampler(bridge.pid)
+            sampler.start()
+
+            sent, send_seconds = drive(pis, args.rate, args.duration)
+            wait_for_rows(conn, pis, sent, args.settle)
+            cpu_seconds, cpu_percent, mean_rss, peak_rss = sampler.stop()
+            for client, driver in pis:
+                client.disconnect()
+                driver.close()
+        finally:
+            bridge.terminate()
+            bridge.wait(timeout=30)
+            bridge_log.close()
+
+        cur = conn.cursor()
+        cur.execute(LATENCY_QUERY)
+        messages, rows, p50, p99, latency_max, span = cur.fetchone()
+        conn.close()
+    finally:
+        for service in reversed(services):
+            service.stop()
+
+    return {
+        'commit': git_commit(),
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'settings': {
+            'pis': args.pis, 'rate': args.rate, 'duration': args.duration, 'driver': args.driver,
+            'engine': args.engine, 'workers': args.workers, 'db_batch_size': args.db_batch_size,
+            'flush_interval': args.flush_interval, 'pi_batch_size': args.pi_batch_size,
+            'timescaledb': timescale,
+        },
+        'metrics': {
+            'messages_sent': sent,
+            'messages_stored': messages,
+            'messages_lost': sent - messages,
+            'rows_stored': rows,
+            'send_rate': sent / send_seconds if send_seconds else 0.0,
+            'messages_per_second': messages / span if span else 0.0,
+            'rows_per_second': rows / span if span else 0.0,
+            'latency_p50_ms': (p50 or 0.0) * 1000,
+            'latency_p99_ms': (p99 or 0.0) * 1000,
+            'latency_max_ms': (latency_max or 0.0) * 1000,
+            'bridge_cpu_seconds': cpu_seconds,
+            'bridge_cpu_percent': cpu_percent,
+            'bridge_rss_mean_mb': mean_rss / 2 ** 20,
+            'bridge_rss_peak_mb': peak_rss / 2 ** 20,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pis', type=int, default=20)
+    parser.add_argument('--rate', type=float, default=1000, help="Messages per second across all Pis, 0 = flat out")
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--driver', default='bme280', help="Simulated driver each Pi reads")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--pi-batch-size', type=int, default=1, help="MQTT_BATCH_SIZE on the Pis")
+    parser.add_argument('--pi-batch-ms', type=int, default=200, help="MQTT_BATCH_MS on the Pis")
+    parser.add_argument('--engine', choices=('sync', 'asyncio'), default='sync')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--db-batch-size', type=int, default=500)
+    parser.add_argument('--flush-interval', type=float, default=0.2)
+    parser.add_argument('--broker', help="host:port of a running broker instead of a local mosquitto")
+    parser.add_argument('--db-host', help="Running Postgres instead of a scratch cluster (DB_USER/DB_PASSWORD from env)")
+    parser.add_argument('--db-port', type=int, default=5432)
+    parser.add_argument('--db-name', default='sensor_data_e2e')
+    parser.add_argument('--pg-bindir', help="Directory with initdb and pg_ctl")
+    parser.add_argument('--bridge-warmup', type=float, default=3, help="Seconds to let the bridge subscribe")
+    parser.add_argument('--settle', type=float, default=10, help="Give up waiting after this long without new rows")
+    parser.add_argument('--output', help="Result file, default bench/results/e2e-<commit>-<engine>.json")
+    parser.add_argument('--baseline', help="Earlier result file to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="Relative change flagged as a regression")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory(prefix='bench-e2e-') as directory:
+        os.chmod(directory, 0o755)
+        result = run(args, directory)
+
+    for key, value in result['metrics'].items():
+        print(f"{key + ':':<24} {value:.2f}" if isinstance(value, float) else f"{key + ':':<24} {value}")
+
+    output = args.output or os.path.join(RESULTS_DIR, f"e2e-{result['commit']}-{args.engine}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.baseline:
+        regressions = compare(result, args.baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} metric(s) regressed by more than {args.tolerance:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""Load test the sync and asyncio bridge engines through a local broker.
+
+Publishes messages stamped with their send time to a local mosquitto, runs
+each engine against a scratch database, and reports achieved messages/sec
+and publish-to-commit latency percentiles:
+
+    DB_HOST=localhost DB_PASSWORD=postgres python3 bench/bench_engines.py --broker localhost:1883 --messages 50000
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+from paho.mqtt import client as mqtt_client  # noqa: E402
+
+from pipeline import IngestPipeline  # noqa: E402
+from subscriber import MQTTSubscriber  # noqa: E402
+
+
+def load_bridge():
+    spec = importlib.util.spec_from_file_location('mqtt_bridge', os.path.join(SRC_DIR, 'mqtt-bridge.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class LatencyProbe:
+    """on_flush hook recording publish-to-commit latency, one sample per message"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.rows = 0
+        self.last_commit = None
+
+    def record(self, rows):
+        now = time.time()
+        samples = [now - row[0].timestamp() for row in rows if row[2] == 'temperature']
+        with self.lock:
+            self.latencies.extend(samples)
+            self.rows += len(rows)
+            self.last_commit = now
+
+    def percentile(self, pct):
+        ordered = sorted(self.latencies)
+        if not ordered:
+            return float('nan')
+        return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+
+def publish(host, port, messages, devices, rate):
+    client = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2, client_id='bench-engines-publisher',
+                                protocol=mqtt_client.MQTTv5)
+    client.connect(host, port)
+    client.loop_start()
+    interval = 1.0 / rate if rate else 0
+    start = time.perf_counter()
+    for seq in range(messages):
+        if interval:
+            delay = start + seq * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        payload = json.dumps({
+            'timestamp': time.time(),
+            'sensor_data': {'temperature_c': 21.5, 'pressure_hpa': 1001.2, 'altitude_m': 133.2},
+        })
+        client.publish(f"sensors/pi{seq % devices:05d}/data", payload, qos=1)
+    client.loop_stop()
+    client.disconnect()
+
+
+def wait_for_rows(probe, expected, timeout):
+    deadline = time.time() + timeout
+    while probe.rows < expected and time.time() < deadline:
+        time.sleep(0.2)
+
+
+def run_sync(config, probe):
+    bridge = load_bridge()
+    pipeline = IngestPipeline.from_config(config, lambda: bridge.get_db_connection(config), on_flush=probe.record)
+    pipeline.start()
+    subscriber = MQTTSubscriber(config, pipeline.submit)
+    subscriber.start()
+
+    def stop():
+        subscriber.stop()
+        pipeline.stop()
+    return stop
+
+
+def run_asyncio(config, probe):
+    from async_engine import AsyncBridge
+
+    engine = AsyncBridge(config, on_flush=probe.record)
+    thread = threading.Thread(target=asyncio.run, args=(engine.run(),), daemon=True)
+    thread.start()
+
+    def stop():
+        engine.stop()
+        thread.join()
+    return stop
+
+
+def truncate(config):
+    conn = load_bridge().get_db_connection(config)
+    cur = conn.cursor()
+    cur.execute("TRUNCATE sensor_data")
+    conn.commit()
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--broker', default='localhost:1883')
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=0, help="Target publish rate in msg/sec, 0 for unthrottled")
+    parser.add_argument('--engines', default='sync,asyncio')
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    host, _, port = args.broker.partition(':')
+    port = int(port or 1883)
+
+    results = {}
+    for engine in args.engines.split(','):
+        config = {
+            'bridge': {
+                'client_id': f"bench-{engine}",
+                'topics': ['sensors/+/data'],
+                'broker': {'host': host, 'port': port, 'tls': False},
+                'stats_interval_seconds': 3600,
+            },
+            'database': {
+                'host': os.environ.get('DB_HOST', 'localhost'),
+                'port': int(os.environ.get('DB_PORT', 5432)),
+                'name': os.environ.get('DB_NAME', 'sensor_data'),
+                'batch': {'size': 1000, 'flush_interval_seconds': 0.2},
+                'pool': {'min_size': 4, 'max_size': 8},
+            },
+        }
+        truncate(config)
+        probe = LatencyProbe()
+        stop = run_sync(config, probe) if engine == 'sync' else run_asyncio(config, probe)
+        time.sleep(1)
+
+        start = time.time()
+        publish(host, port, args.messages, args.devices, args.rate)
+        wait_for_rows(probe, args.messages * 3, args.timeout)
+        elapsed = (probe.last_commit or time.time()) - start
+        stop()
+
+        results[engine] = {
+            'messages': len(probe.latencies),
+            'msg_per_sec': len(probe.latencies) / elapsed if elapsed > 0 else 0,
+            'p50_ms': probe.percentile(50) * 1000,
+            'p99_ms': probe.percentile(99) * 1000,
+        }
+
+    print(f"{'engine':<10} {'messages':>10} {'msg/sec':>10} {'p50 ms':>10} {'p99 ms':>10}")
+    for engine, r in results.items():
+        print(f"{engine:<10} {r['messages']:>10} {r['msg_per_sec']:>10.0f} {r['p50_ms']:>10.1f} {r['p99_ms']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Compare the per-row insert_sensor_data path against BatchWriter.
+
+Run against a scratch database, the sensor_data table is truncated between runs:
+
+    DB_HOST=localhost DB_PASSWORD=timescaledbpassword python3 bench/bench_ingest.py --readings 20000
+"""
+import argparse
+import importlib.util
+import logging
+import os
+import random
+import sys
+import time
+import datetime
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+from batch_writer import BatchWriter  # noqa: E402
+
+
+def load_bridge():
+    # mqtt-bridge.py is not importable by name because of the dash
+    spec = importlib.util.spec_from_file_location('mqtt_bridge', os.path.join(SRC_DIR, 'mqtt-bridge.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def generate_readings(count, devices):
+    rng = random.Random(42)
+    base = datetime.datetime.now()
+    return [
+        (f"sensor{i % devices:04d}",
+         rng.uniform(18.0, 28.0),
+         rng.uniform(30.0, 80.0),
+         rng.uniform(980.0, 1020.0),
+         base + datetime.timedelta(milliseconds=i))
+        for i in range(count)
+    ]
+
+
+def reset_table(conn):
+    cur = conn.cursor()
+    cur.execute("TRUNCATE sensor_data")
+    conn.commit()
+    cur.close()
+
+
+def bench_per_row(bridge, conn, readings):
+    start = time.perf_counter()
+    for sensor_id, temperature, humidity, pressure, ts in readings:
+        bridge.insert_sensor_data(conn, sensor_id, temperature, humidity, pressure, ts)
+    return time.perf_counter() - start, None
+
+
+def bench_batched(conn, readings, method, batch_size):
+    writer = BatchWriter(conn, batch_size=batch_size, flush_interval=3600, method=method)
+    start = time.perf_counter()
+    for sensor_id, temperature, humidity, pressure, ts in readings:
+        writer.add_reading(sensor_id, temperature, humidity, pressure, ts)
+    writer.flush()
+    return time.perf_counter() - start, writer.stats()
+
+
+def report(name, readings, elapsed, stats):
+    rows = len(readings) * 3
+    line = f"{name:<18} {len(readings) / elapsed:>10.0f} readings/sec {rows / elapsed:>10.0f} rows/sec"
+    if stats:
+        line += f"   avg flush {stats['avg_flush_ms']:.1f} ms over {stats['flushes']} flushes"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--readings', type=int, default=10000)
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--skip-per-row', action='store_true', help="Skip the slow per-row baseline")
+    args = parser.parse_args()
+
+    bridge = load_bridge()
+    # Per-insert INFO logging would dominate the per-row timings
+    logging.getLogger('mqtt-bridge').setLevel(logging.WARNING)
+
+    config = {'database': {
+        'host': os.environ.get('DB_HOST', 'localhost'),
+        'port': int(os.environ.get('DB_PORT', 5432)),
+        'name': os.environ.get('DB_NAME', 'sensor_data'),
+    }}
+    conn = bridge.get_db_connection(config)
+    readings = generate_readings(args.readings, args.devices)
+
+    try:
+        if not args.skip_per_row:
+            reset_table(conn)
+            elapsed, stats = bench_per_row(bridge, conn, readings)
+            report('per-row insert', readings, elapsed, stats)
+
+        for method in ('copy', 'values'):
+            reset_table(conn)
+            elapsed, stats = bench_batched(conn, readings, method, args.batch_size)
+            report(f"batched {method}", readings, elapsed, stats)
+    finally:
+        reset_table(conn)
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""Drive the production ingest pipeline and report throughput and backpressure.
+
+By default messages are handed straight to IngestPipeline.submit from
+publisher threads, standing in for paho's network thread, and rows go to a
+null database so only the bridge's own overhead is measured. Use --db to
+write to a real (scratch) database and --broker to go through a local
+mosquitto via MQTTSubscriber instead:
+
+    python3 bench/bench_pipeline.py --messages 200000 --workers 4
+    python3 bench/bench_pipeline.py --broker localhost:1883 --db
+
+Add --rollup to also aggregate every row into per-minute rollups and
+--rules to also run the alert rules over every batch.
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import types
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+from batch_writer import writer_stages  # noqa: E402
+from pipeline import IngestPipeline  # noqa: E402
+
+
+class NullCursor:
+    rowcount = -1
+    connection = types.SimpleNamespace(encoding='UTF8')
+
+    def copy_expert(self, sql, buf):
+        buf.read()
+
+    def mogrify(self, template, args):
+        return b''
+
+    def execute(self, *args, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
+
+class NullConnection:
+    """Accepts writes and discards them, isolating bridge CPU cost from the DB"""
+
+    def cursor(self):
+        return NullCursor()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def load_bridge():
+    spec = importlib.util.spec_from_file_location('mqtt_bridge', os.path.join(SRC_DIR, 'mqtt-bridge.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_payload(device_index, seq):
+    return json.dumps({
+        'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'event': 'regular_reading',
+        'sensor_data': {
+            'temperature_c': 20.0 + (seq % 50) / 10,
+            'temperature_f': 68.0,
+            'pressure_hpa': 1000.0 + (seq % 20),
+            'altitude_m': 133.2,
+        },
+    }).encode()
+
+
+def publish_direct(pipeline, messages, devices, threads):
+    per_thread = messages // threads
+
+    def run(offset):
+        for seq in range(per_thread):
+            device = (offset + seq) % devices
+            pipeline.submit(f"sensors/pi{device:05d}/data", make_payload(device, seq))
+
+    workers = [threading.Thread(target=run, args=(i * per_thread,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return per_thread * threads
+
+
+def publish_broker(pipeline, config, messages, devices):
+    from paho.mqtt import client as mqtt_client
+    from subscriber import MQTTSubscriber, broker_settings
+
+    subscriber = MQTTSubscriber(config, pipeline.submit)
+    subscriber.start()
+    time.sleep(1)
+
+    settings = broker_settings(config)
+    publisher = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2, client_id='bench-publisher',
+                                   protocol=mqtt_client.MQTTv5)
+    publisher.connect(settings['host'], settings['port'])
+    publisher.loop_start()
+    for seq in range(messages):
+        device = seq % devices
+        publisher.publish(f"sensors/pi{device:05d}/data", make_payload(device, seq), qos=1)
+
+    # Wait for the subscriber to see everything or stop making progress
+    last = -1
+    while pipeline.stats()['messages_received'] < messages:
+        received = pipeline.stats()['messages_received']
+        if received == last:
+            break
+        last = received
+        time.sleep(1)
+
+    publisher.loop_stop()
+    publisher.disconnect()
+    subscriber.stop()
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--threads', type=int, default=1, help="Publisher threads in direct mode")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--queue-size', type=int, default=10000)
+    parser.add_argument('--policy', choices=('block', 'drop'), default='block')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--rollup', action='store_true', help="Also run the per-minute rollup stage")
+    parser.add_argument('--rules', action='store_true', help="Also run the alert rules stage")
+    parser.add_argument('--db', action='store_true', help="Write to the database from DB_HOST instead of a null sink")
+    parser.add_argument('--broker', help="host:port of a local MQTT broker to publish through")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    config = {
+        'bridge': {'client_id': 'bench-bridge', 'topics': ['sensors/+/data']},
+        'database': {
+            'host': os.environ.get('DB_HOST', 'localhost'),
+            'port': int(os.environ.get('DB_PORT', 5432)),
+            'name': os.environ.get('DB_NAME', 'sensor_data'),
+        },
+    }
+    if args.broker:
+        host, _, port = args.broker.partition(':')
+        config['bridge']['broker'] = {'host': host, 'port': int(port or 1883), 'tls': False}
+
+    if args.db:
+        bridge = load_bridge()
+        connect = lambda: bridge.get_db_connection(config)  # noqa: E731
+    else:
+        connect = NullConnection
+
+    if args.rollup:
+        config['database']['rollup'] = {'enabled': True}
+    if args.rules:
+        config['alerts'] = {'enabled': True, 'sensors': {
+            'temperature': {'min': -20, 'max': 60, 'max_rate_per_minute': 5, 'zscore': 6},
+            'humidity': {'min': 0, 'max': 100, 'max_rate_per_minute': 20, 'zscore': 6},
+            'pressure': {'min': 870, 'max': 1085, 'max_rate_per_minute': 3, 'zscore': 6},
+        }}
+    pipeline = IngestPipeline(connect, queue_size=args.queue_size, workers=args.workers, policy=args.policy,
+                              batch_size=args.batch_size, flush_interval=0.5,
+                              make_stages=lambda: writer_stages(config),
+                              deduplicate=args.db)
+    pipeline.start()
+
+    start = time.perf_counter()
+    if args.broker:
+        sent = publish_broker(pipeline, config, args.messages, args.devices)
+    else:
+        sent = publish_direct(pipeline, args.messages, args.devices, args.threads)
+    submit_elapsed = time.perf_counter() - start
+    pipeline.stop()
+    total_elapsed = time.perf_counter() - start
+
+    stats = pipeline.stats()
+    print(f"messages sent:        {sent}")
+    print(f"submit rate:          {sent / submit_elapsed:.0f} msg/sec")
+    print(f"end-to-end rate:      {stats['messages_enqueued'] / total_elapsed:.0f} msg/sec")
+    print(f"rows written:         {stats['rows_written']}")
+    print(f"dropped:              {stats['messages_dropped']}")
+    print(f"backpressure waits:   {stats['backpressure_waits']}")
+    print(f"max queue depth:      {stats['max_queue_depth']}/{stats['queue_capacity']}")
+    if args.rollup:
+        print(f"rollup rows in:       {stats['rollup_rows_in']}")
+        print(f"rollup rows written:  {stats['rollup_rows_written']}")
+    if args.rules:
+        print(f"rule rows checked:    {stats['alerts_rows_checked']}")
+        print(f"alerts raised:        {stats['alerts_raised']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""Load test the query API (src/query_api.py) with simulated dashboards.
+
+Starts the API as a subprocess against DB_HOST (or uses --url) and runs
+--clients dashboard viewers. Every --refresh seconds each viewer loads its
+dashboard: /latest plus --panels series panels over --range, picked from
+--dashboards distinct dashboards, the way several people watching the
+same Grafana dashboards do. Reports requests per second, p50/p99 latency
+per endpoint and the database queries the API made, so a run with
+--cache-entries 0 shows what the cache saves:
+
+    DB_HOST=localhost python3 bench/bench_query_api.py --seed --clients 50 --duration 30
+    DB_HOST=localhost python3 bench/bench_query_api.py --clients 50 --duration 30 --cache-entries 0
+
+--seed fills sensor_data with --devices devices reporting every
+--interval seconds for --days, replacing what is there.
+"""
+import argparse
+import datetime
+import http.client
+import io
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import psycopg2
+import yaml
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+QUERY_API = os.path.join(BENCH_DIR, '..', 'src', 'query_api.py')
+SENSOR_TYPES = ('temperature', 'humidity', 'pressure')
+
+
+def db_settings():
+    return {
+        'host': os.environ.get('DB_HOST', 'localhost'),
+        'port': int(os.environ.get('DB_PORT', 5432)),
+        'dbname': os.environ.get('DB_NAME', 'sensor_data'),
+        'user': os.environ.get('DB_USER', 'postgres'),
+        'password': os.environ.get('DB_PASSWORD', 'postgres'),
+    }
+
+
+def seed(args):
+    conn = psycopg2.connect(**db_settings())
+    cur = conn.cursor()
+    cur.execute("TRUNCATE sensor_data")
+    end = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    steps = int(args.days * 86400 / args.interval)
+    rng = random.Random(0)
+    for device in range(args.devices):
+        buf = io.StringIO()
+        for step in range(steps):
+            at = end - datetime.timedelta(seconds=(steps - step) * args.interval)
+            for sensor_type, base in zip(SENSOR_TYPES, (21.0, 45.0, 1013.0)):
+                buf.write(f"{at.isoformat()},sensor{device:04d},{sensor_type},{base + rng.gauss(0, 1):.2f},default\n")
+        buf.seek(0)
+        cur.copy_expert("COPY sensor_data (time, device_id, sensor_type, value, location_id) FROM STDIN WITH (FORMAT csv)",
+                        buf)
+    conn.commit()
+    cur.execute("ANALYZE sensor_data")
+    conn.commit()
+    conn.close()
+    print(f"Seeded {args.devices * steps * len(SENSOR_TYPES)} rows")
+
+
+def start_api(args, port):
+    settings = db_settings()
+    config = {
+        'database': {'host': settings['host'], 'port': settings['port'], 'name': settings['dbname']},
+        'query_api': {'port': port, 'pool_size': args.pool_size,
+                      'cache': {'max_entries': args.cache_entries, 'ttl_seconds': args.ttl}},
+        'logging': {'level': 'warning'},
+    }
+    config_file = tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False)
+    yaml.safe_dump(config, config_file)
+    config_file.close()
+    env = dict(os.environ, CONFIG_PATH=config_file.name, DB_USER=settings['user'], DB_PASSWORD=settings['password'])
+    process = subprocess.Popen([sys.executable, QUERY_API], env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            status, body = get(http.client.HTTPConnection('127.0.0.1', port, timeout=5), '/healthz')
+            if body.get('status') == 'ok':
+                return process, config_file.name
+        except OSError:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise SystemExit("Query API did not become ready")
+
+
+def get(conn, path):
+    conn.request('GET', path)
+    response = conn.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def dashboards(args, devices):
+    """Each dashboard is a list of request paths loaded together"""
+    rng = random.Random(1)
+    boards = []
+    for _ in range(args.dashboards):
+        panels = ['/latest']
+        for _ in range(args.panels):
+            query = urllib.parse.urlencode({'device_id': rng.choice(devices), 'sensor_type': rng.choice(SENSOR_TYPES),
+                                            'from': f"now-{args.range}", 'to': 'now'})
+            panels.append(f"/series?{query}")
+        boards.append(panels)
+    return boards
+
+
+def viewer(host, port, board, args, stop, timings, errors, offset):
+    conn = http.client.HTTPConnection(host, port, timeout=30)
+    # Viewers opened the dashboard at different times
+    stop.wait(offset)
+    while not stop.is_set():
+        started = time.monotonic()
+        for path in board:
+            start = time.perf_counter()
+            try:
+                status, _ = get(conn, path)
+            except (OSError, http.client.HTTPException, ValueError):
+                conn.close()
+                conn = http.client.HTTPConnection(host, port, timeout=30)
+                status = None
+            elapsed = time.perf_counter() - start
+            if status == 200:
+                timings[path.split('?')[0]].append(elapsed)
+            else:
+                errors.append(status)
+        stop.wait(max(args.refresh - (time.monotonic() - started), 0))
+    conn.close()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help="Use a running query API instead of starting one")
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--dashboards', type=int, default=5, help="Distinct dashboards the clients view")
+    parser.add_argument('--panels', type=int, default=6, help="Series panels per dashboard")
+    parser.add_argument('--range', default='24h', help="Time range of the panels")
+    parser.add_argument('--refresh', type=float, default=5.0, help="Dashboard auto-refresh in seconds")
+    parser.add_argument('--duration', type=float, default=30.0)
+    parser.add_argument('--cache-entries', type=int, default=1000, help="0 disables the cache")
+    parser.add_argument('--ttl', type=float, default=10.0)
+    parser.add_argument('--pool-size', type=int, default=8)
+    parser.add_argument('--seed', action='store_true', help="Fill sensor_data first")
+    parser.add_argument('--devices', type=int, default=50)
+    parser.add_argument('--days', type=float, default=2.0)
+    parser.add_argument('--interval', type=float, default=30.0)
+    args = parser.parse_args()
+
+    if args.seed:
+        seed(args)
+
+    process = config_path = None
+    if args.url:
+        url = urllib.parse.urlsplit(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        host = '127.0.0.1'
+        process, config_path = start_api(args, port)
+
+    try:
+        conn = http.client.HTTPConnection(host, port, timeout=30)
+        _, latest = get(conn, '/latest')
+        devices = sorted({row['device_id'] for row in latest}) or ['sensor0000']
+        _, before = get(conn, '/stats')
+        boards = dashboards(args, devices)
+
+        timings = {'/latest': [], '/series': []}
+        errors = []
+        stop = threading.Event()
+        threads = [threading.Thread(target=viewer, daemon=True,
+                                    args=(host, port, boards[i % len(boards)], args, stop, timings, errors,
+                                          args.refresh * i / args.clients))
+                   for i in range(args.clients)]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+        _, after = get(conn, '/stats')
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+            os.unlink(config_path)
+
+    requests = sum(len(values) for values in timings.values())
+    queries = after['query_db_queries'] - before['query_db_queries']
+    print(f"{args.clients} viewers of {args.dashboards} dashboards (1 + {args.panels} panels, {args.range}, "
+          f"refresh {args.refresh}s), cache {args.cache_entries} entries / {args.ttl}s TTL")
+    print(f"{requests} requests in {elapsed:.1f}s ({requests / elapsed:.0f}/s), {len(errors)} errors")
+    for endpoint, values in timings.items():
+        if values:
+            print(f"  {endpoint:<8} p50 {statistics.median(values) * 1000:7.2f} ms   "
+                  f"p99 {percentile(values, 0.99) * 1000:7.2f} ms")
+    hits = after['query_cache_hits'] - before['query_cache_hits']
+    waits = after['query_cache_waits'] - before['query_cache_waits']
+    print(f"database queries: {queries} ({queries / elapsed:.1f}/s, {queries / max(requests, 1):.3f} per request), "
+          f"cache hits {hits}, waited on a query in flight {waits}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""Measure what a config reload costs the running pipeline.
+
+Publishes --rate messages per second into IngestPipeline.submit, as paho's
+network thread would, while ConfigWatcher watches a temporary config file.
+After a baseline phase the file is rewritten once per phase: a bigger batch
+size (applied in place), more and then fewer workers (the workers are
+replaced), and finally a broken edit that must be rejected. For every phase
+it reports the time from the write to the change being applied, how long
+the new workers waited for the old ones to drain, the submit -> commit
+latency (p50/p99/max), the slowest submit() call (what the network thread
+would feel) and dropped messages:
+
+    python3 bench/bench_reload.py --rate 2000 --phase 5
+    DB_HOST=localhost python3 bench/bench_reload.py --db
+
+Without --db rows go to the null database of bench_pipeline.py, so only the
+bridge's own reload cost is measured.
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'src'))
+sys.path.insert(1, BENCH_DIR)
+
+from bench_pipeline import NullConnection, load_bridge  # noqa: E402
+from config_file import ConfigWatcher, parse_config, reload_plan  # noqa: E402
+from pipeline import IngestPipeline  # noqa: E402
+
+CONFIGMAP = os.path.join(BENCH_DIR, '..', 'configmap.yaml')
+
+
+def base_config(args):
+    return {
+        'bridge': {
+            'client_id': 'bench-bridge', 'topics': ['sensors/+/data'], 'workers': args.workers,
+            'queue': {'max_size': args.queue_size, 'policy': 'block', 'block_timeout_seconds': 0.5},
+            'dedup': {'enabled': False},
+            'reload': {'enabled': True, 'debounce_seconds': args.debounce},
+        },
+        'database': {
+            'host': os.environ.get('DB_HOST', 'localhost'),
+            'port': int(os.environ.get('DB_PORT', 5432)),
+            'name': os.environ.get('DB_NAME', 'sensor_data'),
+            'batch': {'size': 500, 'flush_interval_seconds': 0.5, 'deduplicate': args.db},
+        },
+    }
+
+
+def phases(config):
+    """(name, config written at the start of the phase) in order"""
+    bigger_batches = copy.deepcopy(config)
+    bigger_batches['database']['batch']['size'] = 2000
+    more_workers = copy.deepcopy(bigger_batches)
+    more_workers['bridge']['workers'] = config['bridge']['workers'] * 2
+    fewer_workers = copy.deepcopy(more_workers)
+    fewer_workers['bridge']['workers'] = max(config['bridge']['workers'] // 2, 1)
+    broken = copy.deepcopy(fewer_workers)
+    broken['bridge']['workers'] = 0
+    return [('baseline', None), ('batch size 500 -> 2000', bigger_batches),
+            (f"workers {config['bridge']['workers']} -> {more_workers['bridge']['workers']}", more_workers),
+            (f"workers {more_workers['bridge']['workers']} -> {fewer_workers['bridge']['workers']}", fewer_workers),
+            ('invalid edit (rejected)', broken)]
+
+
+def publish(pipeline, args, stop, submits):
+    """Submit --rate messages per second spread over --devices, recording slow submit() calls"""
+    interval = 1.0 / args.rate
+    next_at = time.monotonic()
+    seq = 0
+    while not stop.is_set():
+        device = seq % args.devices
+        payload = json.dumps({'timestamp': time.time(), 'sensor_data': {
+            'temperature_c': 20.0 + (seq % 50) / 10, 'humidity': 45.0, 'pressure_hpa': 1000.0}}).encode()
+        start = time.perf_counter()
+        pipeline.submit(f"sensors/pi{device:05d}/data", payload)
+        submits.append((time.monotonic(), time.perf_counter() - start))
+        seq += 1
+        next_at += interval
+        delay = next_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rate', type=float, default=2000, help="Messages per second")
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--queue-size', type=int, default=10000)
+    parser.add_argument('--phase', type=float, default=5.0, help="Seconds per phase")
+    parser.add_argument('--debounce', type=float, default=0.1)
+    parser.add_argument('--db', action='store_true', help="Write to the database from DB_HOST instead of a null sink")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    with open(CONFIGMAP) as f:
+        text = yaml.safe_load(f)['data']['config.yaml']
+    # The configmap's ${...} are unset here, do not warn 100 times
+    logging.getLogger('mqtt-bridge').setLevel(logging.ERROR)
+    start = time.perf_counter()
+    for _ in range(100):
+        parse_config(text, 'configmap.yaml')
+    logging.getLogger('mqtt-bridge').setLevel(logging.WARNING)
+    print(f"parse + interpolate + validate configmap.yaml: {(time.perf_counter() - start) * 10:.2f} ms")
+
+    config = base_config(args)
+    if args.db:
+        bridge = load_bridge()
+        connect = lambda: bridge.get_db_connection(config)  # noqa: E731
+    else:
+        connect = NullConnection
+
+    latencies = []  # (commit time, seconds from submit to commit) per message
+
+    def on_flush(rows):
+        now = time.monotonic()
+        wall = time.time()
+        previous = None
+        for row in rows:
+            # The rows of one message share their timestamp object
+            if row[0] is not previous:
+                previous = row[0]
+                latencies.append((now, wall - row[0].timestamp()))
+
+    pipeline = IngestPipeline.from_config(config, connect, on_flush=on_flush)
+    pipeline.start()
+
+    applied = []  # (monotonic time, seconds on_change took, seconds new workers waited)
+
+    def on_change(old, new):
+        start = time.perf_counter()
+        plan = reload_plan(old, new)
+        waited = pipeline.reconfigure(new, rebuild=bool(plan['rebuild']))
+        applied.append((time.monotonic(), time.perf_counter() - start, waited))
+
+    config_file = tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False)
+    yaml.safe_dump(config, config_file)
+    config_file.close()
+    watcher = ConfigWatcher.from_config(config, on_change, path=config_file.name)
+    watcher.start()
+    time.sleep(0.2)
+
+    stop = threading.Event()
+    submits = []
+    publisher = threading.Thread(target=publish, args=(pipeline, args, stop, submits), daemon=True)
+    publisher.start()
+
+    results = []
+    try:
+        for name, phase_config in phases(config):
+            began = time.monotonic()
+            dropped = pipeline.stats()['messages_dropped']
+            if phase_config is not None:
+                with open(config_file.name, 'w') as f:
+                    yaml.safe_dump(phase_config, f)
+            time.sleep(args.phase)
+            ended = time.monotonic()
+            reload = [(at - began, took, waited) for at, took, waited in applied if began <= at < ended]
+            results.append((name, began, ended, reload, pipeline.stats()['messages_dropped'] - dropped))
+    finally:
+        stop.set()
+        publisher.join()
+        watcher.stop()
+        pipeline.stop()
+        os.unlink(config_file.name)
+
+    print(f"{args.rate:.0f} msg/s over {args.devices} devices, {'database' if args.db else 'null database'}, "
+          f"inotify {'yes' if watcher.inotify else 'no'}, {watcher.reloads} reloads, {watcher.errors} rejected")
+    print(f"{'phase':<26} {'applied after':>13} {'apply took':>10} {'workers waited':>14} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} "
+          f"{'max submit ms':>13} {'dropped':>7}")
+    for name, began, ended, reload, dropped in results:
+        window = [latency for at, latency in latencies if began <= at < ended]
+        slowest = max((took for at, took in submits if began <= at < ended), default=0.0)
+        after = f"{reload[0][0] * 1000:.0f} ms" if reload else '-'
+        took = f"{reload[0][1] * 1000:.0f} ms" if reload else '-'
+        waited = f"{reload[0][2] * 1000:.0f} ms" if reload and reload[0][2] else '-'
+        print(f"{name:<26} {after:>13} {took:>10} {waited:>14} {statistics.median(window) * 1000 if window else 0:8.1f} "
+              f"{percentile(window, 0.99) * 1000:8.1f} {max(window, default=0) * 1000:8.1f} "
+              f"{slowest * 1000:13.1f} {dropped:>7}")
+    stats = pipeline.stats()
+    print(f"messages enqueued {stats['messages_enqueued']}, committed {len(latencies)}, "
+          f"dropped {stats['messages_dropped']}, rows written {stats['rows_written']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""Measure the per-batch cost of the alert rules (src/rules.py).
+
+Feeds batches of narrow rows from a simulated fleet through a RuleEngine,
+the way each writer's flush does, after enough warm-up batches for every
+series to have state and the z-score rule to be active. Prints the time
+to evaluate one batch and the row rate one writer thread could sustain:
+
+    python3 bench/bench_rules.py --devices 10000 --batch-sizes 100,500,5000
+"""
+import argparse
+import datetime
+import gc
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+from rules import RuleEngine  # noqa: E402
+
+# Same as the alerts section of configmap.yaml
+THRESHOLDS = {
+    'temperature': {'min': -20, 'max': 60, 'max_rate_per_minute': 5, 'zscore': 6},
+    'humidity': {'min': 0, 'max': 100, 'max_rate_per_minute': 20, 'zscore': 6},
+    'pressure': {'min': 870, 'max': 1085, 'max_rate_per_minute': 3, 'zscore': 6},
+}
+BASELINES = {'temperature': (21.0, 0.3), 'humidity': (45.0, 1.0), 'pressure': (1013.0, 0.2)}
+
+
+class Fleet:
+    """Messages of three rows, every device reporting once per ``interval``
+    seconds (in a fixed shuffled order), with a few spikes"""
+
+    def __init__(self, devices, interval, spike_rate, seed):
+        self.rng = np.random.default_rng(seed)
+        self.devices = [f"sensor{i:05d}" for i in range(devices)]
+        self.interval = interval
+        self.spike_rate = spike_rate
+        self.clock = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc).timestamp()
+        self.step = interval / devices
+        self.order = self.rng.permutation(devices)
+        self.next = 0
+
+    def batch(self, rows):
+        messages = rows // 3
+        picks = self.order[(self.next + np.arange(messages)) % len(self.order)]
+        self.next += messages
+        noise = self.rng.standard_normal((messages, 3))
+        spikes = self.rng.random(messages) < self.spike_rate
+        batch = []
+        for i in range(messages):
+            self.clock += self.step
+            timestamp = datetime.datetime.fromtimestamp(self.clock, tz=datetime.timezone.utc)
+            device_id = self.devices[picks[i]]
+            for column, (sensor_type, (mean, std)) in enumerate(BASELINES.items()):
+                value = mean + std * noise[i, column]
+                if spikes[i]:
+                    value += 40 * std
+                batch.append((timestamp, device_id, sensor_type, float(value), 'default'))
+        return batch
+
+
+def run(args, batch_size):
+    fleet = Fleet(args.devices, args.interval, args.spike_rate, args.seed)
+    engine = RuleEngine(THRESHOLDS, cooldown=args.cooldown)
+
+    # Every device has reported enough times for its series to be warm
+    warmup_rows = args.devices * 3 * (engine.warmup + 1)
+    for _ in range(0, warmup_rows, 30000):
+        engine.add_rows(fleet.batch(30000))
+        engine.take()
+    raised = engine.raised
+
+    batches = [fleet.batch(batch_size) for _ in range(args.batches)]
+    # The pending batches are lots of tuples, keep collections of them out of the timings
+    gc.collect()
+    gc.freeze()
+    timings = []
+    for batch in batches:
+        start = time.perf_counter()
+        engine.add_rows(batch)
+        engine.take()
+        timings.append(time.perf_counter() - start)
+    gc.unfreeze()
+
+    timings.sort()
+    rows = sum(len(batch) for batch in batches)
+    total = sum(timings)
+    state = sum(column.nbytes for column in (engine._last_value, engine._last_time, engine._mean,
+                                             engine._var, engine._count, engine._last_alert))
+    print(f"batch {batch_size:>5} rows: p50 {statistics.median(timings) * 1e6:>8.0f} us   "
+          f"p99 {timings[int(len(timings) * 0.99) - 1] * 1e6:>8.0f} us   "
+          f"{total / rows * 1e6:.2f} us/row   {rows / total:>9.0f} rows/s   "
+          f"alerts {engine.raised - raised}")
+    return engine, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=10000)
+    parser.add_argument('--batch-sizes', default='100,500,5000')
+    parser.add_argument('--batches', type=int, default=200)
+    parser.add_argument('--interval', type=float, default=30.0, help="Seconds between reports of one device")
+    parser.add_argument('--spike-rate', type=float, default=0.001, help="Fraction of messages with a spike")
+    parser.add_argument('--cooldown', type=float, default=300.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{args.devices} devices, {len(THRESHOLDS)} sensor types, {args.batches} batches per size")
+    for batch_size in (int(size) for size in args.batch_sizes.split(',')):
+        engine, state = run(args, batch_size)
+    series = len(engine._series)
+    print(f"rule state: {series} series, {state / 1024:.0f} KiB of arrays ({state / series:.0f} bytes/series "
+          f"with the arrays' spare capacity)")
+
+
+if __name__ == "__main__":
+    main()
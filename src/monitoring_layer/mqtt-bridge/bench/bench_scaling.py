@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""Scaling test: N bridge replicas on one MQTT v5 shared subscription.
+
+Each replica is a separate process running MQTTSubscriber + IngestPipeline
+(with a null database, so the bridge's own CPU is what is measured),
+subscribed as $share/bench/sensors/+/data. Publisher processes send
+--messages readings spread over --devices devices, each device from a
+single publisher with an increasing sequence number. The test reports
+throughput per replica count and checks that every replica wrote each
+device's readings in sequence order.
+
+Needs a broker with shared subscription support, e.g. mosquitto 2.x:
+
+    mosquitto -p 1883 &
+    python3 bench/bench_scaling.py --broker localhost:1883 --replicas 1,2,4 --messages 200000
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'src'))
+sys.path.insert(0, BENCH_DIR)
+
+from bench_pipeline import NullConnection  # noqa: E402
+from pipeline import IngestPipeline  # noqa: E402
+from subscriber import MQTTSubscriber  # noqa: E402
+
+ROWS_PER_MESSAGE = 3
+
+
+class OrderTracker:
+    """on_flush callback checking per-device order; the sequence number
+    travels in altitude_m, which the bridge stores as a normal value"""
+
+    def __init__(self, written):
+        self.written = written
+        self.last_seq = {}
+        self.devices = set()
+        self.out_of_order = 0
+
+    def __call__(self, rows):
+        for _, device_id, sensor_type, value, _ in rows:
+            if sensor_type != 'altitude':
+                continue
+            self.devices.add(device_id)
+            if value < self.last_seq.get(device_id, -1):
+                self.out_of_order += 1
+            self.last_seq[device_id] = value
+        with self.written.get_lock():
+            self.written.value += len(rows)
+
+
+def broker_config(args, client_id):
+    host, _, port = args.broker.partition(':')
+    return {
+        'bridge': {
+            'client_id': client_id,
+            'topics': ['sensors/+/data'],
+            'shared_subscription_group': 'bench',
+            'qos': 1,
+            'broker': {'host': host, 'port': int(port or 1883), 'tls': False},
+        },
+    }
+
+
+def replica(index, args, written, ready, stop, results):
+    logging.basicConfig(level=logging.WARNING)
+    tracker = OrderTracker(written)
+    pipeline = IngestPipeline(NullConnection, queue_size=20000, workers=args.workers, batch_size=500,
+                              flush_interval=0.2, on_flush=tracker)
+    pipeline.start()
+    subscriber = MQTTSubscriber(broker_config(args, f"bench-replica-{index}"), pipeline.submit)
+    subscriber.start()
+    time.sleep(1)  # let the subscription land before publishers start
+    ready.release()
+
+    stop.wait()
+    subscriber.stop()
+    pipeline.stop()
+    stats = pipeline.stats()
+    results.put({
+        'replica': index,
+        'messages': stats['messages_received'],
+        'devices': len(tracker.devices),
+        'out_of_order': tracker.out_of_order,
+    })
+
+
+def publisher(index, args, count):
+    from paho.mqtt import client as mqtt_client
+
+    host, _, port = args.broker.partition(':')
+    client = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2, client_id=f"bench-publisher-{index}",
+                                protocol=mqtt_client.MQTTv5)
+    client.max_queued_messages_set(0)
+    client.max_inflight_messages_set(1000)
+    client.connect(host, int(port or 1883))
+    client.loop_start()
+
+    # Devices are partitioned between publishers so each device has one ordered sender
+    devices = [d for d in range(args.devices) if d % args.publishers == index]
+    info = None
+    for seq in range(count):
+        device = devices[seq % len(devices)]
+        payload = json.dumps({
+            'timestamp': time.time(),
+            'sensor_data': {'temperature_c': 21.5, 'pressure_hpa': 1001.2, 'altitude_m': seq // len(devices)},
+        })
+        info = client.publish(f"sensors/pi{device:05d}/data", payload, qos=1)
+    if info is not None:
+        info.wait_for_publish()
+    client.loop_stop()
+    client.disconnect()
+
+
+def run(args, replicas):
+    ctx = multiprocessing.get_context('spawn')
+    written = ctx.Value('q', 0)
+    ready = ctx.Semaphore(0)
+    stop = ctx.Event()
+    results = ctx.Queue()
+
+    procs = [ctx.Process(target=replica, args=(i, args, written, ready, stop, results)) for i in range(replicas)]
+    for p in procs:
+        p.start()
+    for _ in procs:
+        ready.acquire()
+
+    per_publisher = args.messages // args.publishers
+    expected = per_publisher * args.publishers * ROWS_PER_MESSAGE
+    start = time.perf_counter()
+    pubs = [ctx.Process(target=publisher, args=(i, args, per_publisher)) for i in range(args.publishers)]
+    for p in pubs:
+        p.start()
+
+    # Wait for all rows, or for progress to stall (lost messages)
+    last, last_change = -1, time.perf_counter()
+    while written.value < expected and time.perf_counter() - last_change < 5:
+        if written.value != last:
+            last, last_change = written.value, time.perf_counter()
+        time.sleep(0.05)
+    elapsed = (last_change if written.value < expected else time.perf_counter()) - start
+
+    for p in pubs:
+        p.join()
+    stop.set()
+    replica_stats = sorted((results.get() for _ in procs), key=lambda r: r['replica'])
+    for p in procs:
+        p.join()
+    return written.value // ROWS_PER_MESSAGE, elapsed, replica_stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--broker', default='localhost:1883')
+    parser.add_argument('--replicas', default='1,2,4')
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--publishers', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=2, help="DB writer workers per replica")
+    args = parser.parse_args()
+
+    print(f"{'replicas':>8} {'messages':>10} {'msg/sec':>10} {'speedup':>8} {'out of order':>13}  per replica")
+    baseline = None
+    for replicas in (int(r) for r in args.replicas.split(',')):
+        delivered, elapsed, stats = run(args, replicas)
+        rate = delivered / elapsed if elapsed > 0 else 0.0
+        baseline = baseline or rate
+        out_of_order = sum(s['out_of_order'] for s in stats)
+        split = ' '.join(str(s['messages']) for s in stats)
+        print(f"{replicas:>8} {delivered:>10} {rate:>10.0f} {rate / baseline:>7.2f}x {out_of_order:>13}  {split}")
+
+
+if __name__ == '__main__':
+    main()
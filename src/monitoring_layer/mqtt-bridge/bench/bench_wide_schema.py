@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""Measure storage size and dashboard query speed of the narrow and wide layouts.
+
+Run before migrating to record the narrow baseline, and again after
+src/migrate_wide.py (which keeps the old table as sensor_data_narrow) to
+compare it with sensor_readings and the sensor_data compatibility view:
+
+    DB_HOST=localhost DB_PASSWORD=timescaledbpassword python3 bench/bench_wide_schema.py
+"""
+import argparse
+import os
+import statistics
+import time
+
+import psycopg2
+
+# Typical Grafana panels: a bucketed series for one device and a fleet-wide summary
+NARROW_QUERIES = {
+    'device series 1d': """
+        SELECT time_bucket('15 minutes', time) AS bucket, avg(value)
+        FROM {table}
+        WHERE device_id = %(device)s AND sensor_type = 'temperature' AND time > now() - interval '1 day'
+        GROUP BY bucket ORDER BY bucket""",
+    'fleet summary 1d': """
+        SELECT device_id, sensor_type, avg(value), min(value), max(value)
+        FROM {table}
+        WHERE time > now() - interval '1 day'
+        GROUP BY device_id, sensor_type""",
+}
+
+WIDE_QUERIES = {
+    'device series 1d': """
+        SELECT time_bucket('15 minutes', r.time) AS bucket, avg(r.temperature)
+        FROM sensor_readings r JOIN devices d ON d.device_key = r.device_key
+        WHERE d.device_id = %(device)s AND r.time > now() - interval '1 day'
+        GROUP BY bucket ORDER BY bucket""",
+    'fleet summary 1d': """
+        SELECT d.device_id, avg(r.temperature), min(r.temperature), max(r.temperature),
+               avg(r.humidity), min(r.humidity), max(r.humidity),
+               avg(r.pressure), min(r.pressure), max(r.pressure)
+        FROM sensor_readings r JOIN devices d ON d.device_key = r.device_key
+        WHERE r.time > now() - interval '1 day'
+        GROUP BY d.device_id""",
+}
+
+
+def relation_kind(cur, name):
+    cur.execute("SELECT relkind FROM pg_class WHERE relname = %s", (name,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def storage(cur, table):
+    cur.execute("SELECT hypertable_size(%s::regclass), (SELECT count(*) FROM " + table + ")", (table,))
+    return cur.fetchone()
+
+
+def time_query(cur, sql, params, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        cur.execute(sql, params)
+        cur.fetchall()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(
+        host=os.environ.get('DB_HOST', 'localhost'),
+        port=int(os.environ.get('DB_PORT', 5432)),
+        dbname=os.environ.get('DB_NAME', 'sensor_data'),
+        user=os.environ.get('DB_USER', 'postgres'),
+        password=os.environ.get('DB_PASSWORD', 'postgres'),
+    )
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    narrow_table = 'sensor_data' if relation_kind(cur, 'sensor_data') == 'r' else 'sensor_data_narrow'
+    has_wide = relation_kind(cur, 'sensor_readings') == 'r'
+    has_view = relation_kind(cur, 'sensor_data') == 'v'
+
+    cur.execute(f"SELECT device_id FROM {narrow_table} LIMIT 1")
+    row = cur.fetchone()
+    params = {'device': row[0] if row else 'sensor001'}
+
+    print("Storage")
+    size, rows = storage(cur, narrow_table)
+    print(f"  {narrow_table:<22} {size / 1024 / 1024:>10.1f} MB {rows:>12} rows")
+    if has_wide:
+        size, rows = storage(cur, 'sensor_readings')
+        cur.execute("SELECT pg_total_relation_size('devices')")
+        size += cur.fetchone()[0]
+        print(f"  {'sensor_readings+devices':<22} {size / 1024 / 1024:>10.1f} MB {rows:>12} rows")
+
+    print(f"\nQuery median over {args.repeat} runs (ms)")
+    for name, sql in NARROW_QUERIES.items():
+        line = f"  {name:<18} narrow {time_query(cur, sql.format(table=narrow_table), params, args.repeat):>9.1f}"
+        if has_wide:
+            line += f"   wide {time_query(cur, WIDE_QUERIES[name], params, args.repeat):>9.1f}"
+        if has_view:
+            line += f"   compat view {time_query(cur, sql.format(table='sensor_data'), params, args.repeat):>9.1f}"
+        print(line)
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,483 @@
+import asyncio
+import logging
+import os
+import ssl
+import time
+
+import aiomqtt
+import asyncpg
+
+import metrics
+from batch_writer import SENSOR_DATA_COLUMNS
+from config_file import ConfigWatcher, reload_plan, set_log_level
+from decoder import DecodeError, decode_payload
+from dedup import Deduplicator
+from geo import GeoCache
+from latest import LatestNotifier
+from rollup import RollupWindows
+from rules import RuleEngine
+from subscriber import broker_settings, subscription_topics
+from wide_schema import WIDE_COLUMNS, device_registry, pivot_rows, wide_row
+
+logger = logging.getLogger('mqtt-bridge')
+
+_COLUMN_LIST = ', '.join(SENSOR_DATA_COLUMNS)
+STAGING_SQL = ("CREATE TEMP TABLE IF NOT EXISTS sensor_data_staging "
+               "(LIKE sensor_data INCLUDING DEFAULTS) ON COMMIT DELETE ROWS")
+MERGE_SQL = (f"INSERT INTO sensor_data ({_COLUMN_LIST}) "
+             f"SELECT {_COLUMN_LIST} FROM sensor_data_staging ON CONFLICT DO NOTHING")
+# Errors a batch can outlive by waiting: lost connections, a server shutting
+# down or restarting, running out of connections or resources, deadlocks and
+# serialization failures. Anything else fails the same way on retry
+TRANSIENT_ERRORS = (OSError, asyncpg.ConnectionDoesNotExistError, asyncpg.InterfaceError,
+                    asyncpg.CannotConnectNowError, asyncpg.PostgresConnectionError,
+                    asyncpg.OperatorInterventionError, asyncpg.InsufficientResourcesError,
+                    asyncpg.TransactionRollbackError)
+
+
+class AsyncBridge:
+    """Asyncio bridge engine: aiomqtt subscriber feeding an asyncpg pool.
+
+    Decoded rows go onto a bounded asyncio.Queue. A single batcher task cuts
+    batches by size or time and hands each one to its own flush task, so up
+    to ``max_inflight`` COPYs run concurrently on the pool without needing a
+    thread per connection. When all flush slots are busy the batcher stops
+    draining the queue, the queue fills, and the MQTT reader waits on it,
+    which pushes back on the broker.
+
+    Duplicate deliveries are dropped by the same Deduplicator as the
+    threaded pipeline, and with ``database.batch.deduplicate`` narrow
+    batches are COPYed into a per-connection staging table and merged with
+    ON CONFLICT DO NOTHING. The PostGIS geo cache and sink keep their own
+    threads and connections; lookups from the event loop are plain
+    dictionary reads and the sink's drop policy never blocks the loop.
+    Rollup windows, alert rules and latest-value notifications (the writer
+    stages of the threaded pipeline) get rows on the event loop as they are
+    queued, and a separate task writes closed windows, new alerts and
+    notifications every flush interval and publishes the alerts on the MQTT
+    connection.
+
+    A reloaded config (``apply_config``) changes the batch size, flush
+    interval, queue policy and topics on the running loop; everything else,
+    including the worker and stage settings the threaded pipeline rebuilds
+    for, needs a restart with this engine.
+    """
+
+    def __init__(self, config, on_flush=None):
+        bridge_config = config.get('bridge', {})
+        db_config = config.get('database', {})
+        queue_config = bridge_config.get('queue', {})
+        batch_config = db_config.get('batch', {})
+        pool_config = db_config.get('pool', {})
+
+        self.config = config
+        self.on_flush = on_flush
+        self.client_id = broker_settings(config)['client_id']
+        self.topics = subscription_topics(config)
+        self.qos = bridge_config.get('qos', 1)
+        self.stats_interval = bridge_config.get('stats_interval_seconds', 30)
+        self.queue_size = queue_config.get('max_size', 10000)
+        self.policy = queue_config.get('policy', 'block')
+        self.block_timeout = queue_config.get('block_timeout_seconds', 0.5)
+        self.batch_size = batch_config.get('size', 500)
+        self.flush_interval = batch_config.get('flush_interval_seconds', 1.0)
+        self.pool_min_size = pool_config.get('min_size', 2)
+        self.pool_max_size = pool_config.get('max_size', 10)
+        self.max_inflight = pool_config.get('max_inflight_batches', self.pool_max_size)
+        self.retry_delay = pool_config.get('retry_delay_seconds', 5.0)
+        self.layout = db_config.get('layout', 'narrow')
+        self.dedup = Deduplicator.from_config(config)
+        self.geo = GeoCache.from_config(config)
+        self.rollup = RollupWindows.from_config(config)
+        self.rules = RuleEngine.from_config(config)
+        self.latest = LatestNotifier.from_config(config)
+        self.stages = [stage for stage in (self.rollup, self.rules, self.latest) if stage is not None]
+        # The wide layout has no unique key to conflict on
+        self.deduplicate = batch_config.get('deduplicate', True) and self.layout != 'wide'
+
+        self.pool = None
+        self.queue = None
+        self._inflight = None
+        self._flush_tasks = set()
+        self._stopping = None
+        self._loop = None
+        self._client = None
+        self._resubscribe = None
+
+        self.messages_received = 0
+        self.messages_enqueued = 0
+        self.messages_dropped = 0
+        self.decode_errors = 0
+        self.backpressure_waits = 0
+        self.max_queue_depth = 0
+        self.flush_count = 0
+        self.flush_errors = 0
+        self.rows_written = 0
+        self.rows_duplicate = 0
+        self.rows_dropped = 0
+        self.total_flush_seconds = 0.0
+        self.max_inflight_seen = 0
+
+    async def create_pool(self):
+        db_config = self.config.get('database', {})
+        return await asyncpg.create_pool(
+            host=db_config.get('host', 'timescaledb'),
+            port=db_config.get('port', 5432),
+            database=db_config.get('name', 'sensor_data'),
+            user=os.environ.get('DB_USER', 'postgres'),
+            password=os.environ.get('DB_PASSWORD', 'postgres'),
+            min_size=self.pool_min_size,
+            max_size=self.pool_max_size,
+            init=self._init_connection if self.deduplicate else None,
+        )
+
+    async def _init_connection(self, conn):
+        await conn.execute(STAGING_SQL)
+
+    def _tls_context(self, settings):
+        if not settings['tls']:
+            return None
+        context = ssl.create_default_context(cafile=settings['ca_certs'])
+        context.load_cert_chain(settings['certfile'], settings['keyfile'])
+        return context
+
+    async def run(self):
+        """Run until stop() is called"""
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self._inflight = asyncio.Semaphore(self.max_inflight)
+        self.pool = await self.create_pool()
+        logger.info(f"asyncpg pool ready ({self.pool_min_size}-{self.pool_max_size} connections, "
+                    f"{self.max_inflight} in-flight batches)")
+        if self.geo is not None:
+            self.geo.sink.start()
+            self.geo.start()
+
+        batcher = asyncio.create_task(self._batcher())
+        reader = asyncio.create_task(self._mqtt_loop())
+        reporter = asyncio.create_task(self._report_stats())
+        stages = asyncio.create_task(self._stage_loop()) if self.stages else None
+        try:
+            await self._stopping.wait()
+        finally:
+            # Stop reading, then let the batcher flush what is already queued
+            reader.cancel()
+            reporter.cancel()
+            await asyncio.gather(reader, reporter, return_exceptions=True)
+            self._client = None
+            await self.queue.put(None)
+            await batcher
+            if self._flush_tasks:
+                await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+            if stages is not None:
+                stages.cancel()
+                await asyncio.gather(stages, return_exceptions=True)
+                for stage in self.stages:
+                    await self._write_stage(stage, close_all=True)
+            await self.pool.close()
+            if self.geo is not None:
+                self.geo.stop()
+                self.geo.sink.stop()
+            self.log_stats()
+
+    def stop(self):
+        """Request shutdown, safe to call from any thread"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+    def apply_config(self, old, new):
+        """ConfigWatcher callback, safe to call from any thread"""
+        plan = reload_plan(old, new)
+        restart = plan['rebuild'] + plan['restart']
+        if restart:
+            logger.warning(f"Config changed, restart the bridge to apply: {', '.join(restart)}")
+        if plan['live'] and self._loop is not None:
+            logger.info(f"Applying changed config: {', '.join(plan['live'])}")
+            self._loop.call_soon_threadsafe(self.reconfigure, new)
+
+    def reconfigure(self, config):
+        """Apply the live settings of a reloaded config, on the event loop"""
+        bridge_config = config.get('bridge', {})
+        queue_config = bridge_config.get('queue', {})
+        batch_config = config.get('database', {}).get('batch', {})
+        set_log_level(config)
+        self.stats_interval = bridge_config.get('stats_interval_seconds', 30)
+        self.policy = queue_config.get('policy', 'block')
+        self.block_timeout = queue_config.get('block_timeout_seconds', 0.5)
+        self.batch_size = batch_config.get('size', 500)
+        self.flush_interval = batch_config.get('flush_interval_seconds', 1.0)
+
+        topics, qos = subscription_topics(config), bridge_config.get('qos', 1)
+        if (topics, qos) != (self.topics, self.qos):
+            removed = [topic for topic in self.topics if topic not in topics]
+            self.topics, self.qos = topics, qos
+            # A reconnect subscribes to the new topics anyway
+            if self._client is not None:
+                self._resubscribe = asyncio.create_task(self._subscribe(self._client, removed))
+
+    async def _subscribe(self, client, removed):
+        try:
+            for topic in removed:
+                await client.unsubscribe(topic)
+            for topic in self.topics:
+                await client.subscribe(topic, qos=self.qos)
+            logger.info(f"Subscribed to {', '.join(self.topics)}"
+                        + (f", unsubscribed from {', '.join(removed)}" if removed else ""))
+        except aiomqtt.MqttError as e:
+            logger.error(f"Error changing subscriptions: {e}")
+
+    async def _mqtt_loop(self):
+        settings = broker_settings(self.config)
+        tls_context = self._tls_context(settings)
+        while True:
+            try:
+                async with aiomqtt.Client(
+                    settings['host'],
+                    port=settings['port'],
+                    identifier=self.client_id,
+                    protocol=aiomqtt.ProtocolVersion.V5,
+                    tls_context=tls_context,
+                    keepalive=settings['keepalive'],
+                ) as client:
+                    for topic in self.topics:
+                        await client.subscribe(topic, qos=self.qos)
+                    self._client = client
+                    logger.info(f"Connected to MQTT broker {settings['host']}:{settings['port']}, "
+                                f"subscribed to {', '.join(self.topics)}")
+                    async for message in client.messages:
+                        await self.submit(str(message.topic), message.payload)
+            except aiomqtt.MqttError as e:
+                self._client = None
+                logger.warning(f"MQTT connection lost ({e}), reconnecting in {self.retry_delay}s")
+                await asyncio.sleep(self.retry_delay)
+
+    async def submit(self, topic, payload):
+        """Decode a message and queue its rows, returns False if it was dropped"""
+        self.messages_received += 1
+        start = time.perf_counter()
+        try:
+            rows = decode_payload(topic, payload, dedup=self.dedup, geo=self.geo)
+        except DecodeError as e:
+            self.decode_errors += 1
+            logger.debug(f"Dropping undecodable message: {e}")
+            return False
+        metrics.DECODE_SECONDS.observe(time.perf_counter() - start)
+        if not rows:
+            return True
+
+        try:
+            self.queue.put_nowait(rows)
+        except asyncio.QueueFull:
+            if self.policy == 'drop':
+                self._count_drop()
+                return False
+            self.backpressure_waits += 1
+            try:
+                await asyncio.wait_for(self.queue.put(rows), self.block_timeout)
+            except asyncio.TimeoutError:
+                self._count_drop()
+                return False
+
+        self.messages_enqueued += 1
+        for stage in self.stages:
+            stage.add_rows(rows)
+        depth = self.queue.qsize()
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+        return True
+
+    def _count_drop(self):
+        self.messages_dropped += 1
+        if self.messages_dropped == 1 or self.messages_dropped % 1000 == 0:
+            logger.warning(f"Ingest queue full, {self.messages_dropped} messages dropped so far")
+
+    async def _batcher(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            timeout = max(deadline - time.monotonic(), 0)
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                item = ()
+
+            if item is None:
+                if batch:
+                    await self._dispatch(batch)
+                return
+
+            batch.extend(item)
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                if batch:
+                    await self._dispatch(batch)
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+    async def _dispatch(self, rows):
+        # Waiting here for a free slot is what propagates backpressure
+        await self._inflight.acquire()
+        task = asyncio.create_task(self._flush(rows))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+        inflight = len(self._flush_tasks)
+        if inflight > self.max_inflight_seen:
+            self.max_inflight_seen = inflight
+
+    async def _flush(self, rows):
+        table = 'sensor_readings' if self.layout == 'wide' else 'sensor_data'
+        try:
+            while True:
+                start = time.perf_counter()
+                inserted = len(rows)
+                try:
+                    with metrics.span('flush', table=table, rows=len(rows)):
+                        async with self.pool.acquire() as conn:
+                            if self.layout == 'wide':
+                                records = await self._wide_records(conn, rows)
+                                await conn.copy_records_to_table(table, records=records, columns=WIDE_COLUMNS)
+                            elif self.deduplicate:
+                                async with conn.transaction():
+                                    await conn.copy_records_to_table('sensor_data_staging', records=rows,
+                                                                     columns=SENSOR_DATA_COLUMNS)
+                                    status = await conn.execute(MERGE_SQL)
+                                inserted = int(status.rsplit(' ', 1)[-1])  # "INSERT 0 <rows>"
+                            else:
+                                await conn.copy_records_to_table(table, records=rows, columns=SENSOR_DATA_COLUMNS)
+                    break
+                except TRANSIENT_ERRORS as e:
+                    self.flush_errors += 1
+                    logger.error(f"Error flushing {len(rows)} rows: {e}, retrying in {self.retry_delay}s")
+                    await asyncio.sleep(self.retry_delay)
+                except asyncpg.PostgresError as e:
+                    # Retrying would hold this flush slot forever
+                    self.flush_errors += 1
+                    self.rows_dropped += len(rows)
+                    logger.error(f"Error flushing {len(rows)} rows: {e}, dropping the batch")
+                    return
+
+            elapsed = time.perf_counter() - start
+            self.flush_count += 1
+            self.rows_written += inserted
+            self.rows_duplicate += len(rows) - inserted
+            self.total_flush_seconds += elapsed
+            metrics.FLUSH_SECONDS.labels(table=table).observe(elapsed)
+            metrics.BATCH_ROWS.labels(table=table).observe(len(rows))
+            logger.debug(f"Flushed {len(rows)} rows in {elapsed * 1000:.1f} ms")
+            if self.on_flush is not None:
+                self.on_flush(rows)
+        finally:
+            self._inflight.release()
+
+    async def _wide_records(self, conn, rows):
+        records = []
+        for (timestamp, device_id, location_id), values in pivot_rows(rows).items():
+            key = device_registry.get(device_id)
+            if key is None:
+                key = await conn.fetchval(
+                    "INSERT INTO devices (device_id) VALUES ($1) "
+                    "ON CONFLICT (device_id) DO UPDATE SET device_id = EXCLUDED.device_id "
+                    "RETURNING device_key", device_id)
+                device_registry.put(device_id, key)
+            records.append(wide_row(timestamp, key, values, location_id))
+        return records
+
+    async def _stage_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            for stage in self.stages:
+                await self._write_stage(stage)
+
+    async def _write_stage(self, stage, close_all=False):
+        rows = stage.take(close_all=close_all)
+        if not rows:
+            return
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.executemany(stage.row_sql, rows)
+        except asyncio.CancelledError:
+            stage.requeue(rows)
+            raise
+        except (asyncpg.PostgresError, OSError) as e:
+            self.flush_errors += 1
+            logger.error(f"Error writing {len(rows)} rows to {stage.table}: {e}")
+            stage.requeue(rows)
+            return
+        stage.committed(rows)
+        if stage is self.rules:
+            await self._publish_alerts(rows)
+
+    async def _publish_alerts(self, alerts):
+        if not self.rules.topic:
+            return
+        if self._client is None:
+            logger.warning(f"Not connected to MQTT, {len(alerts)} alerts only written to {self.rules.table}")
+            return
+        try:
+            for topic, payload in self.rules.messages(alerts):
+                await self._client.publish(topic, payload, qos=self.qos)
+        except aiomqtt.MqttError as e:
+            logger.error(f"Error publishing {len(alerts)} alerts: {e}")
+
+    async def _report_stats(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            self.log_stats()
+
+    def stats(self):
+        stats = {
+            'messages_received': self.messages_received,
+            'messages_enqueued': self.messages_enqueued,
+            'messages_dropped': self.messages_dropped,
+            'decode_errors': self.decode_errors,
+            'backpressure_waits': self.backpressure_waits,
+            'queue_depth': self.queue.qsize() if self.queue else 0,
+            'queue_capacity': self.queue_size,
+            'max_queue_depth': self.max_queue_depth,
+            'rows_written': self.rows_written,
+            'flushes': self.flush_count,
+            'flush_errors': self.flush_errors,
+            'inflight_batches': len(self._flush_tasks),
+            'max_inflight_batches': self.max_inflight_seen,
+            'avg_flush_ms': (self.total_flush_seconds / self.flush_count * 1000) if self.flush_count else 0.0,
+            'rows_duplicate': self.rows_duplicate,
+            'rows_dropped': self.rows_dropped,
+        }
+        if self.dedup is not None:
+            stats.update(self.dedup.stats())
+        if self.geo is not None:
+            stats.update(self.geo.stats())
+            stats['sinks'] = {'postgis': self.geo.sink.stats()}
+        for stage in self.stages:
+            stats.update(stage.stats())
+        return stats
+
+    def log_stats(self):
+        s = self.stats()
+        logger.info(f"Async pipeline: received={s['messages_received']} enqueued={s['messages_enqueued']} "
+                    f"dropped={s['messages_dropped']} decode_errors={s['decode_errors']} "
+                    f"queue={s['queue_depth']}/{s['queue_capacity']} (max {s['max_queue_depth']}) "
+                    f"inflight={s['inflight_batches']} (max {s['max_inflight_batches']}) "
+                    f"rows_written={s['rows_written']} rows_dropped={s['rows_dropped']} avg_flush={s['avg_flush_ms']:.1f}ms "
+                    f"duplicates={s.get('duplicates_dropped', 0)} (hit rate {s.get('dedup_hit_rate', 0.0):.2%}, "
+                    f"{s['rows_duplicate']} more rows ignored by the database)")
+
+
+def run(config):
+    """Entry point used by main() when bridge.engine is asyncio"""
+    bridge = AsyncBridge(config)
+    watcher = ConfigWatcher.from_config(config, bridge.apply_config)
+    metrics.setup_tracing(config)
+    if watcher is None:
+        metrics.serve(config, bridge.stats)
+    else:
+        metrics.serve(config, lambda: dict(bridge.stats(), **watcher.stats()))
+        watcher.start()
+    try:
+        asyncio.run(bridge.run())
+    except KeyboardInterrupt:
+        logger.info("Async engine stopped by user")
+    finally:
+        if watcher is not None:
+            watcher.stop()
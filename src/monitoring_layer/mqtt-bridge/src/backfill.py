@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+"""Load the Pis' local archives into sensor_data.
+
+Every Pi keeps its readings on the SD card whether or not they reached the
+broker: daily_YYYY-MM-DD.ndjson and events_YYYY-MM-DD.ndjson (gzip or zstd
+compressed once the day is over), the daily_YYYY-MM-DD.json arrays and
+event_<epoch>.json files older clients wrote, and main_app's sensor_log.txt.
+Copy them off the Pis, one directory per device, and replay them:
+
+    DB_HOST=localhost python3 src/backfill.py archives/ --jobs 8
+    python3 src/backfill.py archives/pi-01 --device-id pi-01 --dry-run
+
+Files are parsed by ``--jobs`` processes, JSON arrays incrementally so a
+large file is never read into memory whole. Each process loads its rows
+through its own connection with the bridge's BatchWriter: COPY into a
+staging table and INSERT ... ON CONFLICT DO NOTHING, so rows the bridge
+already wrote, or that an interrupted run loaded, are skipped. Every file
+is recorded in ``--checkpoint`` with its size and mtime once its rows are
+committed and a rerun only loads new or changed files.
+
+Rows are stamped with ``--device-id``, or else with the name of the
+directory the file is in (its parent when that is sensor_data, so both
+archives/pi-01/sensor_log.txt and archives/pi-01/sensor_data/*.json are
+pi-01). Connection settings come from DB_HOST, DB_PORT, DB_NAME, DB_USER
+and DB_PASSWORD.
+"""
+import argparse
+import ast
+import collections
+import concurrent.futures
+import datetime
+import gzip
+import io
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+import psycopg2
+
+from decoder import DecodeError, event_rows
+from wide_schema import writer_class
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s'
+)
+logger = logging.getLogger('mqtt-bridge')
+
+NDJSON_NAME = re.compile(r'(daily|events)_.*\.ndjson(\.gz|\.zst)?$')
+JSON_NAME = re.compile(r'(daily|event)_.*\.json$')
+LOG_NAME = re.compile(r'sensor_log.*\.txt$')
+
+# "2025-03-15 01:13:04,040 - INFO - Temperature reading: {'temperature_c': 16.0, ...}"
+LOG_READING = re.compile(r'(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d+) - \w+ - '
+                         r'(?:Motion triggered temperature|Temperature) reading: (\{.*\})\s*$')
+
+# Whitespace and the commas between array elements
+_SEPARATORS = re.compile(r'[\s,]*')
+
+# Continuous aggregates on sensor_data only refresh recent data on their own
+REFRESH_SQL = "CALL refresh_continuous_aggregate(%s, %s, %s)"
+AGGREGATES_SQL = """
+SELECT view_name FROM timescaledb_information.continuous_aggregates
+WHERE hypertable_name = 'sensor_data' ORDER BY view_name
+"""
+
+
+def file_format(path):
+    """'ndjson', 'json' or 'log' from an archive file name, or None"""
+    name = os.path.basename(path)
+    if NDJSON_NAME.match(name):
+        return 'ndjson'
+    if JSON_NAME.match(name):
+        return 'json'
+    if LOG_NAME.match(name):
+        return 'log'
+    return None
+
+
+def device_for(path, device_id=None):
+    """``device_id``, or the name of the device directory ``path`` is in"""
+    if device_id:
+        return device_id
+    directory = os.path.dirname(os.path.abspath(path))
+    if os.path.basename(directory) == 'sensor_data':
+        directory = os.path.dirname(directory)
+    return os.path.basename(directory)
+
+
+def discover(inputs):
+    """Archive files under ``inputs`` (files or directories), in name order"""
+    for name in inputs:
+        if os.path.isfile(name):
+            yield name
+            continue
+        for directory, subdirectories, files in os.walk(name):
+            subdirectories.sort()
+            for filename in sorted(files):
+                if file_format(filename) is not None:
+                    yield os.path.join(directory, filename)
+
+
+def _open_text(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    if path.endswith('.zst'):
+        import zstandard
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')))
+    return open(path, 'r')
+
+
+def iter_json(f, chunk_size=1024 * 1024):
+    """Yield the elements of a JSON array, or a single JSON value, reading ``f`` a chunk at a time"""
+    decoder = json.JSONDecoder()
+    buf, pos, eof, in_array = '', 0, False, None
+    while True:
+        pos = _SEPARATORS.match(buf, pos).end()
+        if pos < len(buf):
+            if in_array is None:
+                in_array = buf[pos] == '['
+                pos += in_array
+                continue
+            if in_array and buf[pos] == ']':
+                return
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                end = None
+            # A value ending right at the end of the buffer may be cut short, e.g. a number
+            if end is not None and (end < len(buf) or eof):
+                yield value
+                if not in_array:
+                    return
+                pos = end
+                continue
+            if eof:
+                raise ValueError(f"Invalid or truncated JSON after {len(buf) - pos} characters from the end")
+        elif eof:
+            if in_array:
+                raise ValueError("Unterminated JSON array")
+            return
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buf, pos = buf[pos:] + chunk, 0
+
+
+def read_records(path, counts):
+    """Stream the event dicts of one archive file"""
+    kind = file_format(path) or ('log' if path.endswith('.txt') else 'ndjson')
+    with _open_text(path) as f:
+        if kind == 'json':
+            try:
+                for record in iter_json(f):
+                    yield record
+            except ValueError as e:
+                # Older clients rewrote the whole file on every reading, a power
+                # cut can leave it cut off; keep what was complete
+                counts['corrupt'] += 1
+                logger.warning(f"{path}: {e}, loaded the records before it")
+        elif kind == 'log':
+            for line in f:
+                if 'reading: {' not in line:
+                    continue
+                match = LOG_READING.match(line)
+                if match is None:
+                    continue
+                try:
+                    values = ast.literal_eval(match.group(3))
+                except (ValueError, SyntaxError):
+                    counts['corrupt'] += 1
+                    continue
+                yield {'timestamp': f"{match.group(1)}.{match.group(2)}", 'sensor_data': values}
+        else:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # A truncated last line after a power cut
+                    counts['corrupt'] += 1
+
+
+def iter_rows(path, device_id, counts):
+    """Yield the sensor_data rows of each record in one archive file"""
+    for record in read_records(path, counts):
+        if not isinstance(record, dict):
+            counts['corrupt'] += 1
+            continue
+        # A reading without a timestamp cannot be placed, the live decoder would use now()
+        if not record.get('timestamp'):
+            counts['no_timestamp'] += 1
+            continue
+        try:
+            rows = event_rows(device_id, record)
+        except DecodeError:
+            counts['corrupt'] += 1
+            continue
+        counts['records'] += 1
+        if rows:
+            yield rows
+
+
+class Checkpoint:
+    """Files already loaded, one JSON line appended per file.
+
+    A file counts as loaded only while its size and mtime match, so a log
+    that has grown since is loaded again; the rows already in the database
+    are skipped by the ON CONFLICT DO NOTHING insert.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.loaded = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.loaded[entry['path']] = (entry['size'], entry['mtime_ns'])
+                    except (ValueError, KeyError):
+                        continue  # cut off by a crash while writing
+
+    def is_loaded(self, path, stat):
+        return self.loaded.get(path) == (stat.st_size, stat.st_mtime_ns)
+
+    def record(self, path, stat, rows):
+        self.loaded[path] = (stat.st_size, stat.st_mtime_ns)
+        if not self.path:
+            return
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                                'rows': rows}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def plan_tasks(files, task_bytes):
+    """Group files into pool tasks of about ``task_bytes``, so the many small
+    event_<epoch>.json files do not cost a task and a commit each"""
+    tasks, task, size = [], [], 0
+    for entry in files:
+        task.append(entry)
+        size += entry[2].st_size
+        if size >= task_bytes:
+            tasks.append(task)
+            task, size = [], 0
+    if task:
+        tasks.append(task)
+    return tasks
+
+
+def connect():
+    return psycopg2.connect(
+        host=os.environ.get('DB_HOST', 'timescaledb'),
+        port=int(os.environ.get('DB_PORT', 5432)),
+        dbname=os.environ.get('DB_NAME', 'sensor_data'),
+        user=os.environ.get('DB_USER', 'postgres'),
+        password=os.environ.get('DB_PASSWORD', 'postgres'),
+    )
+
+
+# State of each pool process
+_options = None
+_writer = None
+
+
+def _init_worker(options):
+    global _options
+    _options = options
+
+
+def _get_writer():
+    global _writer
+    if _writer is None:
+        config = {'database': {'layout': _options['layout']}}
+        _writer = writer_class(config)(connect(), batch_size=_options['batch_size'], method='copy',
+                                       deduplicate=True, max_pending=_options['batch_size'] * 4)
+    return _writer
+
+
+def _drop_writer():
+    global _writer
+    if _writer is not None:
+        try:
+            _writer.conn.close()
+        except Exception:
+            pass
+    _writer = None
+
+
+def load_task(task):
+    """Parse and load one task's files in a pool process.
+
+    Returns (path, rows, counts) per file plus the rows inserted and the
+    time range covered, after everything is committed.
+    """
+    writer = None if _options['dry_run'] else _get_writer()
+    before = (writer.rows_written, writer.rows_duplicate) if writer is not None else (0, 0)
+    batch_size = _options['batch_size']
+    results = []
+    first = last = None
+    pending = []
+    try:
+        for path, device_id, _ in task:
+            counts = collections.Counter()
+            rows = 0
+            for record_rows in iter_rows(path, device_id, counts):
+                rows += len(record_rows)
+                timestamp = record_rows[0][0]
+                if first is None or timestamp < first:
+                    first = timestamp
+                if last is None or timestamp > last:
+                    last = timestamp
+                if writer is not None:
+                    pending.extend(record_rows)
+                    if len(pending) >= batch_size:
+                        writer.add_rows(pending)
+                        pending = []
+            results.append((path, rows, dict(counts)))
+        if writer is not None:
+            writer.add_rows(pending)
+            writer.flush()
+    except Exception:
+        # The connection may be mid-transaction and the buffer holds rows of
+        # files that will not be checkpointed, start over on the next task
+        _drop_writer()
+        raise
+
+    inserted, duplicates = 0, 0
+    if writer is not None:
+        inserted = writer.rows_written - before[0]
+        duplicates = writer.rows_duplicate - before[1]
+    return results, inserted, duplicates, first, last
+
+
+def refresh_aggregates(first, last):
+    """Refresh sensor_data's continuous aggregates over the loaded time range"""
+    conn = connect()
+    conn.autocommit = True  # refresh_continuous_aggregate cannot run in a transaction
+    try:
+        cur = conn.cursor()
+        cur.execute(AGGREGATES_SQL)
+        for (view,) in cur.fetchall():
+            start = time.perf_counter()
+            # Only buckets wholly inside the window are refreshed, widen it to whole days
+            cur.execute(REFRESH_SQL, (view, first - datetime.timedelta(days=1), last + datetime.timedelta(days=1)))
+            logger.info(f"Refreshed {view} from {first} to {last} in {time.perf_counter() - start:.1f}s")
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help="Archive files or directories to search")
+    parser.add_argument('--device-id', help="Device id for every row, instead of the directory name")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help="Parser/loader processes")
+    parser.add_argument('--batch-size', type=int, default=20000, help="Rows per COPY transaction")
+    parser.add_argument('--task-mb', type=float, default=16, help="Archive MB handed to a process at a time")
+    parser.add_argument('--checkpoint', default='backfill.checkpoint',
+                        help="File recording loaded files, '' to always load everything")
+    parser.add_argument('--layout', choices=('narrow', 'wide'), default='narrow',
+                        help="database.layout of the target database, wide cannot skip rows already loaded")
+    parser.add_argument('--refresh-aggregates', action='store_true',
+                        help="Refresh sensor_data's continuous aggregates over the loaded range afterwards")
+    parser.add_argument('--dry-run', action='store_true', help="Parse and count rows without a database")
+    args = parser.parse_args()
+
+    checkpoint = Checkpoint(None if args.dry_run else args.checkpoint)
+    files, skipped = [], 0
+    for path in discover(args.inputs):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        if checkpoint.is_loaded(path, stat):
+            skipped += 1
+            continue
+        files.append((path, device_for(path, args.device_id), stat))
+    total_bytes = sum(entry[2].st_size for entry in files)
+    logger.info(f"{len(files)} files ({total_bytes / 1024 / 1024:.1f} MB) to load, "
+                f"{skipped} already loaded according to {args.checkpoint}")
+    if not files:
+        return 0
+
+    tasks = plan_tasks(files, args.task_mb * 1024 * 1024)
+    stats = {entry[0]: entry[2] for entry in files}
+    options = {'batch_size': args.batch_size, 'layout': args.layout, 'dry_run': args.dry_run}
+    totals = collections.Counter()
+    first = last = None
+    failed = 0
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs, initializer=_init_worker,
+                                                initargs=(options,)) as pool:
+        futures = {pool.submit(load_task, task): task for task in tasks}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results, inserted, duplicates, task_first, task_last = future.result()
+            except Exception as e:
+                failed += len(futures[future])
+                logger.error(f"Failed to load {', '.join(entry[0] for entry in futures[future])}: {e}")
+                continue
+            for path, rows, counts in results:
+                checkpoint.record(path, stats[path], rows)
+                totals['files'] += 1
+                totals['rows'] += rows
+                totals.update(counts)
+            totals['inserted'] += inserted
+            totals['duplicates'] += duplicates
+            if task_first is not None:
+                first = task_first if first is None else min(first, task_first)
+                last = task_last if last is None else max(last, task_last)
+            elapsed = time.perf_counter() - start
+            logger.info(f"{totals['files']}/{len(files)} files, {totals['rows']} rows "
+                        f"({totals['rows'] / elapsed * 60 / 1e6:.2f}M rows/min)")
+
+    elapsed = time.perf_counter() - start
+    logger.info(f"Loaded {totals['files']} files in {elapsed:.1f}s: {totals['records']} records, "
+                f"{totals['rows']} rows ({totals['rows'] / elapsed * 60 / 1e6:.2f}M rows/min), "
+                f"{totals['inserted']} inserted, {totals['duplicates']} already in the database, "
+                f"{totals['corrupt']} corrupt and {totals['no_timestamp']} undated records skipped"
+                + (f", {failed} files failed" if failed else ""))
+    if args.refresh_aggregates and not args.dry_run and first is not None:
+        refresh_aggregates(first, last)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
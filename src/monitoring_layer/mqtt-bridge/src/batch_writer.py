@@ -0,0 +1,335 @@
+import csv
+import datetime
+import io
+import logging
+import threading
+import time
+
+import psycopg2
+from psycopg2 import extras
+
+import metrics
+from latest import LatestNotifier
+from rollup import RollupWindows
+from rules import RuleEngine
+
+logger = logging.getLogger('mqtt-bridge')
+
+# Column layout of the narrow sensor_data hypertable
+SENSOR_DATA_COLUMNS = ('time', 'device_id', 'sensor_type', 'value', 'location_id')
+
+# Errors the same batch hits again on every retry (bad values, a duplicate
+# the unique index rejects, a missing table): the batch is dropped instead
+PERMANENT_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError, psycopg2.ProgrammingError)
+
+
+def writer_stages(config, publish=None):
+    """The stages enabled in config for one writer: rollups, alert rules, then
+    latest-value notifications for the query API"""
+    stages = (RollupWindows.from_config(config), RuleEngine.from_config(config, publish=publish),
+              LatestNotifier.from_config(config))
+    return [stage for stage in stages if stage is not None]
+
+
+class BatchWriter:
+    """Buffers sensor_data rows and writes them in bulk.
+
+    Rows from any number of sensors are collected in memory and flushed in a
+    single transaction when the buffer reaches ``batch_size`` rows or when
+    ``flush_interval`` seconds have passed since the last flush, whichever
+    comes first. Flushes use ``COPY ... FROM STDIN`` by default, or
+    ``execute_values`` when ``method`` is ``"values"``. If given, ``on_flush``
+    is called with the list of rows after each successful commit.
+
+    With ``deduplicate`` rows that already exist are skipped with ON CONFLICT
+    DO NOTHING, relying on the table's unique index. COPY cannot do that, so
+    it loads a temporary staging table and inserts from there.
+
+    Every row is also handed to each of ``stages`` (RollupWindows,
+    RuleEngine, LatestNotifier), and whatever rows a stage has ready on
+    flush (closed rollup windows, new alerts, notifications) are written in the same transaction as the
+    raw rows.
+
+    A failed flush keeps its rows for the next one and raises, unless the
+    database rejected them (PERMANENT_ERRORS): then the raw rows are dropped
+    and counted in ``rows_dropped``, and the stage rows are tried once more
+    on their own.
+    """
+
+    def __init__(self, conn, batch_size=500, flush_interval=1.0, method='copy',
+                 table='sensor_data', columns=SENSOR_DATA_COLUMNS, max_pending=100000, on_flush=None,
+                 deduplicate=False, stages=()):
+        if method not in ('copy', 'values'):
+            raise ValueError(f"Unknown batch method: {method}")
+
+        self.conn = conn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.method = method
+        self.table = table
+        self.columns = tuple(columns)
+        self.max_pending = max_pending
+        self.on_flush = on_flush
+        self.deduplicate = deduplicate
+        self.stages = list(stages)
+
+        self._rows = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._staged_conn = None
+
+        # Flush statistics
+        self.flush_count = 0
+        self.rows_written = 0
+        self.rows_duplicate = 0
+        self.rows_dropped = 0
+        self.flush_errors = 0
+        self.total_flush_seconds = 0.0
+        self.last_flush_rows = 0
+        self.last_flush_seconds = 0.0
+
+        column_list = ', '.join(self.columns)
+        self._copy_sql = f"COPY {self.table} ({column_list}) FROM STDIN WITH (FORMAT csv)"
+        self._values_sql = f"INSERT INTO {self.table} ({column_list}) VALUES %s"
+        if deduplicate:
+            staging = f"{self.table.rsplit('.', 1)[-1]}_staging"
+            self._staging_sql = (f"CREATE TEMP TABLE IF NOT EXISTS {staging} "
+                                 f"(LIKE {self.table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS")
+            self._copy_sql = f"COPY {staging} ({column_list}) FROM STDIN WITH (FORMAT csv)"
+            self._merge_sql = (f"INSERT INTO {self.table} ({column_list}) "
+                               f"SELECT {column_list} FROM {staging} ON CONFLICT DO NOTHING")
+            self._values_sql += " ON CONFLICT DO NOTHING"
+
+    @classmethod
+    def from_config(cls, conn, config):
+        """Create a writer using the database.batch section of the bridge config"""
+        batch_config = config.get('database', {}).get('batch', {})
+        return cls(
+            conn,
+            batch_size=batch_config.get('size', 500),
+            flush_interval=batch_config.get('flush_interval_seconds', 1.0),
+            method=batch_config.get('method', 'copy'),
+            max_pending=batch_config.get('max_pending_rows', 100000),
+            deduplicate=batch_config.get('deduplicate', True),
+            stages=writer_stages(config),
+        )
+
+    def add_reading(self, sensor_id, temperature, humidity, pressure, timestamp=None, location_id='default'):
+        """Queue one reading as three narrow rows, mirroring insert_sensor_data"""
+        if timestamp is None:
+            timestamp = datetime.datetime.now()
+
+        self.add_rows([
+            (timestamp, sensor_id, 'temperature', temperature, location_id),
+            (timestamp, sensor_id, 'humidity', humidity, location_id),
+            (timestamp, sensor_id, 'pressure', pressure, location_id),
+        ])
+
+    def add_rows(self, rows):
+        """Queue rows and flush if the batch size limit has been reached"""
+        for stage in self.stages:
+            stage.add_rows(rows)
+        self._buffer(rows)
+
+    def _buffer(self, rows):
+        with self._lock:
+            self._rows.extend(rows)
+            pending = len(self._rows)
+
+        if pending >= self.batch_size:
+            self.flush()
+
+    def pending(self):
+        with self._lock:
+            return len(self._rows)
+
+    def maybe_flush(self):
+        """Flush if the time limit has elapsed since the last flush"""
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self, final=False):
+        """Write all buffered rows in one transaction, returns rows written.
+        ``final`` also writes rollup windows that are still open."""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+            self._last_flush = time.monotonic()
+            staged = [(stage, stage.take(close_all=final)) for stage in self.stages]
+            staged = [(stage, stage_rows) for stage, stage_rows in staged if stage_rows]
+
+            if not rows and not staged:
+                return 0
+
+            start = time.perf_counter()
+            try:
+                inserted = self._write(rows, staged)
+            except PERMANENT_ERRORS as e:
+                self.flush_errors += 1
+                self.rows_dropped += len(rows)
+                logger.error(f"{self.table} rejected a batch of {len(rows)} rows, dropping them: {e}")
+                self._rollback()
+                if not rows:
+                    self._drop_staged(staged)
+                    return 0
+                rows, inserted = [], 0
+                staged = self._write_staged(staged)
+            except Exception as e:
+                self.flush_errors += 1
+                logger.error(f"Error flushing {len(rows)} rows to {self.table}: {e}")
+                # Keep the rows before touching the connection, rollback()
+                # raises itself once the server has dropped it
+                self._requeue(rows)
+                for stage, stage_rows in staged:
+                    stage.requeue(stage_rows)
+                self._rollback()
+                raise
+
+            elapsed = time.perf_counter() - start
+            for stage, stage_rows in staged:
+                stage.committed(stage_rows)
+            if not rows:
+                return 0
+            # rowcount is -1 when the driver cannot tell, assume every row was new
+            duplicates = len(rows) - inserted if self.deduplicate and inserted >= 0 else 0
+            self.flush_count += 1
+            self.rows_written += len(rows) - duplicates
+            self.rows_duplicate += duplicates
+            self.total_flush_seconds += elapsed
+            self.last_flush_rows = len(rows)
+            self.last_flush_seconds = elapsed
+            metrics.FLUSH_SECONDS.labels(table=self.table).observe(elapsed)
+            metrics.BATCH_ROWS.labels(table=self.table).observe(len(rows))
+
+            logger.debug(f"Flushed {len(rows)} rows to {self.table} in {elapsed * 1000:.1f} ms "
+                         f"({len(rows) / elapsed if elapsed > 0 else 0:.0f} rows/sec)")
+            if self.on_flush is not None:
+                self.on_flush(rows)
+            return len(rows)
+
+    def _write(self, rows, staged):
+        """Write rows and stage rows in one transaction, returns the rows inserted"""
+        inserted = 0
+        with metrics.span('flush', table=self.table, rows=len(rows)):
+            cur = self.conn.cursor()
+            if rows and self.method == 'copy':
+                inserted = self._copy_rows(cur, rows)
+            elif rows:
+                extras.execute_values(cur, self._values_sql, rows, page_size=len(rows))
+                inserted = cur.rowcount
+            for stage, stage_rows in staged:
+                stage.write(cur, stage_rows)
+            self.conn.commit()
+            cur.close()
+            # The staging table lives as long as the session once committed
+            if self.deduplicate:
+                self._staged_conn = self.conn
+        return inserted
+
+    def _write_staged(self, staged):
+        """Retry the stage rows of a rejected batch without its raw rows,
+        returns them if written"""
+        if not staged:
+            return []
+        try:
+            self._write([], staged)
+        except PERMANENT_ERRORS as e:
+            logger.error(f"{self.table} rejected the stage rows of a batch too: {e}")
+            self._rollback()
+            self._drop_staged(staged)
+            return []
+        except Exception as e:
+            logger.error(f"Error flushing stage rows to {self.table}: {e}")
+            for stage, stage_rows in staged:
+                stage.requeue(stage_rows)
+            self._rollback()
+            raise
+        return staged
+
+    def _drop_staged(self, staged):
+        for stage, stage_rows in staged:
+            logger.error(f"Dropped {len(stage_rows)} rows of {type(stage).__name__} the database rejected")
+
+    def _rollback(self):
+        try:
+            self.conn.rollback()
+        except Exception as e:
+            logger.warning(f"Rollback after failed flush to {self.table} failed: {e}")
+
+    def _copy_rows(self, cur, rows):
+        # In CSV format an unquoted empty field is NULL, which is how csv writes None
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerows(rows)
+        buf.seek(0)
+        if not self.deduplicate:
+            cur.copy_expert(self._copy_sql, buf)
+            return len(rows)
+        if self._staged_conn is not self.conn:
+            cur.execute(self._staging_sql)
+        cur.copy_expert(self._copy_sql, buf)
+        cur.execute(self._merge_sql)
+        return cur.rowcount
+
+    def _requeue(self, rows):
+        # Put failed rows back in front of anything queued since, dropping the
+        # oldest if the database has been unavailable for too long
+        with self._lock:
+            self._rows = rows + self._rows
+            overflow = len(self._rows) - self.max_pending
+            if overflow > 0:
+                del self._rows[:overflow]
+                self.rows_dropped += overflow
+                logger.error(f"Batch buffer full, dropped {overflow} oldest rows")
+
+    def stats(self):
+        """Return a snapshot of flush statistics"""
+        stats = {
+            'flushes': self.flush_count,
+            'rows_written': self.rows_written,
+            'rows_duplicate': self.rows_duplicate,
+            'rows_dropped': self.rows_dropped,
+            'flush_errors': self.flush_errors,
+            'pending_rows': self.pending(),
+            'last_flush_rows': self.last_flush_rows,
+            'last_flush_ms': self.last_flush_seconds * 1000,
+            'avg_flush_ms': (self.total_flush_seconds / self.flush_count * 1000) if self.flush_count else 0.0,
+            'rows_per_sec': (self.rows_written / self.total_flush_seconds) if self.total_flush_seconds > 0 else 0.0,
+        }
+        for stage in self.stages:
+            stats.update(stage.stats())
+        return stats
+
+    def log_stats(self):
+        s = self.stats()
+        logger.info(f"Batch writer: {s['rows_written']} rows in {s['flushes']} flushes, "
+                    f"last flush {s['last_flush_rows']} rows in {s['last_flush_ms']:.1f} ms, "
+                    f"avg flush {s['avg_flush_ms']:.1f} ms, {s['rows_per_sec']:.0f} rows/sec, "
+                    f"{s['pending_rows']} pending, {s['rows_duplicate']} duplicates, {s['flush_errors']} errors")
+
+    def start(self):
+        """Start a background thread that enforces the flush interval"""
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='batch-writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop_event.wait(min(self.flush_interval, 0.1)):
+            try:
+                self.maybe_flush()
+            except Exception:
+                # Already logged by flush, rows stay queued for the next attempt
+                pass
+
+    def close(self):
+        """Stop the background thread and flush whatever is left"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush(final=True)
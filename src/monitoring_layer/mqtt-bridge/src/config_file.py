@@ -0,0 +1,434 @@
+import ctypes
+import logging
+import os
+import re
+import select
+import threading
+import time
+
+import yaml
+
+logger = logging.getLogger('mqtt-bridge')
+
+DEFAULT_PATH = '/app/config/config.yaml'
+
+# ${NAME} or ${NAME:-default}
+_PLACEHOLDER = re.compile(r'\$\{([A-Za-z_][A-Za-z0-9_]*)(?::-([^}]*))?\}')
+
+
+class ConfigError(ValueError):
+    """Raised when the config file cannot be read or does not match SCHEMA"""
+
+
+class Field:
+    """A config value of one of ``types`` (``float`` also takes ints, nothing
+    takes booleans but ``bool``), optionally one of ``choices`` or at least
+    ``minimum``. ``items`` is the Field of every element of a list."""
+
+    def __init__(self, *types, choices=None, minimum=None, items=None):
+        self.types = types
+        self.choices = choices
+        self.minimum = minimum
+        self.items = items
+
+    def check(self, value, path, errors):
+        if not self._typed(value):
+            names = ' or '.join('number' if t is float else 'null' if t is type(None) else t.__name__
+                                for t in self.types)
+            errors.append(f"{path}: expected {names}, got {type(value).__name__} {value!r}")
+        elif self.choices is not None and value not in self.choices:
+            errors.append(f"{path}: {value!r} is not one of {', '.join(map(repr, self.choices))}")
+        elif self.minimum is not None and isinstance(value, (int, float)) and value < self.minimum:
+            errors.append(f"{path}: {value!r} is below the minimum of {self.minimum}")
+        elif self.items is not None and isinstance(value, list):
+            for index, item in enumerate(value):
+                self.items.check(item, f"{path}[{index}]", errors)
+
+    def _typed(self, value):
+        if isinstance(value, bool):
+            return bool in self.types
+        if isinstance(value, int) and float in self.types:
+            return True
+        return isinstance(value, self.types)
+
+
+class MapOf:
+    """A mapping with arbitrary keys, each holding a ``schema`` section"""
+
+    def __init__(self, schema):
+        self.schema = schema
+
+
+def _count(minimum=1):
+    return Field(int, minimum=minimum)
+
+
+def _seconds(minimum=0):
+    return Field(float, minimum=minimum)
+
+
+_PORT = Field(int, minimum=1)
+_RETRY = {'min_delay_seconds': _seconds(), 'max_delay_seconds': _seconds()}
+_POLICY = Field(str, choices=('block', 'drop'))
+_LEVELS = ('debug', 'info', 'warning', 'error', 'critical')
+
+# Every setting the bridge, the query API and the load generator read.
+# Unknown keys only log a warning, so a newer config still loads.
+SCHEMA = {
+    'bridge': {
+        'client_id': Field(str),
+        'mode': Field(str, choices=('production', 'development')),
+        'engine': Field(str, choices=('sync', 'asyncio')),
+        'aws': {'region': Field(str), 'endpoint': Field(str)},
+        'topics': Field(list, items=Field(str)),
+        'shared_subscription_group': Field(str, type(None)),
+        'qos': Field(int, choices=(0, 1, 2)),
+        'broker': {
+            'host': Field(str), 'port': _PORT, 'tls': Field(bool), 'cert_dir': Field(str),
+            'ca_certs': Field(str), 'certfile': Field(str), 'keyfile': Field(str), 'keepalive': _count(),
+        },
+        'queue': {'max_size': _count(), 'policy': _POLICY, 'block_timeout_seconds': _seconds()},
+        'workers': _count(),
+        'stats_interval_seconds': _seconds(1),
+        'metrics': {'enabled': Field(bool), 'port': _PORT},
+        'tracing': {'enabled': Field(bool), 'service_name': Field(str)},
+        'dedup': {'enabled': Field(bool), 'window': _count(), 'max_devices': _count()},
+        'reload': {'enabled': Field(bool), 'poll_interval_seconds': _seconds(0.1), 'debounce_seconds': _seconds()},
+    },
+    'geo': {
+        'enabled': Field(bool), 'host': Field(str), 'port': _PORT, 'name': Field(str), 'channel': Field(str),
+        'refresh_interval_seconds': _seconds(1), 'retry_delay_seconds': _seconds(),
+        'sink': {
+            'workers': _count(), 'queue_size': _count(), 'policy': _POLICY, 'batch_size': _count(),
+            'flush_interval_seconds': _seconds(0.01), 'retry': _RETRY,
+        },
+    },
+    'database': {
+        'host': Field(str), 'port': _PORT, 'name': Field(str), 'user': Field(str), 'password': Field(str),
+        'layout': Field(str, choices=('narrow', 'wide')),
+        'batch': {
+            'size': _count(), 'flush_interval_seconds': _seconds(0.01), 'method': Field(str, choices=('copy', 'values')),
+            'max_pending_rows': _count(), 'deduplicate': Field(bool),
+        },
+        'rollup': {'enabled': Field(bool), 'table': Field(str), 'window_seconds': _count(), 'grace_seconds': _seconds()},
+        'retry': _RETRY,
+        'pool': {
+            'min_size': _count(0), 'max_size': _count(), 'max_inflight_batches': _count(),
+            'retry_delay_seconds': _seconds(),
+        },
+    },
+    'alerts': {
+        'enabled': Field(bool), 'table': Field(str), 'topic': Field(str, type(None)),
+        'cooldown_seconds': _seconds(), 'ewma_alpha': Field(float, minimum=0), 'warmup_readings': _count(0),
+        'sensors': MapOf({'min': Field(float), 'max': Field(float), 'max_rate_per_minute': Field(float),
+                          'zscore': Field(float)}),
+    },
+    'query_api': {
+        'enabled': Field(bool), 'port': _PORT, 'channel': Field(str), 'pool_size': _count(),
+        'cache': {'max_entries': _count(0), 'ttl_seconds': _seconds(), 'latest_ttl_seconds': _seconds()},
+        'series': {'max_points': _count(2), 'lttb_factor': _count()},
+        'latest': {'lookback_seconds': _seconds(), 'refresh_interval_seconds': _seconds(1),
+                   'retry_delay_seconds': _seconds()},
+    },
+    'logging': {'level': Field(str, choices=_LEVELS + tuple(level.upper() for level in _LEVELS))},
+    'development': {
+        'devices': _count(), 'rate_per_second': Field(float, minimum=0), 'seed': Field(int),
+        'target': Field(str, choices=('database', 'mqtt')), 'motion_events_per_hour': Field(float, minimum=0),
+        'report_interval_seconds': _seconds(), 'device_prefix': Field(str), 'tick_seconds': _seconds(0.001),
+        'duration_seconds': Field(float, type(None), minimum=0),
+    },
+}
+
+# How a running bridge takes a changed setting, by dotted key prefix; the
+# longest matching prefix wins. "live" settings are applied in place,
+# "rebuild" ones by replacing the writer workers after they have written
+# what they hold, "ignore" ones do not concern a running bridge and
+# anything else needs a restart.
+RELOAD_ACTIONS = {
+    'bridge.topics': 'live',
+    'bridge.shared_subscription_group': 'live',
+    'bridge.qos': 'live',
+    'bridge.queue.policy': 'live',
+    'bridge.queue.block_timeout_seconds': 'live',
+    'bridge.stats_interval_seconds': 'live',
+    'database.batch.size': 'live',
+    'database.batch.flush_interval_seconds': 'live',
+    'database.batch.max_pending_rows': 'live',
+    'logging': 'live',
+    'bridge.workers': 'rebuild',
+    'bridge.queue.max_size': 'rebuild',
+    'database.batch.method': 'rebuild',
+    'database.batch.deduplicate': 'rebuild',
+    'database.rollup': 'rebuild',
+    'database.retry': 'rebuild',
+    'alerts': 'rebuild',
+    'query_api': 'ignore',
+    'query_api.enabled': 'rebuild',
+    'query_api.channel': 'rebuild',
+    'development': 'ignore',
+    'database.user': 'ignore',
+    'database.password': 'ignore',
+}
+
+
+def interpolate(value, missing):
+    """Expand ${NAME} and ${NAME:-default} in every string of ``value``.
+    Names that are unset and have no default become "" and are added to ``missing``."""
+    if isinstance(value, dict):
+        return {key: interpolate(item, missing) for key, item in value.items()}
+    if isinstance(value, list):
+        return [interpolate(item, missing) for item in value]
+    if not isinstance(value, str) or '${' not in value:
+        return value
+
+    def expand(match):
+        name, default = match.groups()
+        if name in os.environ:
+            return os.environ[name]
+        if default is None:
+            missing.add(name)
+            return ''
+        return default
+
+    return _PLACEHOLDER.sub(expand, value)
+
+
+def validate(config, schema=SCHEMA, path='', errors=None, unknown=None):
+    """Check ``config`` against ``schema``, returns (errors, unknown keys) as lists of strings"""
+    errors = [] if errors is None else errors
+    unknown = [] if unknown is None else unknown
+    if not isinstance(config, dict):
+        errors.append(f"{path or 'config'}: expected a mapping, got {type(config).__name__}")
+        return errors, unknown
+    for key, value in config.items():
+        key_path = f"{path}.{key}" if path else str(key)
+        spec = schema.get(key)
+        if spec is None:
+            unknown.append(key_path)
+        elif isinstance(spec, Field):
+            spec.check(value, key_path, errors)
+        elif isinstance(spec, MapOf):
+            if not isinstance(value, dict):
+                errors.append(f"{key_path}: expected a mapping, got {type(value).__name__}")
+                continue
+            for name, section in value.items():
+                validate(section, spec.schema, f"{key_path}.{name}", errors, unknown)
+        elif value is not None:
+            validate(value, spec, key_path, errors, unknown)
+    return errors, unknown
+
+
+def parse_config(text, source='config'):
+    """Parse, interpolate and validate YAML ``text``, returns the config dict"""
+    try:
+        config = yaml.safe_load(text)
+    except yaml.YAMLError as e:
+        raise ConfigError(f"Invalid YAML in {source}: {e}")
+    if config is None:
+        config = {}
+    missing = set()
+    config = interpolate(config, missing)
+    errors, unknown = validate(config)
+    if errors:
+        raise ConfigError(f"Invalid {source}:\n  " + '\n  '.join(errors))
+    if missing:
+        logger.warning(f"Environment variables not set, left empty in {source}: {', '.join(sorted(missing))}")
+    if unknown:
+        logger.warning(f"Unknown settings in {source}, ignored: {', '.join(unknown)}")
+    return config
+
+
+def load_config(path=None):
+    """Read the config file at ``path`` (CONFIG_PATH by default) with parse_config"""
+    path = path or os.environ.get('CONFIG_PATH', DEFAULT_PATH)
+    try:
+        with open(path, 'r') as f:
+            text = f.read()
+    except OSError as e:
+        raise ConfigError(f"Cannot read {path}: {e}")
+    return parse_config(text, path)
+
+
+def set_log_level(config):
+    """Apply logging.level; per-message and per-flush logs are DEBUG, keep INFO at high rates"""
+    level = config.get('logging', {}).get('level', 'info').upper()
+    logging.getLogger().setLevel(getattr(logging, level, logging.INFO))
+
+
+def changed_keys(old, new, path=''):
+    """Dotted paths of the settings that differ between two configs"""
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return [] if old == new else [path]
+    keys = []
+    for key in list(old) + [key for key in new if key not in old]:
+        key_path = f"{path}.{key}" if path else str(key)
+        before, after = old.get(key), new.get(key)
+        # A section added or removed as a whole changes each of its settings
+        if before is None and isinstance(after, dict):
+            before = {}
+        elif after is None and isinstance(before, dict):
+            after = {}
+        keys.extend(changed_keys(before, after, key_path))
+    return keys
+
+
+def reload_action(key):
+    """"live", "rebuild", "ignore" or "restart" for a changed dotted key"""
+    parts = key.split('.')
+    for end in range(len(parts), 0, -1):
+        action = RELOAD_ACTIONS.get('.'.join(parts[:end]))
+        if action is not None:
+            return action
+    return 'restart'
+
+
+def reload_plan(old, new):
+    """Group the settings changed from ``old`` to ``new`` by reload_action"""
+    plan = {'live': [], 'rebuild': [], 'ignore': [], 'restart': []}
+    for key in changed_keys(old, new):
+        plan[reload_action(key)].append(key)
+    return plan
+
+
+# inotify(7), the events that show a file or the ConfigMap's ..data symlink being replaced
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_NONBLOCK = 0o4000
+
+
+def _inotify(directory):
+    """A non-blocking inotify fd watching ``directory``, or None where inotify is unavailable"""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(_IN_NONBLOCK)
+        if fd < 0:
+            return None
+        mask = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+        if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (AttributeError, OSError):
+        return None
+
+
+class ConfigWatcher:
+    """Reloads the config file when it changes and hands it to ``on_change``.
+
+    Kubernetes updates a mounted ConfigMap by swapping the ``..data``
+    symlink next to the file, so a background thread watches the file's
+    directory with inotify, waits ``debounce`` seconds for the update to
+    settle, and re-reads the file; without inotify it re-reads every
+    ``poll_interval`` seconds. Only a file whose text changed and that
+    passes validation reaches ``on_change(old, new)``; a broken edit is
+    logged and the running config kept, so a typo never takes the bridge
+    down.
+    """
+
+    def __init__(self, path, config, on_change, poll_interval=5.0, debounce=0.5):
+        self.path = path
+        self.config = config
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+
+        self._text = self._read()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        self.reloads = 0
+        self.errors = 0
+        self.last_reload_seconds = 0.0
+        self.inotify = False
+
+    @classmethod
+    def from_config(cls, config, on_change, path=None):
+        """Create a watcher from bridge.reload, or None if disabled"""
+        reload_config = config.get('bridge', {}).get('reload', {})
+        if not reload_config.get('enabled', True):
+            return None
+        return cls(path or os.environ.get('CONFIG_PATH', DEFAULT_PATH), config, on_change,
+                   poll_interval=reload_config.get('poll_interval_seconds', 5.0),
+                   debounce=reload_config.get('debounce_seconds', 0.5))
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='config-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.poll_interval + 1)
+            self._thread = None
+
+    def _run(self):
+        fd = _inotify(os.path.dirname(os.path.abspath(self.path)))
+        self.inotify = fd is not None
+        logger.info(f"Watching {self.path} for changes "
+                    f"({'inotify' if self.inotify else f'polling every {self.poll_interval}s'})")
+        try:
+            while not self._stop_event.is_set():
+                if fd is None:
+                    self._stop_event.wait(self.poll_interval)
+                elif not self._wait_for_event(fd):
+                    continue
+                self.check()
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def _wait_for_event(self, fd):
+        # Wake up once a second to notice stop()
+        if not select.select([fd], [], [], 1.0)[0]:
+            return False
+        # Let the rest of an update land before reading
+        self._stop_event.wait(self.debounce)
+        try:
+            while os.read(fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def check(self):
+        """Reload if the file changed, returns True if ``on_change`` was called"""
+        text = self._read()
+        if text is None or text == self._text:
+            return False
+        self._text = text
+        start = time.perf_counter()
+        try:
+            config = parse_config(text, self.path)
+        except ConfigError as e:
+            self.errors += 1
+            logger.error(f"Keeping the running config: {e}")
+            return False
+        old, self.config = self.config, config
+        try:
+            self.on_change(old, config)
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Error applying the changed config: {e}")
+            return False
+        self.reloads += 1
+        self.last_reload_seconds = time.perf_counter() - start
+        return True
+
+    def stats(self):
+        return {
+            'config_reloads': self.reloads,
+            'config_errors': self.errors,
+            'config_last_reload_seconds': self.last_reload_seconds,
+        }
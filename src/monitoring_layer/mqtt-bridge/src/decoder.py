@@ -0,0 +1,183 @@
+import datetime
+import json
+import logging
+
+logger = logging.getLogger('mqtt-bridge')
+
+# Payload field names sent by the Pi client (and the flat dev-mode style)
+# mapped to the sensor_type stored in sensor_data. Derived fields such as
+# temperature_f are intentionally left out.
+SENSOR_FIELDS = {
+    'temperature_c': 'temperature',
+    'temperature': 'temperature',
+    'humidity': 'humidity',
+    'humidity_pct': 'humidity',
+    'pressure_hpa': 'pressure',
+    'pressure': 'pressure',
+    'altitude_m': 'altitude',
+    'altitude': 'altitude',
+    'volume': 'volume',
+    'volume_db': 'volume',
+}
+
+TIMESTAMP_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S')
+
+# Batched payloads from the Pi client (see pi_client/batching.py):
+# b"PB" + format version byte + codec byte + body
+BATCH_MAGIC = b'PB'
+BATCH_VERSION = 1
+BATCH_CODEC_MSGPACK = 1
+BATCH_CODEC_JSON = 2
+
+
+class DecodeError(ValueError):
+    """Raised when an MQTT payload cannot be turned into sensor_data rows"""
+
+
+def device_from_topic(topic):
+    """Extract the device id from a sensors/<device_id>/<kind> topic"""
+    parts = topic.split('/')
+    if len(parts) >= 3 and parts[0] == 'sensors':
+        return parts[1]
+    return None
+
+
+def parse_timestamp(value):
+    """Parse the timestamp formats the Pi client produces into an aware
+    datetime. Times without an offset (older Pi clients) are taken as UTC,
+    the same as batched payloads, whose times are epoch milliseconds."""
+    if value is None:
+        return datetime.datetime.now(datetime.timezone.utc)
+    if isinstance(value, (int, float)):
+        return datetime.datetime.fromtimestamp(value, tz=datetime.timezone.utc)
+    parsed = _parse_time_string(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed
+
+
+def _parse_time_string(value):
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        pass
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise DecodeError(f"Unrecognised timestamp: {value!r}")
+
+
+def decode_payload(topic, payload, location_id='default', dedup=None, geo=None):
+    """Turn one MQTT message into a list of narrow sensor_data rows.
+
+    Accepts the Pi client's event format
+    ({"timestamp", "event", "location", "sensor_data": {...}}) as well as a
+    flat {"device_id", "temperature", "humidity", "pressure"} object. Status
+    messages and readings without numeric values produce no rows. Events
+    stamped with "boot_id" and "seq" that ``dedup`` has already seen are
+    skipped. With a ``geo`` cache rows are tagged with the device's geofence
+    instead of ``location_id``, and locations in events or status messages
+    are passed on to it.
+    """
+    if topic.endswith('/status'):
+        if geo is not None:
+            _observe_status(topic, payload, geo)
+        return []
+    if isinstance(payload, (bytes, bytearray)) and payload[:2] == BATCH_MAGIC:
+        return decode_batch(topic, payload, location_id, dedup, geo)
+
+    try:
+        message = json.loads(payload)
+    except (TypeError, ValueError) as e:
+        raise DecodeError(f"Invalid JSON payload on {topic}: {e}")
+    if not isinstance(message, dict):
+        raise DecodeError(f"Expected a JSON object on {topic}")
+
+    device_id = message.get('device_id') or device_from_topic(topic)
+    if not device_id:
+        raise DecodeError(f"No device id in topic {topic} or payload")
+
+    seq = message.get('seq')
+    if dedup is not None and isinstance(seq, int) and dedup.seen(device_id, message.get('boot_id'), seq):
+        return []
+    if geo is not None:
+        location_id = geo.location_id(device_id, message.get('location'))
+
+    return event_rows(device_id, message, location_id)
+
+
+def event_rows(device_id, message, location_id='default'):
+    """Rows of one decoded event, {"timestamp", "sensor_data": {...}} or flat"""
+    timestamp = parse_timestamp(message.get('timestamp'))
+    values = message.get('sensor_data')
+    if not isinstance(values, dict):
+        values = message
+
+    return _rows(timestamp, device_id, values.items(), location_id)
+
+
+def _observe_status(topic, payload, geo):
+    try:
+        message = json.loads(payload)
+    except (TypeError, ValueError):
+        return
+    if not isinstance(message, dict):
+        return
+    device_id = message.get('device_id') or device_from_topic(topic)
+    if device_id:
+        geo.observe_status(device_id, message)
+
+
+def _rows(timestamp, device_id, fields, location_id):
+    rows = []
+    for field, value in fields:
+        sensor_type = SENSOR_FIELDS.get(field)
+        if sensor_type is None or isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        rows.append((timestamp, device_id, sensor_type, float(value), location_id))
+    return rows
+
+
+def decode_batch(topic, payload, location_id='default', dedup=None, geo=None):
+    """Decode a batched payload into narrow rows for every event in it.
+
+    The body is {"d": device_id, "t": first_epoch_ms, "k": string_table,
+    "e": [[dt_ms, event_index, field_index, value, ...], ...]}, where dt_ms
+    is relative to the previous event and names are indices into "k".
+    Optional "b" (boot id) and "s" (one sequence number per event) let
+    ``dedup`` skip events already seen.
+    """
+    if len(payload) < 4 or payload[2] != BATCH_VERSION:
+        raise DecodeError(f"Unsupported batch format version on {topic}")
+    codec, data = payload[3], bytes(payload[4:])
+    try:
+        if codec == BATCH_CODEC_MSGPACK:
+            import msgpack
+            body = msgpack.unpackb(data)
+        elif codec == BATCH_CODEC_JSON:
+            body = json.loads(data)
+        else:
+            raise DecodeError(f"Unknown batch codec {codec} on {topic}")
+        device_id = body.get('d') or device_from_topic(topic)
+        strings = body['k']
+        ms = body['t']
+        seqs = body.get('s') if dedup is not None else None
+        if geo is not None:
+            location_id = geo.location_id(device_id, body.get('l'))
+        rows = []
+        for index, event in enumerate(body['e']):
+            ms += event[0]
+            if seqs is not None and dedup.seen(device_id, body.get('b'), seqs[index]):
+                continue
+            timestamp = datetime.datetime.fromtimestamp(ms / 1000, tz=datetime.timezone.utc)
+            fields = ((strings[event[i]], event[i + 1]) for i in range(2, len(event) - 1, 2))
+            rows.extend(_rows(timestamp, device_id, fields, location_id))
+    except DecodeError:
+        raise
+    except Exception as e:
+        raise DecodeError(f"Invalid batch payload on {topic}: {e}")
+    if not device_id:
+        raise DecodeError(f"No device id in topic {topic} or batch")
+    return rows
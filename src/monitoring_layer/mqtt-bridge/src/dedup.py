@@ -0,0 +1,77 @@
+import collections
+import threading
+
+
+class Deduplicator:
+    """Recognises messages already seen by their (device_id, boot_id, seq) stamp.
+
+    QoS 1 redelivery and outbox replays after a reconnect send the same
+    reading again. For each (device, boot) stream this keeps the highest
+    sequence number seen plus a bitmap of which of the ``window`` numbers
+    below it have arrived, like an IPsec anti-replay window, so memory per
+    device is constant however many messages it sends. A sequence number
+    older than the window (e.g. a long outbox backlog replayed after fresh
+    readings) cannot be judged and is let through; the database's unique
+    index catches any duplicate among those. At most ``max_streams``
+    streams are tracked, the least recently active are forgotten first.
+    """
+
+    def __init__(self, window=4096, max_streams=100000):
+        self.window = window
+        self.max_streams = max_streams
+        self._mask = (1 << window) - 1
+        self._streams = collections.OrderedDict()  # (device_id, boot_id) -> [highest seq, bitmap]
+        self._lock = threading.Lock()
+
+        self.checked = 0
+        self.duplicates = 0
+        self.too_old = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a deduplicator from bridge.dedup, or None if disabled"""
+        dedup_config = config.get('bridge', {}).get('dedup', {})
+        if not dedup_config.get('enabled', True):
+            return None
+        return cls(window=dedup_config.get('window', 4096), max_streams=dedup_config.get('max_devices', 100000))
+
+    def seen(self, device_id, boot_id, seq):
+        """Record a message, returns True if it is a duplicate"""
+        key = (device_id, boot_id)
+        with self._lock:
+            self.checked += 1
+            state = self._streams.get(key)
+            if state is None:
+                self._streams[key] = [seq, 1]
+                if len(self._streams) > self.max_streams:
+                    self._streams.popitem(last=False)
+                return False
+            self._streams.move_to_end(key)
+
+            highest, bitmap = state
+            if seq > highest:
+                shift = seq - highest
+                state[0] = seq
+                state[1] = ((bitmap << shift) | 1) & self._mask if shift < self.window else 1
+                return False
+
+            offset = highest - seq
+            if offset >= self.window:
+                self.too_old += 1
+                return False
+            bit = 1 << offset
+            if bitmap & bit:
+                self.duplicates += 1
+                return True
+            state[1] = bitmap | bit
+            return False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'dedup_checked': self.checked,
+                'duplicates_dropped': self.duplicates,
+                'dedup_too_old': self.too_old,
+                'dedup_streams': len(self._streams),
+                'dedup_hit_rate': self.duplicates / self.checked if self.checked else 0.0,
+            }
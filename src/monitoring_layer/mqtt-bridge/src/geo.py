@@ -0,0 +1,357 @@
+import json
+import logging
+import os
+import select
+import threading
+import time
+
+import psycopg2
+from psycopg2 import extras
+
+from sinks import RetryPolicy, Sink
+
+logger = logging.getLogger('mqtt-bridge')
+
+DEFAULT_LOCATION_ID = 'default'
+
+# Every device with its point and the first geofence that covers it
+LOAD_SQL = """
+SELECT l.sensor_id, ST_Y(l.location::geometry), ST_X(l.location::geometry), f.fence_id
+FROM sensor_locations l
+LEFT JOIN LATERAL (
+  SELECT fence_id FROM geo_fences WHERE ST_Covers(boundary, l.location) ORDER BY fence_id LIMIT 1
+) f ON TRUE
+"""
+
+# The name is only set on insert so a name given by an operator is kept
+LOCATION_UPSERT_SQL = """
+INSERT INTO sensor_locations (sensor_id, name, description, location, installation_date)
+VALUES %s
+ON CONFLICT (sensor_id) DO UPDATE
+SET description = EXCLUDED.description, location = EXCLUDED.location
+"""
+LOCATION_TEMPLATE = "(%s, %s, %s, ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography, NOW())"
+
+STATUS_UPSERT_SQL = """
+INSERT INTO sensor_locations (sensor_id, name, status)
+VALUES %s
+ON CONFLICT (sensor_id) DO UPDATE SET status = EXCLUDED.status
+"""
+
+
+def parse_location(location):
+    """Return (lat, lon, description) from a Pi location dict, or None.
+
+    Accepts the ipinfo.io shape {"city", "region", "country", "loc": "lat,lon"}
+    and an explicit {"lat", "lon"}.
+    """
+    if not isinstance(location, dict):
+        return None
+    try:
+        if 'lat' in location and 'lon' in location:
+            lat, lon = float(location['lat']), float(location['lon'])
+        else:
+            lat, lon = (float(part) for part in location['loc'].split(','))
+    except (KeyError, AttributeError, TypeError, ValueError):
+        return None
+    description = ', '.join(str(location[key]) for key in ('city', 'region', 'country') if location.get(key))
+    return lat, lon, description or None
+
+
+class LocationWriter:
+    """Batches sensor_locations updates for the PostGIS sink.
+
+    Same interface as BatchWriter. Items are ``('location', device_id, lat,
+    lon, description)`` or ``('status', device_id, state)``; only the latest
+    of each kind per device is kept, so a flapping device costs one row per
+    flush. ``on_flush`` is called with the device ids after each commit.
+    """
+
+    def __init__(self, conn, batch_size=100, flush_interval=1.0, on_flush=None):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush
+
+        self._locations = {}
+        self._statuses = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+        self.flush_count = 0
+        self.rows_written = 0
+        self.flush_errors = 0
+
+    def add_rows(self, items):
+        with self._lock:
+            for item in items:
+                if item[0] == 'location':
+                    self._locations[item[1]] = item[1:]
+                else:
+                    self._statuses[item[1]] = item[1:]
+            pending = len(self._locations) + len(self._statuses)
+        if pending >= self.batch_size:
+            self.flush()
+
+    def pending(self):
+        with self._lock:
+            return len(self._locations) + len(self._statuses)
+
+    def maybe_flush(self):
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self, final=False):
+        with self._lock:
+            locations, self._locations = self._locations, {}
+            statuses, self._statuses = self._statuses, {}
+        self._last_flush = time.monotonic()
+        if not locations and not statuses:
+            return 0
+
+        try:
+            cur = self.conn.cursor()
+            if locations:
+                rows = [(device_id, device_id, description, lon, lat)
+                        for device_id, lat, lon, description in locations.values()]
+                extras.execute_values(cur, LOCATION_UPSERT_SQL, rows, template=LOCATION_TEMPLATE)
+            if statuses:
+                rows = [(device_id, device_id, state) for device_id, state in statuses.values()]
+                extras.execute_values(cur, STATUS_UPSERT_SQL, rows)
+            self.conn.commit()
+            cur.close()
+        except Exception as e:
+            self.flush_errors += 1
+            logger.error(f"Error writing {len(locations) + len(statuses)} device updates to PostGIS: {e}")
+            # Put them back unless a newer update arrived meanwhile, before
+            # touching the connection: rollback() raises once it is gone
+            with self._lock:
+                self._locations = {**locations, **self._locations}
+                self._statuses = {**statuses, **self._statuses}
+            try:
+                self.conn.rollback()
+            except Exception as rollback_error:
+                logger.warning(f"Rollback after failed PostGIS write failed: {rollback_error}")
+            raise
+
+        written = len(locations) + len(statuses)
+        self.flush_count += 1
+        self.rows_written += written
+        for device_id, lat, lon, _ in locations.values():
+            logger.info(f"Updated location of {device_id} to {lat:.4f},{lon:.4f}")
+        if self.on_flush is not None:
+            self.on_flush(set(locations) | set(statuses))
+        return written
+
+    def stats(self):
+        return {
+            'flushes': self.flush_count,
+            'rows_written': self.rows_written,
+            'flush_errors': self.flush_errors,
+            'pending_rows': self.pending(),
+        }
+
+
+class GeoCache:
+    """In-memory device -> location/geofence map backed by PostGIS.
+
+    ``location_id(device_id, location)`` is called for every decoded
+    message and only touches dictionaries: it returns the id of the
+    geofence the device is in (``"default"`` when it is in none or unknown)
+    and, when the reported location differs from the cached one, submits an
+    update to ``sink`` (the PostGIS sink, whose writer reports back when it
+    has committed). A background thread LISTENs on ``channel``; the triggers
+    in postgis/configmap.yaml notify on every change to sensor_locations or
+    geo_fences, so a moved device or an edited fence is picked up without
+    polling. A full reload every ``refresh_interval`` seconds covers
+    databases without the triggers.
+    """
+
+    def __init__(self, connect, channel='geo_changed', refresh_interval=300.0, retry_delay=5.0, sink=None):
+        self.connect = connect
+        self.channel = channel
+        self.refresh_interval = refresh_interval
+        self.retry_delay = retry_delay
+        self.sink = sink
+
+        self._tags = {}  # device_id -> location_id written with its rows
+        self._points = {}  # device_id -> (lat, lon) as stored in PostGIS
+        self._reported = {}  # device_id -> last location dict seen, to skip parsing repeats
+        self._states = {}  # device_id -> last status state seen
+        self._changed = set()  # devices the sink has written, to reload
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        self.reloads = 0
+        self.notifications = 0
+        self.errors = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a cache and its PostGIS sink from the geo section, or None if disabled"""
+        geo_config = config.get('geo', {})
+        if not geo_config.get('enabled', False):
+            return None
+        sink_config = geo_config.get('sink', {})
+
+        def connect():
+            return psycopg2.connect(
+                host=geo_config.get('host', 'postgis'),
+                port=geo_config.get('port', 5432),
+                dbname=geo_config.get('name', 'iot_geo_data'),
+                user=os.environ.get('GEO_DB_USER', 'postgres'),
+                password=os.environ.get('GEO_DB_PASSWORD', 'postgres'),
+            )
+
+        cache = cls(
+            connect,
+            channel=geo_config.get('channel', 'geo_changed'),
+            refresh_interval=geo_config.get('refresh_interval_seconds', 300.0),
+            retry_delay=geo_config.get('retry_delay_seconds', 5.0),
+        )
+        flush_interval = sink_config.get('flush_interval_seconds', 1.0)
+        cache.sink = Sink(
+            'postgis', connect,
+            lambda: LocationWriter(None, batch_size=sink_config.get('batch_size', 100),
+                                   flush_interval=flush_interval, on_flush=cache.written),
+            queue_size=sink_config.get('queue_size', 1000),
+            workers=sink_config.get('workers', 1),
+            policy=sink_config.get('policy', 'drop'),
+            flush_interval=flush_interval,
+            retry=RetryPolicy.from_config(sink_config.get('retry', {})),
+        )
+        return cache
+
+    def location_id(self, device_id, location=None):
+        """Tag for the device's rows; submits a changed ``location`` to the sink"""
+        if location is not None and self._reported.get(device_id) != location:
+            self._reported[device_id] = location
+            parsed = parse_location(location)
+            if parsed is not None and self._points.get(device_id) != parsed[:2]:
+                self._submit(device_id, ('location', device_id) + parsed)
+        return self._tags.get(device_id, DEFAULT_LOCATION_ID)
+
+    def observe_status(self, device_id, message):
+        """Record the state and location from a status message"""
+        state = message.get('state')
+        if isinstance(state, str) and self._states.get(device_id) != state:
+            self._states[device_id] = state
+            self._submit(device_id, ('status', device_id, state[:20]))
+        if message.get('location') is not None:
+            self.location_id(device_id, message['location'])
+
+    def _submit(self, device_id, update):
+        if self.sink is None:
+            return
+        if not self.sink.submit(device_id, [update]):
+            # Forget it so the next message from the device tries again
+            self._reported.pop(device_id, None)
+            self._states.pop(device_id, None)
+
+    def tags(self):
+        """{device_id: location_id} of every device with a known location"""
+        return self._tags
+
+    def devices(self, location_id):
+        """{device_id: (lat, lon)} of the devices tagged with geofence ``location_id``"""
+        tags, points = self._tags, self._points
+        return {device_id: points[device_id] for device_id, tag in tags.items()
+                if tag == location_id and device_id in points}
+
+    def written(self, devices):
+        """Called by the sink's writer after committing updates for ``devices``"""
+        with self._lock:
+            self._changed |= devices
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='geo-cache', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.retry_delay + 1)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            conn = None
+            try:
+                conn = self.connect()
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f"LISTEN {self.channel}")
+                self._reload(cur)
+                self._listen(conn, cur)
+            except psycopg2.Error as e:
+                self.errors += 1
+                logger.error(f"Geo cache lost its PostGIS connection: {e}, retrying in {self.retry_delay}s")
+                self._stop_event.wait(self.retry_delay)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def _listen(self, conn, cur):
+        last_reload = time.monotonic()
+        while not self._stop_event.is_set():
+            # Wake up at least once a second to reload devices the sink wrote
+            if select.select([conn], [], [], 1.0)[0]:
+                conn.poll()
+            changed, reload_all = set(), False
+            while conn.notifies:
+                notify = conn.notifies.pop(0)
+                self.notifications += 1
+                try:
+                    payload = json.loads(notify.payload)
+                except ValueError:
+                    payload = {}
+                if payload.get('table') == 'sensor_locations' and payload.get('id'):
+                    changed.add(payload['id'])
+                else:
+                    # A fence change can move any number of devices in or out
+                    reload_all = True
+
+            with self._lock:
+                changed |= self._changed
+                self._changed = set()
+            if reload_all or time.monotonic() - last_reload >= self.refresh_interval:
+                self._reload(cur)
+                last_reload = time.monotonic()
+            elif changed:
+                self._reload(cur, changed)
+
+    def _reload(self, cur, devices=None):
+        """Reload all devices, or only ``devices``, from PostGIS"""
+        if devices is None:
+            cur.execute(LOAD_SQL)
+        else:
+            cur.execute(LOAD_SQL + "WHERE l.sensor_id = ANY(%s)", (list(devices),))
+        rows = cur.fetchall()
+
+        tags = {} if devices is None else dict(self._tags)
+        points = {} if devices is None else dict(self._points)
+        for device_id in devices or ():
+            # Deleted from sensor_locations, upsert again on the next report
+            tags.pop(device_id, None)
+            points.pop(device_id, None)
+            self._reported.pop(device_id, None)
+        for device_id, lat, lon, fence_id in rows:
+            tags[device_id] = str(fence_id) if fence_id is not None else DEFAULT_LOCATION_ID
+            points[device_id] = (lat, lon)
+        # Swap whole dicts so the decoder never sees a half-updated map
+        self._tags, self._points = tags, points
+        self.reloads += 1
+        if devices is None:
+            logger.info(f"Geo cache loaded {len(rows)} device locations")
+
+    def stats(self):
+        return {
+            'geo_devices': len(self._tags),
+            'geo_reloads': self.reloads,
+            'geo_notifications': self.notifications,
+            'geo_errors': self.errors,
+        }
@@ -0,0 +1,251 @@
+import json
+import logging
+import select
+import threading
+import time
+
+import psycopg2
+from psycopg2 import extras
+
+logger = logging.getLogger('mqtt-bridge')
+
+# NOTIFY payloads must stay under 8000 bytes
+MAX_PAYLOAD = 7900
+
+NOTIFY_SQL = "SELECT pg_notify(%s, %s)"
+
+# Latest row of every series that reported within the lookback, using the
+# (device_id, sensor_type, time DESC) index
+LOAD_SQL = """
+SELECT DISTINCT ON (device_id, sensor_type) device_id, sensor_type, extract(epoch FROM time), value, location_id
+FROM sensor_data
+WHERE time > now() - make_interval(secs => %s)
+ORDER BY device_id, sensor_type, time DESC
+"""
+
+
+def encode_latest(latest):
+    """NOTIFY payloads for {(device_id, sensor_type): (epoch, value, location_id)}, each a
+    JSON list of [device_id, sensor_type, epoch, value, location_id] under MAX_PAYLOAD bytes"""
+    payloads, entries, size = [], [], 2
+    for (device_id, sensor_type), (at, value, location_id) in latest.items():
+        entry = json.dumps([device_id, sensor_type, at, value, location_id], separators=(',', ':'))
+        if entries and size + len(entry) + 1 > MAX_PAYLOAD:
+            payloads.append('[' + ','.join(entries) + ']')
+            entries, size = [], 2
+        entries.append(entry)
+        size += len(entry) + 1
+    if entries:
+        payloads.append('[' + ','.join(entries) + ']')
+    return payloads
+
+
+class LatestNotifier:
+    """Writer stage announcing each series' newest value on commit.
+
+    ``add_rows`` keeps the newest row per (device_id, sensor_type) since
+    the last flush and ``take()`` turns them into ``pg_notify(channel,
+    ...)`` calls in the same transaction as the raw rows, so listeners (the
+    query API's latest-values cache) only hear about committed readings
+    and every bridge replica reaches them through the database.
+    """
+
+    def __init__(self, channel='sensor_latest'):
+        self.channel = channel
+        self.table = f"NOTIFY {channel}"
+        self.row_sql = "SELECT pg_notify($1, $2)"
+
+        self._latest = {}
+        self._ready = []  # (channel, payload) rolled back, to send again
+        self._lock = threading.Lock()
+
+        self.rows_in = 0
+        self.notifications = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a notifier from the query_api section, or None if disabled"""
+        api_config = config.get('query_api', {})
+        if not api_config.get('enabled', False):
+            return None
+        return cls(channel=api_config.get('channel', 'sensor_latest'))
+
+    def add_rows(self, rows):
+        previous = None
+        with self._lock:
+            latest = self._latest
+            for timestamp, device_id, sensor_type, value, location_id in rows:
+                # The rows of one message share their timestamp object
+                if timestamp is not previous:
+                    previous = timestamp
+                    at = timestamp.timestamp()
+                current = latest.get((device_id, sensor_type))
+                if current is None or at >= current[0]:
+                    latest[(device_id, sensor_type)] = (at, value, location_id)
+            self.rows_in += len(rows)
+
+    def take(self, close_all=False):
+        with self._lock:
+            latest, self._latest = self._latest, {}
+            ready, self._ready = self._ready, []
+        return ready + [(self.channel, payload) for payload in encode_latest(latest)]
+
+    def requeue(self, rows):
+        # Stale values are harmless, the cache keeps the newest per series
+        with self._lock:
+            self._ready = rows + self._ready
+
+    def write(self, cur, rows):
+        extras.execute_batch(cur, NOTIFY_SQL, rows, page_size=100)
+
+    def committed(self, rows):
+        self.notifications += len(rows)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'latest_rows_in': self.rows_in,
+                'latest_notifications': self.notifications,
+                'latest_pending_series': len(self._latest),
+            }
+
+
+class LatestValues:
+    """In-memory newest value of every device and sensor type.
+
+    A background thread loads the newest row of every series that reported
+    within ``lookback`` seconds, then LISTENs on ``channel`` for the
+    bridge's LatestNotifier and applies each notification, so reads never
+    touch the database. A full reload every ``refresh_interval`` seconds,
+    and after every reconnect, covers notifications missed meanwhile;
+    series older than the lookback keep their cached value.
+    """
+
+    def __init__(self, connect, channel='sensor_latest', lookback=3600.0, refresh_interval=300.0,
+                 retry_delay=5.0):
+        self.connect = connect
+        self.channel = channel
+        self.lookback = lookback
+        self.refresh_interval = refresh_interval
+        self.retry_delay = retry_delay
+
+        self._devices = {}  # device_id -> {sensor_type: (epoch, value, location_id)}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._loaded = threading.Event()
+        self._thread = None
+
+        self.reloads = 0
+        self.notifications = 0
+        self.errors = 0
+
+    @classmethod
+    def from_config(cls, config, connect):
+        api_config = config.get('query_api', {})
+        latest_config = api_config.get('latest', {})
+        return cls(connect, channel=api_config.get('channel', 'sensor_latest'),
+                   lookback=latest_config.get('lookback_seconds', 3600.0),
+                   refresh_interval=latest_config.get('refresh_interval_seconds', 300.0),
+                   retry_delay=latest_config.get('retry_delay_seconds', 5.0))
+
+    def update(self, entries):
+        """Apply (device_id, sensor_type, epoch, value, location_id) entries, keeping the newest"""
+        with self._lock:
+            devices = self._devices
+            for device_id, sensor_type, at, value, location_id in entries:
+                series = devices.get(device_id)
+                if series is None:
+                    series = devices[device_id] = {}
+                current = series.get(sensor_type)
+                if current is None or at > current[0]:
+                    series[sensor_type] = (at, value, location_id)
+
+    def get(self, devices=None, sensor_type=None):
+        """{device_id: {sensor_type: (epoch, value, location_id)}} for ``devices`` (all if None)"""
+        with self._lock:
+            if devices is None:
+                devices = list(self._devices)
+            result = {}
+            for device_id in devices:
+                series = self._devices.get(device_id)
+                if series is None:
+                    continue
+                if sensor_type is not None:
+                    if sensor_type not in series:
+                        continue
+                    series = {sensor_type: series[sensor_type]}
+                result[device_id] = dict(series)
+        return result
+
+    def wait_loaded(self, timeout=None):
+        return self._loaded.wait(timeout)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='latest-values', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.retry_delay + 1)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            conn = None
+            try:
+                conn = self.connect()
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f"LISTEN {self.channel}")
+                self._reload(cur)
+                self._listen(conn, cur)
+            except psycopg2.Error as e:
+                self.errors += 1
+                logger.error(f"Latest values cache lost its database connection: {e}, "
+                             f"retrying in {self.retry_delay}s")
+                self._stop_event.wait(self.retry_delay)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def _listen(self, conn, cur):
+        last_reload = time.monotonic()
+        while not self._stop_event.is_set():
+            if select.select([conn], [], [], 1.0)[0]:
+                conn.poll()
+            while conn.notifies:
+                notify = conn.notifies.pop(0)
+                self.notifications += 1
+                try:
+                    self.update(json.loads(notify.payload))
+                except (ValueError, TypeError):
+                    logger.warning(f"Ignoring malformed {self.channel} notification")
+            if time.monotonic() - last_reload >= self.refresh_interval:
+                self._reload(cur)
+                last_reload = time.monotonic()
+
+    def _reload(self, cur):
+        start = time.perf_counter()
+        cur.execute(LOAD_SQL, (self.lookback,))
+        rows = cur.fetchall()
+        self.update((device_id, sensor_type, float(at), value, location_id)
+                    for device_id, sensor_type, at, value, location_id in rows)
+        self.reloads += 1
+        self._loaded.set()
+        logger.info(f"Latest values cache loaded {len(rows)} series in {time.perf_counter() - start:.2f}s")
+
+    def stats(self):
+        with self._lock:
+            series = sum(len(series) for series in self._devices.values())
+            devices = len(self._devices)
+        return {
+            'latest_devices': devices,
+            'latest_series': series,
+            'latest_reloads': self.reloads,
+            'latest_notifications_received': self.notifications,
+            'latest_errors': self.errors,
+        }
@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+"""Deterministic load generator for capacity planning.
+
+Simulates a fleet of devices with NumPy: each sensor value is a per-device
+baseline plus a diurnal curve plus a mean-reverting random walk, and
+motion comes in bursts. All randomness comes from one seeded generator
+and the simulation advances in fixed ticks of simulated time, so the same
+seed always produces the same data however fast the target keeps up.
+Readings are spread evenly over each device's reporting period and sent
+either straight to the database through the bridge's batch writer or to
+an MQTT broker as Pi-style messages.
+
+Runs as the bridge's development mode (``bridge.mode: development``, see
+the ``development`` config section) or standalone:
+
+    python3 loadgen.py --devices 10000 --rate 5000 --target db --duration 60
+    python3 loadgen.py --devices 10000 --rate 2000 --target mqtt --broker localhost:1883
+"""
+import argparse
+import collections
+import datetime
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger('mqtt-bridge')
+
+SENSORS = ('temperature', 'humidity', 'pressure')
+
+# Per sensor: baseline mean and spread across devices, diurnal amplitude
+# range, and random walk volatility per sqrt(second)
+PROFILES = {
+    'temperature': {'mean': 21.0, 'spread': 2.0, 'amplitude': (1.0, 4.0), 'volatility': 0.01},
+    'humidity': {'mean': 45.0, 'spread': 8.0, 'amplitude': (-10.0, -3.0), 'volatility': 0.05},
+    'pressure': {'mean': 1005.0, 'spread': 6.0, 'amplitude': (0.5, 2.0), 'volatility': 0.005},
+}
+
+# Random walks revert to the baseline over about an hour
+WALK_REVERSION = 1 / 3600.0
+# Temperature peaks mid-afternoon, humidity (negative amplitude) troughs then
+DIURNAL_PEAK_HOUR = 15
+# Motion: bursts start motion_per_hour times per hour, last ~60s and
+# trigger the PIR about every 5s while they last
+BURST_SECONDS = 60.0
+BURST_EVENT_RATE = 0.2
+
+
+class Fleet:
+    """Vectorized state for ``devices`` simulated devices"""
+
+    def __init__(self, devices, seed=0, motion_per_hour=4.0, prefix='sim'):
+        self.rng = np.random.default_rng(seed)
+        self.size = devices
+        self.ids = [f"{prefix}{i:05d}" for i in range(devices)]
+        self.motion_per_hour = motion_per_hour
+
+        self.base = {}
+        self.amplitude = {}
+        self.walk = {}
+        for sensor in SENSORS:
+            profile = PROFILES[sensor]
+            self.base[sensor] = self.rng.normal(profile['mean'], profile['spread'], devices)
+            self.amplitude[sensor] = self.rng.uniform(*profile['amplitude'], devices)
+            self.walk[sensor] = np.zeros(devices)
+        # Devices are spread over a few time zones
+        self.phase = self.rng.uniform(-3, 3, devices) * 3600.0
+        self.in_burst = np.zeros(devices, dtype=bool)
+
+    def __len__(self):
+        return self.size
+
+    def advance(self, dt):
+        """Step the random walks and motion bursts forward by ``dt`` seconds.
+        Returns the indices of devices whose PIR fired during the step."""
+        for sensor in SENSORS:
+            walk = self.walk[sensor]
+            walk -= WALK_REVERSION * walk * dt
+            walk += self.rng.normal(0.0, PROFILES[sensor]['volatility'] * math.sqrt(dt), self.size)
+
+        starts = self.rng.random(self.size) < self.motion_per_hour / 3600.0 * dt
+        ends = self.rng.random(self.size) < dt / BURST_SECONDS
+        self.in_burst = (self.in_burst & ~ends) | starts
+        fired = self.in_burst & (self.rng.random(self.size) < BURST_EVENT_RATE * dt)
+        return np.nonzero(fired)[0]
+
+    def values(self, index, timestamps):
+        """Sensor values for the devices in ``index`` at epoch ``timestamps``"""
+        local = timestamps + self.phase[index]
+        diurnal = np.sin(2 * math.pi * ((local % 86400.0) / 86400.0 - (DIURNAL_PEAK_HOUR - 6) / 24.0))
+        return {sensor: self.base[sensor][index] + self.amplitude[sensor][index] * diurnal + self.walk[sensor][index]
+                for sensor in SENSORS}
+
+
+class LatencyRecorder:
+    """Thread-safe window of latency samples in seconds"""
+
+    def __init__(self, window=100000):
+        self.samples = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, latencies):
+        with self._lock:
+            self.samples.extend(latencies)
+
+    def percentiles(self, *points):
+        with self._lock:
+            ordered = sorted(self.samples)
+        if not ordered:
+            return [None] * len(points)
+        return [ordered[min(int(len(ordered) * p), len(ordered) - 1)] for p in points]
+
+
+class DatabaseTarget:
+    """Writes readings as narrow rows through the configured batch writer.
+    Latency is from a reading's scheduled time to its batch committing."""
+
+    def __init__(self, config, connect, latency, time_offset=0.0):
+        from wide_schema import writer_class
+
+        self.conn = connect()
+        self.writer = writer_class(config).from_config(self.conn, config)
+        self.writer.on_flush = self._on_flush
+        self.writer.start()
+        self.latency = latency
+        self.time_offset = time_offset
+
+    def _on_flush(self, rows):
+        now = time.time()
+        step = max(len(rows) // 200, 1)
+        self.latency.add([now - (row[0].timestamp() + self.time_offset) for row in rows[::step]])
+
+    def send(self, kind, device_ids, timestamps, values):
+        times = [datetime.datetime.fromtimestamp(ts, tz=datetime.timezone.utc) for ts in timestamps.tolist()]
+        rows = []
+        for sensor in SENSORS:
+            rows.extend(zip(times, device_ids, [sensor] * len(times), values[sensor].tolist(),
+                            ['default'] * len(times)))
+        self.writer.add_rows(rows)
+
+    def close(self):
+        try:
+            self.writer.close()
+        finally:
+            self.conn.close()
+
+    def stats(self):
+        return {'rows_written': self.writer.stats()['rows_written']}
+
+
+class MQTTTarget:
+    """Publishes each reading as a Pi-style JSON message to
+    sensors/{device_id}/data (or /motion). Latency is from a reading's
+    scheduled time to the broker's PUBACK (QoS 1) or the send (QoS 0)."""
+
+    def __init__(self, config, latency, time_offset=0.0):
+        from paho.mqtt import client as mqtt_client
+        from subscriber import broker_settings
+
+        settings = broker_settings(config)
+        self.qos = config.get('bridge', {}).get('qos', 1)
+        self.latency = latency
+        self.time_offset = time_offset
+        self._sent = {}
+        self._acked_early = set()
+        self._lock = threading.Lock()
+        self._connected = threading.Event()
+        self.published = 0
+
+        self.client = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2,
+                                         client_id=f"loadgen-{os.getpid()}", protocol=mqtt_client.MQTTv5)
+        if settings['tls']:
+            self.client.tls_set(ca_certs=settings['ca_certs'], certfile=settings['certfile'],
+                                keyfile=settings['keyfile'])
+        self.client.max_inflight_messages_set(1000)
+        self.client.max_queued_messages_set(0)
+        self.client.on_connect = self._on_connect
+        self.client.on_publish = self._on_publish
+        self.client.connect(settings['host'], settings['port'], keepalive=settings['keepalive'])
+        self.client.loop_start()
+        if not self._connected.wait(10):
+            self.client.loop_stop()
+            raise ConnectionError(f"No CONNACK from MQTT broker {settings['host']}:{settings['port']}")
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties=None):
+        if reason_code.is_failure:
+            logger.error(f"MQTT broker refused load generator connection: {reason_code}")
+        else:
+            self._connected.set()
+
+    def _on_publish(self, client, userdata, mid, reason_code=None, properties=None):
+        with self._lock:
+            scheduled = self._sent.pop(mid, None)
+            if scheduled is None:
+                # PUBACK arrived before send() recorded the message
+                self._acked_early.add(mid)
+        if scheduled is not None:
+            self.latency.add([time.time() - scheduled])
+
+    def send(self, kind, device_ids, timestamps, values):
+        columns = [values[sensor].tolist() for sensor in SENSORS]
+        for i, (device_id, ts) in enumerate(zip(device_ids, timestamps.tolist())):
+            message = {
+                'timestamp': ts,
+                'event': 'motion_detected' if kind == 'motion' else 'regular_reading',
+                'sensor_data': {
+                    'temperature_c': round(columns[0][i], 2),
+                    'humidity': round(columns[1][i], 2),
+                    'pressure_hpa': round(columns[2][i], 2),
+                },
+            }
+            info = self.client.publish(f"sensors/{device_id}/{kind}", json.dumps(message), qos=self.qos)
+            self.published += 1
+            if self.qos:
+                with self._lock:
+                    if info.mid in self._acked_early:
+                        self._acked_early.discard(info.mid)
+                        self.latency.add([time.time() - (ts + self.time_offset)])
+                    else:
+                        self._sent[info.mid] = ts + self.time_offset
+            else:
+                self.latency.add([time.time() - (ts + self.time_offset)])
+
+    def close(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+    def stats(self):
+        with self._lock:
+            unacked = len(self._sent)
+        return {'published': self.published, 'unacked': unacked}
+
+
+class LoadGenerator:
+    """Drives a Fleet against a target at ``rate`` readings per second.
+
+    Simulated time advances in ``tick`` second steps. In real time, each
+    step waits for the wall clock; if the target cannot keep up the steps
+    run back to back and the gap between wall clock and simulated time is
+    reported as lag. ``start`` pins the simulated timestamps (epoch seconds)
+    for a fully reproducible dataset; by default they follow the wall clock.
+    """
+
+    def __init__(self, fleet, rate, tick=0.1, start=None, duration=None, report_interval=10):
+        self.fleet = fleet
+        self.rate = rate
+        self.tick = tick
+        self.start = start
+        self.duration = duration
+        self.report_interval = report_interval
+        self.latency = LatencyRecorder()
+        self._stop = threading.Event()
+
+        self.wall_start = None
+        self.readings = 0
+        self.motion_events = 0
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+    @property
+    def time_offset(self):
+        """Seconds to add to a simulated timestamp to get its scheduled wall time"""
+        if self.start is None:
+            return 0.0
+        return self.wall_start - self.start
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self, target):
+        fleet = self.fleet
+        period = len(fleet) / self.rate
+        # Spread the devices evenly over their reporting period
+        next_due = fleet.rng.uniform(0.0, period, len(fleet))
+        sim_origin = self.start if self.start is not None else self.wall_start
+        last_report = time.monotonic()
+        report_readings = 0
+        step = 0
+
+        while not self._stop.is_set():
+            sim_end = (step + 1) * self.tick
+            if self.duration is not None and sim_end > self.duration:
+                break
+            delay = self.wall_start + sim_end - time.time()
+            if delay > 0:
+                self._stop.wait(delay)
+            self.lag = max(-delay, 0.0)
+            self.max_lag = max(self.max_lag, self.lag)
+
+            fired = fleet.advance(self.tick)
+            while True:
+                due = np.nonzero(next_due < sim_end)[0]
+                if not due.size:
+                    break
+                times = sim_origin + next_due[due]
+                target.send('data', [fleet.ids[i] for i in due], times, fleet.values(due, times))
+                next_due[due] += period
+                self.readings += due.size
+                report_readings += due.size
+            if fired.size:
+                times = np.full(fired.size, sim_origin + sim_end)
+                target.send('motion', [fleet.ids[i] for i in fired], times, fleet.values(fired, times))
+                self.motion_events += fired.size
+
+            step += 1
+            now = time.monotonic()
+            if now - last_report >= self.report_interval:
+                self.log_report(report_readings / (now - last_report), target)
+                last_report, report_readings = now, 0
+
+    def log_report(self, achieved, target):
+        p50, p95, p99 = self.latency.percentiles(0.5, 0.95, 0.99)
+        latency = (f"latency p50={p50 * 1000:.0f}ms p95={p95 * 1000:.0f}ms p99={p99 * 1000:.0f}ms"
+                   if p50 is not None else "latency n/a")
+        logger.info(f"Load: {achieved:.0f}/{self.rate:.0f} readings/s, lag {self.lag:.2f}s "
+                    f"(max {self.max_lag:.2f}s), {latency}, motion {self.motion_events}, {target.stats()}")
+
+    def summary(self, elapsed):
+        p50, p95, p99 = self.latency.percentiles(0.5, 0.95, 0.99)
+        return {
+            'devices': len(self.fleet),
+            'target_rate': self.rate,
+            'achieved_rate': self.readings / elapsed if elapsed > 0 else 0.0,
+            'readings': self.readings,
+            'motion_events': self.motion_events,
+            'max_lag_s': self.max_lag,
+            'latency_p50_ms': p50 * 1000 if p50 is not None else None,
+            'latency_p95_ms': p95 * 1000 if p95 is not None else None,
+            'latency_p99_ms': p99 * 1000 if p99 is not None else None,
+        }
+
+    def execute(self, make_target):
+        """Create the target, run until the duration ends or stop(), return a summary"""
+        self.wall_start = time.time()
+        target = make_target(self.latency, self.time_offset)
+        try:
+            self.run(target)
+        finally:
+            target.close()
+        elapsed = time.time() - self.wall_start
+        self.log_report(self.readings / elapsed if elapsed > 0 else 0.0, target)
+        return self.summary(elapsed)
+
+
+def from_config(config, connect=None):
+    """Build a generator and target factory from the ``development`` config section"""
+    dev_config = config.get('development', {})
+    fleet = Fleet(
+        dev_config.get('devices', 100),
+        seed=dev_config.get('seed', 0),
+        motion_per_hour=dev_config.get('motion_events_per_hour', 4.0),
+        prefix=dev_config.get('device_prefix', 'sim'),
+    )
+    generator = LoadGenerator(
+        fleet,
+        rate=dev_config.get('rate_per_second', 10),
+        tick=dev_config.get('tick_seconds', 0.1),
+        duration=dev_config.get('duration_seconds'),
+        report_interval=dev_config.get('report_interval_seconds', 30),
+    )
+
+    if dev_config.get('target', 'database') == 'mqtt':
+        def make_target(latency, offset):
+            return MQTTTarget(config, latency, offset)
+    else:
+        def make_target(latency, offset):
+            return DatabaseTarget(config, connect, latency, offset)
+    return generator, make_target
+
+
+def run(config, connect):
+    generator, make_target = from_config(config, connect)
+    dev_config = config.get('development', {})
+    logger.info(f"Simulating {len(generator.fleet)} devices at {generator.rate} readings/s "
+                f"into {dev_config.get('target', 'database')} (seed {dev_config.get('seed', 0)})")
+    try:
+        return generator.execute(make_target)
+    except KeyboardInterrupt:
+        logger.info("Load generator stopped by user")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default=os.environ.get('CONFIG_PATH'), help="Bridge config.yaml for database/broker settings")
+    parser.add_argument('--devices', type=int, default=10000)
+    parser.add_argument('--rate', type=float, default=1000, help="Readings per second across the fleet")
+    parser.add_argument('--target', choices=('db', 'mqtt'), default='db')
+    parser.add_argument('--broker', help="host:port of a plain MQTT broker, overrides the config")
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--motion-per-hour', type=float, default=4.0)
+    parser.add_argument('--start', help="Pin simulated timestamps to start at this ISO time (UTC)")
+    parser.add_argument('--report-interval', type=float, default=10)
+    parser.add_argument('--json', action='store_true', help="Print the summary as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    config = {}
+    if args.config and os.path.exists(args.config):
+        import yaml
+        with open(args.config) as f:
+            config = yaml.safe_load(f) or {}
+    if args.broker:
+        host, _, port = args.broker.partition(':')
+        config.setdefault('bridge', {})['broker'] = {'host': host, 'port': int(port or 1883), 'tls': False}
+    config['development'] = {
+        'devices': args.devices,
+        'rate_per_second': args.rate,
+        'target': 'mqtt' if args.target == 'mqtt' else 'database',
+        'duration_seconds': args.duration,
+        'seed': args.seed,
+        'motion_events_per_hour': args.motion_per_hour,
+        'report_interval_seconds': args.report_interval,
+    }
+
+    def connect():
+        import psycopg2
+        db_config = config.get('database', {})
+        return psycopg2.connect(
+            host=os.environ.get('DB_HOST', db_config.get('host', 'localhost')),
+            port=int(os.environ.get('DB_PORT', db_config.get('port', 5432))),
+            dbname=os.environ.get('DB_NAME', db_config.get('name', 'sensor_data')),
+            user=os.environ.get('DB_USER', 'postgres'),
+            password=os.environ.get('DB_PASSWORD', 'postgres'),
+        )
+
+    generator, make_target = from_config(config, connect)
+    if args.start:
+        start = datetime.datetime.fromisoformat(args.start)
+        if start.tzinfo is None:
+            start = start.replace(tzinfo=datetime.timezone.utc)
+        generator.start = start.timestamp()
+
+    summary = generator.execute(make_target)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        for key, value in summary.items():
+            print(f"{key + ':':<18} {value:.2f}" if isinstance(value, float) else f"{key + ':':<18} {value}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,211 @@
+import contextlib
+import logging
+
+try:
+    import prometheus_client
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+except ImportError:
+    prometheus_client = None
+
+logger = logging.getLogger('mqtt-bridge')
+
+DEFAULT_PORT = 9108
+
+DECODE_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01)
+FLUSH_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+BATCH_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+RULES_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+# Pipeline stats() keys exported at scrape time
+COUNTERS = {
+    'messages_received': 'MQTT messages handed to the pipeline',
+    'messages_enqueued': 'Messages whose rows were queued for the database',
+    'backpressure_waits': 'Times the network thread waited on a full queue',
+    'rows_written': 'Rows committed to the database',
+    'flushes': 'Batches committed to the database',
+    'dedup_checked': 'Messages checked against the dedup window',
+    'duplicates_dropped': 'Duplicate messages dropped before decoding into rows',
+    'rows_duplicate': 'Rows the database ignored because they already existed',
+    'rows_dropped': 'Rows dropped because the database rejected them or the writer buffer was full',
+    'geo_reloads': 'Geo cache reloads from PostGIS',
+    'geo_notifications': 'Change notifications received from PostGIS',
+    'rollup_rows_in': 'Rows folded into rollup windows',
+    'rollup_rows_late': 'Rows that arrived after their rollup window was written',
+    'rollup_rows_written': 'Rollup rows upserted into the rollup table',
+    'alerts_rows_checked': 'Rows evaluated by the alert rules',
+    'alerts_raised': 'Alerts raised by the alert rules',
+    'alerts_written': 'Alerts inserted into the alerts table',
+    'latest_notifications': 'Latest-value notifications sent to the query API',
+    'latest_notifications_received': 'Latest-value notifications applied by the query API',
+    'latest_reloads': 'Full reloads of the query API latest-values cache',
+    'query_requests': 'Query API requests answered',
+    'query_db_queries': 'Database queries made by the query API',
+    'query_db_seconds': 'Seconds spent in query API database queries',
+    'query_cache_hits': 'Query API requests answered from the cache',
+    'query_cache_misses': 'Query API requests that had to be loaded',
+    'query_cache_waits': 'Query API requests that waited for the same query in flight',
+    'query_cache_evictions': 'Query API cache entries evicted to stay under max_entries',
+    'config_reloads': 'Changed config files applied without a restart',
+}
+ERROR_TYPES = {
+    'decode_errors': 'decode',
+    'messages_dropped': 'queue_full',
+    'flush_errors': 'flush',
+    'connect_errors': 'db_connect',
+    'geo_errors': 'geo',
+    'query_errors': 'query',
+    'latest_errors': 'latest',
+    'config_errors': 'config',
+}
+GAUGES = {
+    'queue_depth': 'Messages waiting for a DB writer',
+    'queue_capacity': 'Maximum messages the queues hold',
+    'max_queue_depth': 'Highest queue depth seen',
+    'rows_pending': 'Rows buffered in writers, not yet committed',
+    'workers_connected': 'DB writer workers with a database connection',
+    'inflight_batches': 'Batches being written concurrently',
+    'dedup_streams': 'Device boot sessions tracked by the deduplicator',
+    'dedup_hit_rate': 'Fraction of checked messages that were duplicates',
+    'geo_devices': 'Devices with a known location in the geo cache',
+    'rollup_open_series': 'Device/sensor series in rollup windows not yet closed',
+    'rollup_pending_rows': 'Closed rollup rows waiting to be written',
+    'alerts_pending': 'Alerts waiting to be written',
+    'alerts_series': 'Device/sensor series with alert rule state',
+    'latest_pending_series': 'Series with a latest value not yet notified',
+    'latest_series': 'Device/sensor series in the query API latest-values cache',
+    'query_cache_entries': 'Entries in the query API cache',
+    'config_last_reload_seconds': 'Time to validate and apply the last changed config file',
+}
+# Per-sink stats under stats()['sinks'], labelled by sink name
+SINK_COUNTERS = {
+    'enqueued': 'Messages queued for the sink',
+    'dropped': 'Messages dropped because the sink queue was full',
+    'rows_written': 'Rows committed by the sink',
+    'flushes': 'Batches committed by the sink',
+    'flush_errors': 'Failed sink batches',
+    'rows_dropped': 'Rows the sink dropped because the database rejected them or its buffer was full',
+    'connect_errors': 'Failed sink connection attempts',
+}
+SINK_GAUGES = {
+    'queue_depth': 'Messages waiting in the sink queue',
+    'rows_pending': 'Rows buffered by the sink, not yet committed',
+    'lag_seconds': 'Age of the oldest message the sink has not committed',
+    'workers_connected': 'Sink workers with a database connection',
+}
+
+
+class _Disabled:
+    """Stands in for a histogram when prometheus_client is not installed"""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+
+def _histogram(name, documentation, buckets, labelnames=()):
+    if prometheus_client is None:
+        return _Disabled()
+    return prometheus_client.Histogram(name, documentation, labelnames, buckets=buckets)
+
+
+# Observed on the hot path; everything else is read from stats() when scraped
+DECODE_SECONDS = _histogram('mqtt_bridge_decode_seconds', 'Time to decode one MQTT message', DECODE_BUCKETS)
+FLUSH_SECONDS = _histogram('mqtt_bridge_flush_seconds', 'Time to write and commit one batch',
+                           FLUSH_BUCKETS, ['table'])
+BATCH_ROWS = _histogram('mqtt_bridge_batch_rows', 'Rows per committed batch', BATCH_BUCKETS, ['table'])
+RULES_SECONDS = _histogram('mqtt_bridge_rules_seconds', 'Time to evaluate the alert rules over one batch',
+                           RULES_BUCKETS)
+
+
+class StatsCollector:
+    """Prometheus collector exporting a ``stats()`` dict on every scrape.
+
+    The pipeline keeps its counters anyway for the periodic log line, so
+    exposing them this way adds nothing per message.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def collect(self):
+        stats = self.stats()
+        for key, documentation in COUNTERS.items():
+            if key in stats:
+                yield CounterMetricFamily(f"mqtt_bridge_{key}", documentation, value=stats[key])
+
+        errors = CounterMetricFamily('mqtt_bridge_errors', 'Errors by type', labels=['type'])
+        for key, error_type in ERROR_TYPES.items():
+            if key in stats:
+                errors.add_metric([error_type], stats[key])
+        yield errors
+
+        for key, documentation in GAUGES.items():
+            if key in stats:
+                yield GaugeMetricFamily(f"mqtt_bridge_{key}", documentation, value=stats[key])
+
+        sinks = stats.get('sinks', {})
+        for families, family_class in ((SINK_COUNTERS, CounterMetricFamily), (SINK_GAUGES, GaugeMetricFamily)):
+            for key, documentation in families.items():
+                family = family_class(f"mqtt_bridge_sink_{key}", documentation, labels=['sink'])
+                for name, sink_stats in sinks.items():
+                    family.add_metric([name], sink_stats[key])
+                yield family
+
+
+def serve(config, stats):
+    """Expose /metrics on ``bridge.metrics.port`` unless disabled.
+    Returns True if the endpoint was started."""
+    metrics_config = config.get('bridge', {}).get('metrics', {})
+    if not metrics_config.get('enabled', True):
+        return False
+    if prometheus_client is None:
+        logger.warning("prometheus_client is not installed, /metrics disabled")
+        return False
+
+    port = metrics_config.get('port', DEFAULT_PORT)
+    prometheus_client.REGISTRY.register(StatsCollector(stats))
+    prometheus_client.start_http_server(port)
+    logger.info(f"Serving Prometheus metrics on :{port}/metrics")
+    return True
+
+
+_tracer = None
+
+
+def setup_tracing(config):
+    """Export an OpenTelemetry span per DB batch when ``bridge.tracing.enabled``.
+
+    Spans go to the OTLP endpoint from the standard OTEL_EXPORTER_OTLP_*
+    environment variables. Needs opentelemetry-sdk and
+    opentelemetry-exporter-otlp, which the image does not install by default.
+    """
+    global _tracer
+    tracing_config = config.get('bridge', {}).get('tracing', {})
+    if not tracing_config.get('enabled', False):
+        return False
+    try:
+        from opentelemetry import trace
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        logger.warning("opentelemetry-sdk/opentelemetry-exporter-otlp not installed, tracing disabled")
+        return False
+
+    provider = TracerProvider(resource=Resource.create({
+        'service.name': tracing_config.get('service_name', 'mqtt-bridge')}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    _tracer = trace.get_tracer('mqtt-bridge')
+    logger.info("OpenTelemetry tracing enabled")
+    return True
+
+
+def span(name, **attributes):
+    """Context manager for a tracing span, a no-op unless tracing is set up"""
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.start_as_current_span(name, attributes=attributes)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""Migrate the narrow sensor_data hypertable to the wide sensor_readings layout.
+
+Copies existing rows into sensor_readings one time window at a time, then,
+in a single transaction holding a lock on sensor_data, copies anything that
+arrived since, renames the narrow table to sensor_data_narrow, and replaces
+it with a compatibility view of the same name. Grafana queries and scripts
+that insert into sensor_data keep working against the view.
+
+Run inside the bridge pod (or with DB_HOST/DB_USER/DB_PASSWORD set):
+
+    python3 /app/migrate_wide.py --window '1 day'
+    python3 /app/migrate_wide.py --no-swap   # backfill only, swap later
+
+Afterwards set database.layout to "wide" in the bridge config.
+"""
+import argparse
+import datetime
+import logging
+import os
+import sys
+import time
+
+import psycopg2
+
+from wide_schema import COMPAT_VIEW_SQL, ensure_wide_schema
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s'
+)
+logger = logging.getLogger('mqtt-bridge')
+
+REGISTER_DEVICES_SQL = """
+INSERT INTO devices (device_id)
+SELECT DISTINCT device_id FROM sensor_data WHERE device_id IS NOT NULL AND time >= %s AND time < %s
+ON CONFLICT (device_id) DO NOTHING
+"""
+
+# Rows sharing (time, device_id, location_id) came from the same reading
+COPY_WINDOW_SQL = """
+INSERT INTO sensor_readings (time, device_key, temperature, humidity, pressure, altitude, volume, location_id)
+SELECT n.time, d.device_key,
+  max(n.value) FILTER (WHERE n.sensor_type = 'temperature'),
+  max(n.value) FILTER (WHERE n.sensor_type = 'humidity'),
+  max(n.value) FILTER (WHERE n.sensor_type = 'pressure'),
+  max(n.value) FILTER (WHERE n.sensor_type = 'altitude'),
+  max(n.value) FILTER (WHERE n.sensor_type = 'volume'),
+  n.location_id
+FROM sensor_data n
+JOIN devices d ON d.device_id = n.device_id
+WHERE n.time >= %s AND n.time < %s
+GROUP BY n.time, d.device_key, n.location_id
+"""
+
+
+def is_view(cur, name):
+    cur.execute("SELECT 1 FROM information_schema.views WHERE table_name = %s", (name,))
+    return cur.fetchone() is not None
+
+
+def copy_window(cur, start, end):
+    cur.execute(REGISTER_DEVICES_SQL, (start, end))
+    cur.execute(COPY_WINDOW_SQL, (start, end))
+    return cur.rowcount
+
+
+def backfill(conn, window):
+    """Copy narrow rows into sensor_readings window by window, returns the end time reached"""
+    cur = conn.cursor()
+    cur.execute("SELECT min(time), max(time) FROM sensor_data")
+    first, last = cur.fetchone()
+    if first is None:
+        logger.info("sensor_data is empty, nothing to backfill")
+        cur.close()
+        return None
+
+    # Resume after whatever an earlier, interrupted run already copied
+    cur.execute("SELECT max(time) FROM sensor_readings")
+    resume = cur.fetchone()[0]
+    if resume is not None:
+        cur.execute("DELETE FROM sensor_readings WHERE time = %s", (resume,))
+        first = resume
+        logger.info(f"Resuming backfill from {resume}")
+
+    start = first
+    total = 0
+    started = time.perf_counter()
+    while start <= last:
+        cur.execute("SELECT %s::timestamptz + %s::interval", (start, window))
+        end = cur.fetchone()[0]
+        copied = copy_window(cur, start, end)
+        conn.commit()
+        total += copied
+        logger.info(f"Copied {copied} readings from {start} to {end} ({total} total)")
+        start = end
+
+    elapsed = time.perf_counter() - started
+    logger.info(f"Backfilled {total} readings in {elapsed:.1f}s")
+    cur.close()
+    return start
+
+
+def warn_about_aggregates(cur):
+    # Continuous aggregates follow the renamed table, so they stop seeing new data
+    cur.execute("SELECT view_name FROM timescaledb_information.continuous_aggregates "
+                "WHERE hypertable_name = 'sensor_data'")
+    views = [row[0] for row in cur.fetchall()]
+    if views:
+        logger.warning(f"Continuous aggregates {', '.join(views)} are defined on sensor_data and will only "
+                       f"cover sensor_data_narrow after the swap, recreate them on sensor_readings")
+
+
+def swap(conn, since):
+    """Copy the tail, rename sensor_data and create the compatibility view atomically"""
+    cur = conn.cursor()
+    warn_about_aggregates(cur)
+    cur.execute("LOCK TABLE sensor_data IN EXCLUSIVE MODE")
+    if since is not None:
+        cur.execute("SELECT max(time) FROM sensor_data")
+        last = cur.fetchone()[0]
+        if last is not None and last >= since:
+            copied = copy_window(cur, since, last + datetime.timedelta(microseconds=1))
+            logger.info(f"Copied {copied} readings that arrived during the backfill")
+    cur.execute("ALTER TABLE sensor_data RENAME TO sensor_data_narrow")
+    cur.execute(COMPAT_VIEW_SQL)
+    conn.commit()
+    cur.close()
+    logger.info("sensor_data is now a view over sensor_readings, "
+                "the original table was kept as sensor_data_narrow")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--window', default='1 day', help="Time window copied per transaction")
+    parser.add_argument('--no-swap', action='store_true', help="Only backfill, leave sensor_data as a table")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(
+        host=os.environ.get('DB_HOST', 'timescaledb'),
+        port=int(os.environ.get('DB_PORT', 5432)),
+        dbname=os.environ.get('DB_NAME', 'sensor_data'),
+        user=os.environ.get('DB_USER', 'postgres'),
+        password=os.environ.get('DB_PASSWORD', 'postgres'),
+    )
+    try:
+        cur = conn.cursor()
+        if is_view(cur, 'sensor_data'):
+            logger.info("sensor_data is already a compatibility view, nothing to do")
+            return 0
+        cur.close()
+
+        ensure_wide_schema(conn)
+        reached = backfill(conn, args.window)
+        if not args.no_swap:
+            swap(conn, reached)
+    except Exception as e:
+        logger.error(f"Migration failed: {e}")
+        conn.rollback()
+        return 1
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
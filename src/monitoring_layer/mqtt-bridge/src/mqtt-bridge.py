@@ -4,12 +4,17 @@ import traceback
 import json
 import os
 import time
-import yaml
 import logging
-import random
 import datetime
 import psycopg2
 from psycopg2 import extras
+import metrics
+from config_file import ConfigWatcher, load_config, reload_plan, set_log_level
+from pipeline import IngestPipeline
+from rollup import ensure_rollup_schema
+from rules import ensure_alert_schema
+from subscriber import MQTTSubscriber
+from wide_schema import ensure_wide_schema
 
 # Logging configuration
 logging.basicConfig(
@@ -18,17 +23,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger('mqtt-bridge')
 
-# Load configuration
-def load_config():
-    config_path = os.environ.get('CONFIG_PATH', '/app/config/config.yaml')
-    try:
-        with open(config_path, 'r') as f:
-            config = yaml.safe_load(f)
-        return config
-    except Exception as e:
-        logger.error(f"Error loading configuration: {e}")
-        raise
-
 # Database connection
 def get_db_connection(config):
     try:
@@ -51,6 +45,29 @@ def get_db_connection(config):
         logger.error(f"Database connection error: {e}")
         raise
 
+# Create the wide-layout tables when database.layout is "wide", the
+# rollup table when database.rollup is enabled and the alerts table when
+# alerts are enabled
+def prepare_schema(config):
+    wide = config.get('database', {}).get('layout', 'narrow') == 'wide'
+    rollup_config = config.get('database', {}).get('rollup', {})
+    alerts_config = config.get('alerts', {})
+    if not wide and not rollup_config.get('enabled', False) and not alerts_config.get('enabled', False):
+        return
+    conn = get_db_connection(config)
+    try:
+        if wide:
+            ensure_wide_schema(conn)
+            logger.info("Using wide sensor_readings layout")
+        if rollup_config.get('enabled', False):
+            ensure_rollup_schema(conn, rollup_config.get('table', 'sensor_rollup_1m'))
+            logger.info(f"Writing rollups to {rollup_config.get('table', 'sensor_rollup_1m')}")
+        if alerts_config.get('enabled', False):
+            ensure_alert_schema(conn, alerts_config.get('table', 'alerts'))
+            logger.info(f"Writing alerts to {alerts_config.get('table', 'alerts')}")
+    finally:
+        conn.close()
+
 # Insert sensor data
 def insert_sensor_data(conn, sensor_id, temperature, humidity, pressure, timestamp=None):
     if timestamp is None:
@@ -80,7 +97,7 @@ def insert_sensor_data(conn, sensor_id, temperature, humidity, pressure, timesta
         conn.commit()
         cur.close()
         
-        logger.info(f"Inserted data for sensor {sensor_id}: temp={temperature:.1f}, humidity={humidity:.1f}, pressure={pressure:.1f}")
+        logger.debug(f"Inserted data for sensor {sensor_id}: temp={temperature:.1f}, humidity={humidity:.1f}, pressure={pressure:.1f}")
     except Exception as e:
         logger.error(f"Error inserting sensor data for {sensor_id}: {e}")
         conn.rollback()
@@ -88,63 +105,64 @@ def insert_sensor_data(conn, sensor_id, temperature, humidity, pressure, timesta
 
 # Development mode data generation
 def development_mode(config):
-    dev_config = config.get('development', {})
-    interval = dev_config.get('sample_interval_seconds', 10)
-    sensors = dev_config.get('sample_sensors', [])
+    # Simulated fleet from loadgen.py, sized by the development config section
+    import loadgen
     
-    # Ensure some default sensors if none are configured
-    if not sensors:
-        sensors = [
-            {
-                "id": "sensor001", 
-                "temperature_min": 18.0, 
-                "temperature_max": 28.0,
-                "humidity_min": 30.0, 
-                "humidity_max": 80.0,
-                "pressure_min": 980.0, 
-                "pressure_max": 1020.0
-            },
-            {
-                "id": "sensor002", 
-                "temperature_min": 20.0, 
-                "temperature_max": 25.0,
-                "humidity_min": 40.0, 
-                "humidity_max": 70.0,
-                "pressure_min": 990.0, 
-                "pressure_max": 1010.0
-            }
-        ]
+    prepare_schema(config)
+    loadgen.run(config, lambda: get_db_connection(config))
+
+# Apply a changed config file to the running pipeline and subscriber.
+# Settings that need a restart are only reported.
+def apply_config(old, new, pipeline, subscriber):
+    plan = reload_plan(old, new)
+    if plan['restart']:
+        logger.warning(f"Config changed, restart the bridge to apply: {', '.join(plan['restart'])}")
+    if not plan['live'] and not plan['rebuild']:
+        return
+    logger.info(f"Applying changed config: {', '.join(plan['live'] + plan['rebuild'])}")
+    set_log_level(new)
+    if plan['rebuild']:
+        # Rollups or alerts may have just been enabled
+        prepare_schema(new)
+    pipeline.reconfigure(new, rebuild=bool(plan['rebuild']))
+    subscriber.set_topics(new)
+
+# Production mode: MQTT subscriber feeding the ingest pipeline
+def production_mode(config):
+    prepare_schema(config)
     
-    # Establish database connection once
-    conn = get_db_connection(config)
+    subscriber = None
+    # Alerts are only raised once messages arrive, after the subscriber exists
+    pipeline = IngestPipeline.from_config(config, lambda: get_db_connection(config),
+                                          publish_alerts=lambda messages: subscriber.publish(messages))
+    pipeline.start()
+    metrics.setup_tracing(config)
+    
+    subscriber = MQTTSubscriber(config, pipeline.submit)
+    watcher = ConfigWatcher.from_config(config, lambda old, new: apply_config(old, new, pipeline, subscriber))
+    if watcher is None:
+        metrics.serve(config, pipeline.stats)
+    else:
+        metrics.serve(config, lambda: dict(pipeline.stats(), **watcher.stats()))
     
     try:
-        logger.info(f"Starting development mode with {len(sensors)} simulated sensors")
-        logger.info(f"Data will be generated every {interval} seconds")
-        
+        subscriber.start()
+        if watcher is not None:
+            watcher.start()
         while True:
-            for sensor in sensors:
-                try:
-                    sensor_id = sensor.get('id')
-                    
-                    # Generate realistic sensor data
-                    temperature = sensor.get('temperature_min', 20.0) + random.uniform(0, sensor.get('temperature_max', 25.0) - sensor.get('temperature_min', 20.0))
-                    humidity = sensor.get('humidity_min', 40.0) + random.uniform(0, sensor.get('humidity_max', 60.0) - sensor.get('humidity_min', 40.0))
-                    pressure = sensor.get('pressure_min', 1000.0) + random.uniform(0, sensor.get('pressure_max', 1020.0) - sensor.get('pressure_min', 1000.0))
-                    
-                    # Insert the data
-                    insert_sensor_data(conn, sensor_id, temperature, humidity, pressure)
-                
-                except Exception as sensor_err:
-                    logger.error(f"Error processing sensor {sensor.get('id')}: {sensor_err}")
-            
-            # Sleep until next interval
-            time.sleep(interval)
+            current = watcher.config if watcher is not None else config
+            time.sleep(current.get('bridge', {}).get('stats_interval_seconds', 30))
+            pipeline.log_stats()
     
     except KeyboardInterrupt:
-        logger.info("Development mode stopped by user")
+        logger.info("Production mode stopped by user")
     finally:
-        conn.close()
+        if watcher is not None:
+            watcher.stop()
+        # Stop receiving first so the workers can drain what is already queued
+        subscriber.stop()
+        pipeline.stop()
+        pipeline.log_stats()
 
 # Main function
 def main():
@@ -152,6 +170,9 @@ def main():
         # Load configuration
         config = load_config()
         
+        # Per-message and per-flush logs are DEBUG, keep INFO at high rates
+        set_log_level(config)
+        
         # Determine mode
         mode = config.get('bridge', {}).get('mode', 'production').lower()
         logger.info(f"Starting MQTT bridge in {mode} mode")
@@ -160,9 +181,15 @@ def main():
         if mode == 'development':
             development_mode(config)
         else:
-            logger.warning("Production mode not implemented")
-            while True:
-                time.sleep(60)
+            engine = config.get('bridge', {}).get('engine', 'sync').lower()
+            logger.info(f"Using {engine} engine")
+            if engine == 'asyncio':
+                # Imported lazily so the sync engine does not need aiomqtt/asyncpg
+                import async_engine
+                prepare_schema(config)
+                async_engine.run(config)
+            else:
+                production_mode(config)
     
     except Exception as e:
         logger.error(f"Unhandled exception: {e}")
@@ -0,0 +1,216 @@
+import logging
+import threading
+import time
+
+import metrics
+from batch_writer import BatchWriter, writer_stages
+from decoder import DecodeError, decode_payload
+from dedup import Deduplicator
+from geo import GeoCache
+from rollup import sum_stats
+from sinks import RetryPolicy, Sink
+from wide_schema import writer_class
+
+logger = logging.getLogger('mqtt-bridge')
+
+
+class IngestPipeline:
+    """Decodes MQTT messages and fans them out to the database sinks.
+
+    ``submit`` is called from paho's network thread: it decodes the payload
+    and hands the resulting rows to the TimescaleDB sink, a ``Sink`` with
+    ``workers`` threads, each with its own bounded queue, connection and
+    BatchWriter. Rows are sharded by device id, so one device's readings
+    are always written by the same worker, in the order they arrived.
+    ``queue_size`` is split evenly between the workers. When a queue is
+    full the ``block`` policy waits up to ``block_timeout`` seconds (slowing
+    the network thread and, through TCP, the broker) before dropping; the
+    ``drop`` policy drops immediately.
+    Messages ``dedup`` has already seen are skipped while decoding, and
+    writers insert with ON CONFLICT DO NOTHING when ``deduplicate`` is set.
+    A failed flush is retried after the sink's backoff, but a batch the
+    database rejects is dropped and counted in ``rows_dropped`` so it cannot
+    stall its worker.
+    Rows are tagged with their device's geofence when a ``geo`` cache is
+    given; location and status changes it detects go to its own PostGIS
+    sink, started and stopped with the pipeline along with any other
+    ``sinks``. ``make_stages`` returns the stages of each worker's writer,
+    so every worker keeps the per-minute rollups (rollup.py) and alert rule
+    state (rules.py) of its own devices. ``reconfigure`` applies a reloaded
+    config while running.
+    """
+
+    def __init__(self, connect, queue_size=10000, workers=4, policy='block', block_timeout=0.5,
+                 batch_size=500, flush_interval=1.0, batch_method='copy', retry=None, on_flush=None,
+                 writer_cls=BatchWriter, dedup=None, deduplicate=False, geo=None, make_stages=None, sinks=(),
+                 max_pending=100000):
+        self.dedup = dedup
+        self.geo = geo
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.batch_method = batch_method
+        self.max_pending = max_pending
+        self.deduplicate = deduplicate
+        self.on_flush = on_flush
+        self.writer_cls = writer_cls
+        self.make_stages = make_stages
+        self.publish_alerts = None
+
+        self.timescale = Sink('timescale', connect, self._make_writer, queue_size=queue_size, workers=workers,
+                              policy=policy, block_timeout=block_timeout, flush_interval=flush_interval,
+                              retry=retry)
+        self.sinks = [self.timescale] + list(sinks)
+        if geo is not None and geo.sink is not None:
+            self.sinks.append(geo.sink)
+
+        self._counter_lock = threading.Lock()
+        self.messages_received = 0
+        self.messages_enqueued = 0
+        self.messages_dropped = 0
+        self.decode_errors = 0
+
+    @classmethod
+    def from_config(cls, config, connect, on_flush=None, publish_alerts=None):
+        """``publish_alerts`` is called with (topic, payload) pairs once alerts are committed"""
+        bridge_config = config.get('bridge', {})
+        queue_config = bridge_config.get('queue', {})
+        db_config = config.get('database', {})
+        batch_config = db_config.get('batch', {})
+        pipeline = cls(
+            connect,
+            queue_size=queue_config.get('max_size', 10000),
+            workers=bridge_config.get('workers', 4),
+            policy=queue_config.get('policy', 'block'),
+            block_timeout=queue_config.get('block_timeout_seconds', 0.5),
+            batch_size=batch_config.get('size', 500),
+            flush_interval=batch_config.get('flush_interval_seconds', 1.0),
+            batch_method=batch_config.get('method', 'copy'),
+            max_pending=batch_config.get('max_pending_rows', 100000),
+            retry=RetryPolicy.from_config(db_config.get('retry', {})),
+            on_flush=on_flush,
+            writer_cls=writer_class(config),
+            dedup=Deduplicator.from_config(config),
+            deduplicate=batch_config.get('deduplicate', True),
+            geo=GeoCache.from_config(config),
+            make_stages=lambda: writer_stages(config, publish=publish_alerts),
+        )
+        pipeline.publish_alerts = publish_alerts
+        return pipeline
+
+    def _make_writer(self):
+        return self.writer_cls(None, batch_size=self.batch_size, flush_interval=self.flush_interval,
+                               method=self.batch_method, max_pending=self.max_pending, on_flush=self.on_flush,
+                               deduplicate=self.deduplicate,
+                               stages=self.make_stages() if self.make_stages is not None else ())
+
+    def reconfigure(self, config, rebuild=False):
+        """Apply the queue and batch settings of a reloaded config.
+
+        Batch size, flush interval and queue policy change on the running
+        writers. With ``rebuild`` the TimescaleDB workers are replaced by
+        ``bridge.workers`` new ones with writers and stages built from
+        ``config``, after the old ones have written what they hold
+        (Sink.resize); returns the seconds that took, else 0.
+        """
+        bridge_config = config.get('bridge', {})
+        queue_config = bridge_config.get('queue', {})
+        db_config = config.get('database', {})
+        batch_config = db_config.get('batch', {})
+        self.batch_size = batch_config.get('size', 500)
+        self.flush_interval = batch_config.get('flush_interval_seconds', 1.0)
+        self.max_pending = batch_config.get('max_pending_rows', 100000)
+
+        sink = self.timescale
+        sink.policy = queue_config.get('policy', 'block')
+        sink.block_timeout = queue_config.get('block_timeout_seconds', 0.5)
+        sink.flush_interval = self.flush_interval
+        sink.configure_writers(batch_size=self.batch_size, flush_interval=self.flush_interval,
+                               max_pending=self.max_pending)
+        if not rebuild:
+            return 0.0
+
+        self.batch_method = batch_config.get('method', 'copy')
+        self.deduplicate = batch_config.get('deduplicate', True)
+        publish_alerts = self.publish_alerts
+        self.make_stages = lambda: writer_stages(config, publish=publish_alerts)
+        sink.retry = RetryPolicy.from_config(db_config.get('retry', {}))
+        return sink.resize(workers=bridge_config.get('workers', 4), queue_size=queue_config.get('max_size', 10000))
+
+    def start(self):
+        for sink in self.sinks:
+            sink.start()
+        if self.geo is not None:
+            self.geo.start()
+
+    def submit(self, topic, payload):
+        """Decode a message and queue its rows, returns False if it was dropped"""
+        with self._counter_lock:
+            self.messages_received += 1
+
+        start = time.perf_counter()
+        try:
+            rows = decode_payload(topic, payload, dedup=self.dedup, geo=self.geo)
+        except DecodeError as e:
+            with self._counter_lock:
+                self.decode_errors += 1
+            logger.debug(f"Dropping undecodable message: {e}")
+            return False
+        metrics.DECODE_SECONDS.observe(time.perf_counter() - start)
+
+        if not rows:
+            return True
+        # All rows of one message belong to the same device
+        enqueued = self.timescale.submit(rows[0][1], rows)
+        with self._counter_lock:
+            if enqueued:
+                self.messages_enqueued += 1
+            else:
+                self.messages_dropped += 1
+        return enqueued
+
+    def stop(self):
+        """Let every sink drain its queues, flush, and exit"""
+        if self.geo is not None:
+            self.geo.stop()
+        for sink in self.sinks:
+            sink.stop()
+        logger.info("Ingest pipeline stopped")
+
+    def stats(self):
+        """Return message counters, TimescaleDB sink statistics and every sink under 'sinks'"""
+        with self._counter_lock:
+            stats = {
+                'messages_received': self.messages_received,
+                'messages_enqueued': self.messages_enqueued,
+                'messages_dropped': self.messages_dropped,
+                'decode_errors': self.decode_errors,
+            }
+        sinks = {sink.name: sink.stats() for sink in self.sinks}
+        timescale = sinks['timescale']
+        for key in ('connect_errors', 'backpressure_waits', 'queue_depth', 'queue_capacity', 'max_queue_depth',
+                    'rows_written', 'rows_pending', 'flush_errors', 'flushes', 'rows_duplicate',
+                    'rows_dropped', 'workers_connected'):
+            stats[key] = timescale[key]
+        if self.dedup is not None:
+            stats.update(self.dedup.stats())
+        if self.geo is not None:
+            stats.update(self.geo.stats())
+        stats.update(sum_stats(self.timescale.writer_stats(), prefixes=('rollup_', 'alerts_', 'latest_')))
+        stats['sinks'] = sinks
+        return stats
+
+    def log_stats(self):
+        s = self.stats()
+        logger.info(f"Pipeline: received={s['messages_received']} enqueued={s['messages_enqueued']} "
+                    f"dropped={s['messages_dropped']} decode_errors={s['decode_errors']} "
+                    f"queue={s['queue_depth']}/{s['queue_capacity']} (max {s['max_queue_depth']}) "
+                    f"backpressure_waits={s['backpressure_waits']} rows_written={s['rows_written']} "
+                    f"rows_pending={s['rows_pending']} rows_dropped={s['rows_dropped']} "
+                    f"duplicates={s.get('duplicates_dropped', 0)} (hit rate {s.get('dedup_hit_rate', 0.0):.2%}, "
+                    f"{s['rows_duplicate']} more rows ignored by the database)")
+        for name, sink in s['sinks'].items():
+            logger.info(f"Sink {name}: rows_written={sink['rows_written']} ({sink['rows_per_sec']:.0f}/s) "
+                        f"lag={sink['lag_seconds']:.2f}s queue={sink['queue_depth']}/{sink['queue_capacity']} "
+                        f"dropped={sink['dropped']} rows_dropped={sink['rows_dropped']} "
+                        f"flush_errors={sink['flush_errors']} "
+                        f"workers_connected={sink['workers_connected']}/{sink['workers']}")
@@ -0,0 +1,569 @@
+#!/usr/bin/env python3
+"""Read-side query API for dashboards, in front of TimescaleDB and PostGIS.
+
+Serves JSON over HTTP from the bridge image:
+
+    GET /latest?device_id=a,b&sensor_type=temperature&location_id=3
+        Newest value of every device and sensor type, from memory
+    GET /series?device_id=a&sensor_type=temperature&from=now-7d&to=now&points=1000
+        Time-bucketed averages, downsampled with LTTB to at most ``points``
+    GET /geofences and /geofences/<fence_id>/devices
+        Devices per geofence, with location and latest values, from memory
+    GET /stats, /metrics, /healthz
+
+``from``/``to`` take epoch milliseconds (Grafana's ${__from}/${__to}),
+ISO 8601 or now[-<n>s|m|h|d|w]. Query results are kept in an LRU cache
+for ``query_api.cache.ttl_seconds``, keyed on the time range rounded to
+the TTL, so every viewer of a dashboard auto-refreshing the same panel
+costs one database query per TTL.
+
+    CONFIG_PATH=config.yaml python3 src/query_api.py
+"""
+import collections
+import contextlib
+import datetime
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import psycopg2
+
+import metrics
+from config_file import load_config, set_log_level
+from geo import GeoCache
+from latest import LatestValues
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s'
+)
+logger = logging.getLogger('mqtt-bridge')
+
+DEFAULT_PORT = 8080
+
+# Tables a series can be read from, finest first: (table, time column,
+# average expression, resolution in seconds, retention in days or None),
+# matching timescaledb/configmap.yaml
+SERIES_SOURCES = (
+    ('sensor_data', 'time', 'avg(value)', 0, 90),
+    ('sensor_data_1m', 'bucket', 'sum(sum_value) / sum(reading_count)', 60, 30),
+    ('sensor_data_1h', 'bucket', 'sum(sum_value) / sum(reading_count)', 3600, 365),
+    ('sensor_data_1d', 'bucket', 'sum(sum_value) / sum(reading_count)', 86400, None),
+)
+
+SERIES_SQL = """
+SELECT extract(epoch FROM time_bucket(make_interval(secs => %s), {time})) AS t, {average}
+FROM {table}
+WHERE device_id = %s AND sensor_type = %s AND {time} >= %s AND {time} < %s
+GROUP BY t ORDER BY t
+"""
+
+DURATION = re.compile(r'(\d+(?:\.\d+)?)([smhdw])$')
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+class BadRequest(ValueError):
+    """Raised for a request the API cannot answer, sent back as a 400"""
+
+
+class NotFound(LookupError):
+    """Raised for a path or feature that does not exist, sent back as a 404"""
+
+
+def parse_duration(value):
+    """Seconds in "90s", "5m", "1h", "7d" or "2w" (or a plain number of seconds)"""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    match = DURATION.match(value.strip())
+    if match is None:
+        raise BadRequest(f"Unrecognised duration: {value!r}")
+    return float(match.group(1)) * UNITS[match.group(2)]
+
+
+def parse_time(value, now):
+    """Epoch seconds from epoch milliseconds, ISO 8601 or now[-duration]"""
+    value = value.strip()
+    if value.startswith('now'):
+        offset = value[3:].strip()
+        if not offset:
+            return now
+        if offset[0] not in '+-':
+            raise BadRequest(f"Unrecognised time: {value!r}")
+        seconds = parse_duration(offset[1:])
+        return now - seconds if offset[0] == '-' else now + seconds
+    if value.isdigit():
+        return int(value) / 1000.0
+    try:
+        parsed = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise BadRequest(f"Unrecognised time: {value!r}")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+
+def lttb(x, y, threshold):
+    """Indices of ``threshold`` points of (x, y) chosen by Largest-Triangle-Three-Buckets.
+
+    Keeps the first and last point and, from each of ``threshold - 2``
+    equal-count buckets in between, the point forming the largest triangle
+    with the point kept from the previous bucket and the average of the
+    next bucket, so peaks and dips survive where averaging would flatten
+    them.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    counts = np.diff(edges)
+    # Averages of every bucket, and of the last point as the bucket after the last
+    next_x = np.append(np.add.reduceat(x[:n - 1], edges[:-1]) / counts, x[n - 1])
+    next_y = np.append(np.add.reduceat(y[:n - 1], edges[:-1]) / counts, y[n - 1])
+
+    picked = np.empty(threshold, dtype=np.int64)
+    picked[0], picked[-1] = 0, n - 1
+    a = 0
+    if n > threshold * 32:
+        for i in range(threshold - 2):
+            start, end = edges[i], edges[i + 1]
+            ax, ay = x[a], y[a]
+            area = np.abs((ax - next_x[i + 1]) * (y[start:end] - ay) - (ax - x[start:end]) * (next_y[i + 1] - ay))
+            a = start + int(area.argmax())
+            picked[i + 1] = a
+        return picked
+
+    # Series are planned at about 10 rows per bucket, where a plain loop
+    # beats a few numpy calls per bucket
+    xs, ys, bounds = x.tolist(), y.tolist(), edges.tolist()
+    next_x, next_y = next_x.tolist(), next_y.tolist()
+    for i in range(threshold - 2):
+        ax, ay = xs[a], ys[a]
+        dx, dy = ax - next_x[i + 1], next_y[i + 1] - ay
+        best = -1.0
+        for j in range(bounds[i], bounds[i + 1]):
+            area = abs(dx * (ys[j] - ay) - (ax - xs[j]) * dy)
+            if area > best:
+                best, a = area, j
+        picked[i + 1] = a
+    return picked
+
+
+def plan_series(start, end, points, now, bucket=None, lttb_factor=10):
+    """(table, time column, average expression, bucket seconds) to read a series from.
+
+    Without an explicit ``bucket`` it is sized for about ``lttb_factor``
+    times ``points`` rows, which LTTB then reduces, and read from the
+    coarsest source that is fine enough and still holds ``start``.
+    """
+    target = bucket if bucket else max((end - start) / (points * lttb_factor), 1.0)
+    age_days = (now - start) / 86400
+    candidates = [source for source in SERIES_SOURCES if source[4] is None or source[4] >= age_days]
+    fine_enough = [source for source in candidates if source[3] <= target]
+    table, time_column, average, resolution, _ = fine_enough[-1] if fine_enough else candidates[0]
+    if resolution:
+        seconds = max(math.ceil(target / resolution), 1) * resolution
+    else:
+        seconds = max(math.ceil(target), 1)
+    return table, time_column, average, seconds
+
+
+class TTLCache:
+    """LRU map of query results that expire ``ttl`` seconds after loading.
+
+    ``get(key, load)`` returns the cached value or calls ``load()`` and
+    keeps the result. Concurrent misses for the same key wait for the one
+    load in flight rather than each querying the database, which is what
+    happens when every open dashboard refreshes the same panel at once.
+    ``max_entries`` of 0 disables caching.
+    """
+
+    def __init__(self, max_entries=1000, ttl=10.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._entries = collections.OrderedDict()  # key -> (expires, value)
+        self._loading = {}  # key -> Event set when its load finishes
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.evictions = 0
+
+    def get(self, key, load, ttl=None):
+        if self.max_entries <= 0:
+            with self._lock:
+                self.misses += 1
+            return load()
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    if entry[0] > time.monotonic():
+                        self._entries.move_to_end(key)
+                        self.hits += 1
+                        return entry[1]
+                    del self._entries[key]
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    self.misses += 1
+                    break
+                self.waits += 1
+            # Loaded by now, or the load failed and the next pass retries it
+            loading.wait()
+
+        try:
+            value = load()
+        except BaseException:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+            raise
+        with self._lock:
+            self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            del self._loading[key]
+        loading.set()
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {
+                'query_cache_hits': self.hits,
+                'query_cache_misses': self.misses,
+                'query_cache_waits': self.waits,
+                'query_cache_evictions': self.evictions,
+                'query_cache_entries': len(self._entries),
+            }
+
+
+class QueryAPI:
+    """The endpoints, independent of HTTP: each returns a JSON-ready object.
+
+    Latest values come from ``latest`` (a LatestValues fed by the bridge's
+    notifications) and geofence membership from ``geo`` (the bridge's
+    GeoCache), so only series read the database, through a pool of at most
+    ``pool_size`` connections.
+    """
+
+    def __init__(self, connect, latest, geo=None, cache=None, pool_size=8, latest_ttl=1.0, max_points=1000,
+                 lttb_factor=10):
+        self.connect = connect
+        self.latest = latest
+        self.geo = geo
+        self.cache = cache or TTLCache()
+        self.pool_size = pool_size
+        self.latest_ttl = latest_ttl
+        self.max_points = max_points
+        self.lttb_factor = lttb_factor
+
+        self._idle = []  # connections not in use
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._counter_lock = threading.Lock()
+
+        self.requests = 0
+        self.errors = 0
+        self.db_queries = 0
+        self.db_seconds = 0.0
+
+    @classmethod
+    def from_config(cls, config):
+        db_config = config.get('database', {})
+        api_config = config.get('query_api', {})
+        cache_config = api_config.get('cache', {})
+        series_config = api_config.get('series', {})
+
+        def connect():
+            return psycopg2.connect(
+                host=db_config.get('host', 'timescaledb'),
+                port=db_config.get('port', 5432),
+                dbname=db_config.get('name', 'sensor_data'),
+                user=os.environ.get('DB_USER', 'postgres'),
+                password=os.environ.get('DB_PASSWORD', 'postgres'),
+            )
+
+        return cls(
+            connect,
+            LatestValues.from_config(config, connect),
+            geo=GeoCache.from_config(config),
+            cache=TTLCache(max_entries=cache_config.get('max_entries', 1000),
+                           ttl=cache_config.get('ttl_seconds', 10.0)),
+            pool_size=api_config.get('pool_size', 8),
+            latest_ttl=cache_config.get('latest_ttl_seconds', 1.0),
+            max_points=series_config.get('max_points', 1000),
+            lttb_factor=series_config.get('lttb_factor', 10),
+        )
+
+    def start(self):
+        self.latest.start()
+        if self.geo is not None:
+            self.geo.start()
+
+    def stop(self):
+        self.latest.stop()
+        if self.geo is not None:
+            self.geo.stop()
+        while self._idle:
+            self._idle.pop().close()
+
+    @contextlib.contextmanager
+    def _connection(self):
+        """A pooled connection; waits while ``pool_size`` are in use"""
+        with self._slots:
+            try:
+                conn = self._idle.pop()
+            except IndexError:
+                conn = self.connect()
+                conn.autocommit = True
+            # Whatever went wrong, the connection may be mid-query: close it
+            # rather than leak it or hand it to the next caller
+            try:
+                yield conn
+            except BaseException:
+                conn.close()
+                raise
+            else:
+                if not conn.closed:
+                    self._idle.append(conn)
+
+    def _query(self, sql, params):
+        start = time.perf_counter()
+        with self._connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, params)
+                rows = cur.fetchall()
+        with self._counter_lock:
+            self.db_queries += 1
+            self.db_seconds += time.perf_counter() - start
+        return rows
+
+    def count_request(self, failed=False):
+        with self._counter_lock:
+            self.requests += 1
+            if failed:
+                self.errors += 1
+
+    def latest_values(self, device_ids=None, sensor_type=None, location_id=None):
+        """Rows of {device_id, sensor_type, time (epoch ms), value, location_id}"""
+        key = ('latest', tuple(device_ids) if device_ids else None, sensor_type, location_id)
+        return self.cache.get(key, lambda: self._latest_rows(device_ids, sensor_type, location_id),
+                              ttl=self.latest_ttl)
+
+    def _latest_rows(self, device_ids, sensor_type, location_id):
+        rows = []
+        for device_id, series in sorted(self.latest.get(device_ids, sensor_type).items()):
+            for name, (at, value, tag) in sorted(series.items()):
+                if location_id is None or tag == location_id:
+                    rows.append({'device_id': device_id, 'sensor_type': name, 'time': int(at * 1000),
+                                 'value': value, 'location_id': tag})
+        return rows
+
+    def series(self, device_id, sensor_type, start, end, points=None, bucket=None):
+        """Bucketed averages of one series between epoch seconds ``start`` and
+        ``end``, at most ``points`` of them"""
+        points = min(points or self.max_points, self.max_points)
+        if end <= start:
+            raise BadRequest("'to' must be after 'from'")
+        # Round the range to the TTL so refreshes of a relative range within
+        # one TTL share an entry; the rounded range covers the requested one
+        ttl = self.cache.ttl or 1.0
+        start = math.floor(start / ttl) * ttl
+        end = math.ceil(end / ttl) * ttl
+        key = ('series', device_id, sensor_type, start, end, points, bucket)
+        return self.cache.get(key, lambda: self._series(device_id, sensor_type, start, end, points, bucket))
+
+    def _series(self, device_id, sensor_type, start, end, points, bucket):
+        table, time_column, average, seconds = plan_series(start, end, points, time.time(), bucket,
+                                                           self.lttb_factor)
+        sql = SERIES_SQL.format(table=table, time=time_column, average=average)
+        rows = self._query(sql, (seconds, device_id, sensor_type,
+                                 datetime.datetime.fromtimestamp(start, tz=datetime.timezone.utc),
+                                 datetime.datetime.fromtimestamp(end, tz=datetime.timezone.utc)))
+        x = np.fromiter((row[0] for row in rows), dtype=np.float64, count=len(rows))
+        y = np.fromiter((row[1] for row in rows), dtype=np.float64, count=len(rows))
+        picked = lttb(x, y, points)
+        return {
+            'device_id': device_id,
+            'sensor_type': sensor_type,
+            'from': int(start * 1000),
+            'to': int(end * 1000),
+            'source': table,
+            'bucket_seconds': seconds,
+            'rows': len(rows),
+            'downsampled': len(picked) < len(rows),
+            'points': [{'time': int(t * 1000), 'value': v} for t, v in zip(x[picked].tolist(), y[picked].tolist())],
+        }
+
+    def geofences(self):
+        """Rows of {location_id, devices}, devices per geofence"""
+        self._require_geo()
+        counts = collections.Counter(self.geo.tags().values())
+        return [{'location_id': fence, 'devices': count} for fence, count in sorted(counts.items())]
+
+    def geofence_devices(self, location_id, sensor_type=None):
+        """Rows of {device_id, lat, lon, latest} for the devices in a geofence"""
+        self._require_geo()
+        key = ('geofence', location_id, sensor_type)
+        return self.cache.get(key, lambda: self._geofence_rows(location_id, sensor_type), ttl=self.latest_ttl)
+
+    def _geofence_rows(self, location_id, sensor_type):
+        points = self.geo.devices(location_id)
+        latest = self.latest.get(list(points), sensor_type)
+        rows = []
+        for device_id, (lat, lon) in sorted(points.items()):
+            values = {name: {'time': int(at * 1000), 'value': value}
+                      for name, (at, value, _) in latest.get(device_id, {}).items()}
+            rows.append({'device_id': device_id, 'lat': lat, 'lon': lon, 'latest': values})
+        return rows
+
+    def _require_geo(self):
+        if self.geo is None:
+            raise NotFound("Geofences need geo.enabled")
+
+    def stats(self):
+        with self._counter_lock:
+            stats = {
+                'query_requests': self.requests,
+                'query_errors': self.errors,
+                'query_db_queries': self.db_queries,
+                'query_db_seconds': self.db_seconds,
+            }
+        stats.update(self.cache.stats())
+        stats.update(self.latest.stats())
+        if self.geo is not None:
+            stats.update(self.geo.stats())
+        return stats
+
+
+def _list(params, name):
+    values = [item for value in params.get(name, ()) for item in value.split(',') if item]
+    return sorted(set(values)) or None
+
+
+def _one(params, name, required=False):
+    values = params.get(name)
+    if not values:
+        if required:
+            raise BadRequest(f"Missing parameter: {name}")
+        return None
+    return values[-1]
+
+
+def make_handler(api):
+    """A request handler class serving ``api``"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            params = urllib.parse.parse_qs(url.query)
+            parts = [part for part in url.path.split('/') if part]
+            try:
+                if parts == ['metrics']:
+                    return self._metrics()
+                if parts == ['healthz']:
+                    # Not ready until the latest values are loaded
+                    if api.latest.wait_loaded(0):
+                        return self._send(200, {'status': 'ok'})
+                    return self._send(503, {'status': 'loading'})
+                self._send(200, self._route(parts, params))
+                api.count_request()
+            except BadRequest as e:
+                api.count_request(failed=True)
+                self._send(400, {'error': str(e)})
+            except NotFound as e:
+                api.count_request(failed=True)
+                self._send(404, {'error': str(e)})
+            except psycopg2.Error as e:
+                api.count_request(failed=True)
+                logger.error(f"Query for {self.path} failed: {e}")
+                self._send(503, {'error': 'database unavailable'})
+
+        def _route(self, parts, params):
+            if parts == ['latest']:
+                return api.latest_values(_list(params, 'device_id'), _one(params, 'sensor_type'),
+                                         _one(params, 'location_id'))
+            if parts == ['series']:
+                now = time.time()
+                bucket = _one(params, 'bucket')
+                points = _one(params, 'points')
+                try:
+                    points = int(points) if points else None
+                except ValueError:
+                    raise BadRequest(f"Invalid points: {points!r}")
+                return api.series(_one(params, 'device_id', required=True),
+                                  _one(params, 'sensor_type', required=True),
+                                  parse_time(_one(params, 'from') or 'now-6h', now),
+                                  parse_time(_one(params, 'to') or 'now', now),
+                                  points=points,
+                                  bucket=parse_duration(bucket) if bucket else None)
+            if parts == ['geofences']:
+                return api.geofences()
+            if len(parts) == 3 and parts[0] == 'geofences' and parts[2] == 'devices':
+                return api.geofence_devices(urllib.parse.unquote(parts[1]), _one(params, 'sensor_type'))
+            if parts == ['stats']:
+                return api.stats()
+            raise NotFound(f"No such endpoint: /{'/'.join(parts)}")
+
+        def _send(self, status, body):
+            data = json.dumps(body, separators=(',', ':')).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _metrics(self):
+            if metrics.prometheus_client is None:
+                raise NotFound("prometheus_client is not installed")
+            data = metrics.prometheus_client.generate_latest()
+            self.send_response(200)
+            self.send_header('Content-Type', metrics.prometheus_client.CONTENT_TYPE_LATEST)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            # One line per request is too much at dashboard refresh rates
+            logger.debug(f"{self.address_string()} {format % args}")
+
+    return Handler
+
+
+def main():
+    config = load_config()
+    set_log_level(config)
+
+    port = config.get('query_api', {}).get('port', DEFAULT_PORT)
+    api = QueryAPI.from_config(config)
+    api.start()
+    if metrics.prometheus_client is not None:
+        metrics.prometheus_client.REGISTRY.register(metrics.StatsCollector(api.stats))
+    server = ThreadingHTTPServer(('', port), make_handler(api))
+    server.daemon_threads = True
+    logger.info(f"Query API listening on :{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Query API stopped by user")
+    finally:
+        server.server_close()
+        api.stop()
+
+
+if __name__ == "__main__":
+    main()
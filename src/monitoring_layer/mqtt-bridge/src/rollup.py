@@ -0,0 +1,262 @@
+import array
+import datetime
+import threading
+import time
+
+from psycopg2 import extras
+
+ROLLUP_COLUMNS = ('bucket', 'device_id', 'sensor_type', 'location_id', 'reading_count',
+                  'sum_value', 'min_value', 'max_value', 'last_value', 'last_time')
+
+# Same as timescaledb/configmap.yaml, for deployments initialised before it had the table
+ROLLUP_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS {table} (
+  bucket TIMESTAMPTZ NOT NULL,
+  device_id TEXT NOT NULL,
+  sensor_type TEXT NOT NULL,
+  location_id TEXT,
+  reading_count INTEGER NOT NULL,
+  sum_value DOUBLE PRECISION NOT NULL,
+  min_value DOUBLE PRECISION NOT NULL,
+  max_value DOUBLE PRECISION NOT NULL,
+  last_value DOUBLE PRECISION NOT NULL,
+  last_time TIMESTAMPTZ NOT NULL,
+  PRIMARY KEY (device_id, sensor_type, bucket)
+);
+
+SELECT create_hypertable('{table}', 'bucket', chunk_time_interval => INTERVAL '7 days', if_not_exists => TRUE);
+"""
+
+# Every column merges, so partial windows for the same bucket (late rows,
+# other replicas, a restart) add up to the same row as one complete window
+UPSERT_SQL = """
+INSERT INTO {table} AS r ({columns}) VALUES {values}
+ON CONFLICT (device_id, sensor_type, bucket) DO UPDATE SET
+  reading_count = r.reading_count + EXCLUDED.reading_count,
+  sum_value = r.sum_value + EXCLUDED.sum_value,
+  min_value = LEAST(r.min_value, EXCLUDED.min_value),
+  max_value = GREATEST(r.max_value, EXCLUDED.max_value),
+  last_value = CASE WHEN EXCLUDED.last_time >= r.last_time THEN EXCLUDED.last_value ELSE r.last_value END,
+  location_id = CASE WHEN EXCLUDED.last_time >= r.last_time THEN EXCLUDED.location_id ELSE r.location_id END,
+  last_time = GREATEST(r.last_time, EXCLUDED.last_time)
+"""
+
+
+def ensure_rollup_schema(conn, table='sensor_rollup_1m'):
+    """Create the rollup hypertable if missing"""
+    cur = conn.cursor()
+    cur.execute(ROLLUP_SCHEMA_SQL.format(table=table))
+    conn.commit()
+    cur.close()
+
+
+class _Window:
+    """Accumulators of one time bucket, one array slot per series"""
+
+    __slots__ = ('count', 'total', 'low', 'high', 'last', 'last_at', 'slots', 'late')
+
+    def __init__(self, late=False):
+        self.count = array.array('l')
+        self.total = array.array('d')
+        self.low = array.array('d')
+        self.high = array.array('d')
+        self.last = array.array('d')
+        self.last_at = array.array('d')
+        self.slots = []  # slots with at least one reading, in first-seen order
+        self.late = late  # the bucket was already taken, this is a partial update
+
+    def grow(self, size):
+        missing = size - len(self.count)
+        self.count.extend([0] * missing)
+        for column in (self.total, self.low, self.high, self.last, self.last_at):
+            column.extend([0.0] * missing)
+
+
+class RollupWindows:
+    """Tumbling-window count/sum/min/max/last of sensor_data rows.
+
+    ``add_rows`` folds each narrow row into the accumulators of its
+    (device_id, sensor_type) series for the ``window`` second bucket its
+    timestamp falls in. Series are numbered once and each open bucket keeps
+    its accumulators in flat arrays indexed by that number, so a reading
+    costs a few array stores rather than an object. ``take()`` closes the
+    buckets that ended more than ``grace`` seconds before the newest reading
+    seen (capped at the wall clock, so one device with a fast clock cannot
+    close everyone's buckets) and returns their rows, which the batch writer
+    upserts into ``table`` in the same transaction as its raw rows. After
+    ``grace`` seconds without readings the wall clock closes the rest.
+    Rows arriving for a bucket that was already taken start a new partial
+    bucket that the upsert merges into the stored row, so late data is
+    never lost, only written twice.
+    """
+
+    def __init__(self, table='sensor_rollup_1m', window=60, grace=120.0):
+        self.table = table
+        self.window = window
+        self.grace = grace
+
+        self._series = {}  # (device_id, sensor_type) -> slot
+        self._keys = []  # slot -> (device_id, sensor_type)
+        self._locations = []  # slot -> location_id of the series' latest row
+        self._windows = {}  # bucket start (epoch seconds) -> _Window
+        self._closed = set()  # bucket starts already taken, to count late rows
+        self._ready = []  # rows of closed buckets, not yet written
+        self._watermark = 0.0  # newest reading time seen
+        self._last_add = time.monotonic()
+        self._lock = threading.Lock()
+        self._sql = UPSERT_SQL.format(table=table, columns=', '.join(ROLLUP_COLUMNS), values='%s')
+        # One row per statement for asyncpg's executemany
+        self.row_sql = UPSERT_SQL.format(table=table, columns=', '.join(ROLLUP_COLUMNS),
+                                         values='(' + ', '.join(f'${i + 1}' for i in range(len(ROLLUP_COLUMNS))) + ')')
+
+        self.rows_in = 0
+        self.rows_late = 0
+        self.rows_written = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """Create windows from database.rollup, or None if disabled"""
+        rollup_config = config.get('database', {}).get('rollup', {})
+        if not rollup_config.get('enabled', False):
+            return None
+        return cls(table=rollup_config.get('table', 'sensor_rollup_1m'),
+                   window=rollup_config.get('window_seconds', 60),
+                   grace=rollup_config.get('grace_seconds', 120.0))
+
+    def add_rows(self, rows):
+        width = self.window
+        windows = self._windows
+        series = self._series
+        locations = self._locations
+        previous = None
+        late = 0
+        with self._lock:
+            watermark = self._watermark
+            for timestamp, device_id, sensor_type, value, location_id in rows:
+                # The rows of one message share their timestamp object
+                if timestamp is not previous:
+                    previous = timestamp
+                    at = timestamp.timestamp()
+                    if at > watermark:
+                        watermark = at
+                    start = int(at // width) * width
+                    window = windows.get(start)
+                    if window is None:
+                        window = windows[start] = _Window(late=start in self._closed)
+                    count, total, low, high = window.count, window.total, window.low, window.high
+                    last, last_at = window.last, window.last_at
+
+                slot = series.get((device_id, sensor_type))
+                if slot is None:
+                    slot = series[(device_id, sensor_type)] = len(self._keys)
+                    self._keys.append((device_id, sensor_type))
+                    locations.append(location_id)
+                else:
+                    locations[slot] = location_id
+
+                if slot >= len(count):
+                    window.grow(len(self._keys))
+                if count[slot] == 0:
+                    window.slots.append(slot)
+                    count[slot] = 1
+                    total[slot] = low[slot] = high[slot] = last[slot] = value
+                    last_at[slot] = at
+                else:
+                    count[slot] += 1
+                    total[slot] += value
+                    if value < low[slot]:
+                        low[slot] = value
+                    elif value > high[slot]:
+                        high[slot] = value
+                    if at >= last_at[slot]:
+                        last[slot] = value
+                        last_at[slot] = at
+                if window.late:
+                    late += 1
+            self.rows_in += len(rows)
+            self.rows_late += late
+            self._watermark = watermark
+            self._last_add = time.monotonic()
+
+    def take(self, close_all=False):
+        """Rows of the buckets past their grace period, or of every bucket
+        with ``close_all`` (on shutdown), ready to write"""
+        with self._lock:
+            if close_all:
+                before = float('inf')
+            elif time.monotonic() - self._last_add >= self.grace:
+                before = time.time() - self.grace
+            else:
+                before = min(self._watermark, time.time()) - self.grace
+            for start in sorted(s for s in self._windows if s + self.window <= before):
+                self._close(start)
+            # Only remember taken buckets for a day, later rows are still
+            # merged but not counted as late
+            if len(self._closed) > 24 * 3600 // self.window:
+                horizon = time.time() - 24 * 3600
+                self._closed = {s for s in self._closed if s >= horizon}
+            rows, self._ready = _merge(self._ready), []
+        return rows
+
+    def _close(self, start):
+        window = self._windows.pop(start)
+        bucket = datetime.datetime.fromtimestamp(start, tz=datetime.timezone.utc)
+        for slot in window.slots:
+            device_id, sensor_type = self._keys[slot]
+            self._ready.append((
+                bucket, device_id, sensor_type, self._locations[slot], window.count[slot],
+                window.total[slot], window.low[slot], window.high[slot], window.last[slot],
+                datetime.datetime.fromtimestamp(window.last_at[slot], tz=datetime.timezone.utc),
+            ))
+        self._closed.add(start)
+
+    def requeue(self, rows):
+        """Give back taken rows whose transaction was rolled back"""
+        with self._lock:
+            self._ready = rows + self._ready
+
+    def write(self, cur, rows):
+        """Upsert taken rows with a psycopg2 cursor, the caller commits"""
+        extras.execute_values(cur, self._sql, rows, page_size=1000)
+
+    def committed(self, rows):
+        self.rows_written += len(rows)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rollup_rows_in': self.rows_in,
+                'rollup_rows_late': self.rows_late,
+                'rollup_rows_written': self.rows_written,
+                'rollup_pending_rows': len(self._ready),
+                'rollup_open_series': sum(len(window.slots) for window in self._windows.values()),
+            }
+
+
+def _merge(rows):
+    """Combine rows for the same bucket and series, which one upsert cannot both update.
+
+    They only occur when a rolled back write is retried after a late
+    partial bucket for the same minute has closed.
+    """
+    merged = {}
+    for row in rows:
+        key = row[:3]
+        other = merged.get(key)
+        if other is None:
+            merged[key] = row
+            continue
+        newer = row if row[9] >= other[9] else other
+        merged[key] = (row[0], row[1], row[2], newer[3], other[4] + row[4], other[5] + row[5],
+                       min(other[6], row[6]), max(other[7], row[7]), newer[8], newer[9])
+    return list(merged.values())
+
+
+def sum_stats(stats_list, prefixes=('rollup_',)):
+    """Add up the keys starting with ``prefixes`` of several writers' stats"""
+    totals = {}
+    for stats in stats_list:
+        for key, value in stats.items():
+            if key.startswith(prefixes):
+                totals[key] = totals.get(key, 0) + value
+    return totals
@@ -0,0 +1,362 @@
+import itertools
+import json
+import logging
+import threading
+import time
+
+import numpy as np
+from psycopg2 import extras
+
+import metrics
+
+logger = logging.getLogger('mqtt-bridge')
+
+ALERT_COLUMNS = ('time', 'device_id', 'sensor_type', 'location_id', 'rule', 'value', 'observed', 'threshold')
+
+# Same as timescaledb/configmap.yaml, for deployments initialised before it had the table
+ALERT_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS {table} (
+  time TIMESTAMPTZ NOT NULL,
+  device_id TEXT NOT NULL,
+  sensor_type TEXT NOT NULL,
+  location_id TEXT,
+  rule TEXT NOT NULL,
+  value DOUBLE PRECISION NOT NULL,
+  observed DOUBLE PRECISION NOT NULL,
+  threshold DOUBLE PRECISION NOT NULL
+);
+
+SELECT create_hypertable('{table}', 'time', chunk_time_interval => INTERVAL '7 days', if_not_exists => TRUE);
+CREATE INDEX IF NOT EXISTS {table}_device_time_idx ON {table} (device_id, time DESC);
+"""
+
+
+def ensure_alert_schema(conn, table='alerts'):
+    """Create the alerts hypertable if missing"""
+    cur = conn.cursor()
+    cur.execute(ALERT_SCHEMA_SQL.format(table=table))
+    conn.commit()
+    cur.close()
+
+
+class Readings:
+    """One round of readings, at most one per series, and the state of
+    their series before them. Every attribute is an array over the round."""
+
+    __slots__ = ('value', 'seen', 'delta', 'dt', 'mean', 'std', 'warm')
+
+    def __init__(self, value, seen, delta, dt, mean, std, warm):
+        self.value = value
+        self.seen = seen  # the series had an earlier reading
+        self.delta = delta  # change since that reading
+        self.dt = dt  # seconds since that reading
+        self.mean = mean  # EWMA of the series
+        self.std = std  # EWMA standard deviation of the series
+        self.warm = warm  # enough readings for mean and std to mean something
+
+
+class Rule:
+    """A check run over every reading of a batch at once.
+
+    ``key`` is the setting under ``alerts.sensors.<sensor_type>`` that
+    enables the rule for that sensor type and holds its threshold.
+    ``check`` returns a mask of the readings that break the rule and the
+    value compared against the threshold.
+    """
+
+    name = None
+    key = None
+
+    def check(self, readings, threshold):
+        raise NotImplementedError
+
+
+class BelowMin(Rule):
+    name = 'min'
+    key = 'min'
+
+    def check(self, readings, threshold):
+        return readings.value < threshold, readings.value
+
+
+class AboveMax(Rule):
+    name = 'max'
+    key = 'max'
+
+    def check(self, readings, threshold):
+        return readings.value > threshold, readings.value
+
+
+class RateOfChange(Rule):
+    """Change per minute since the series' previous reading"""
+
+    name = 'rate'
+    key = 'max_rate_per_minute'
+
+    def check(self, readings, threshold):
+        rate = np.abs(readings.delta) / readings.dt * 60.0
+        return readings.seen & (readings.dt > 0) & (rate > threshold), rate
+
+
+class ZScore(Rule):
+    """Distance from the series' EWMA in EWMA standard deviations"""
+
+    name = 'zscore'
+    key = 'zscore'
+
+    def check(self, readings, threshold):
+        score = np.abs(readings.value - readings.mean) / readings.std
+        return readings.warm & (readings.std > 0) & (score > threshold), score
+
+
+RULES = (BelowMin(), AboveMax(), RateOfChange(), ZScore())
+
+
+class RuleEngine:
+    """Threshold, rate-of-change and z-score alerts on sensor_data rows.
+
+    A writer stage like RollupWindows: ``add_rows`` only buffers the rows,
+    ``take()`` evaluates everything buffered since the previous flush and
+    returns the new alerts, which the batch writer inserts into ``table`` in
+    the same transaction as the raw rows and hands to ``publish`` (as
+    (topic, payload) pairs for ``topic``) once committed.
+
+    Each (device_id, sensor_type) series is numbered once and its state
+    lives in flat numpy arrays indexed by that number: previous value and
+    time, EWMA mean and variance (``alpha``), reading count and the time of
+    its last alert per rule, so memory is a fixed few dozen bytes per
+    series. A batch is evaluated with array operations over all of its
+    rows; readings of a series that appears several times in one batch are
+    split into successive rounds so each sees the state left by the one
+    before. A rule fires at most once per ``cooldown`` seconds per series,
+    and the z-score rule only after ``warmup`` readings.
+
+    ``thresholds`` maps a sensor type to its settings, e.g.
+    ``{'temperature': {'max': 60, 'max_rate_per_minute': 5}}``; rules
+    without a setting are off for that type and types without settings are
+    not checked at all.
+    """
+
+    def __init__(self, thresholds, table='alerts', topic=None, publish=None, alpha=0.05, warmup=30,
+                 cooldown=300.0, rules=RULES):
+        self.table = table
+        self.topic = topic
+        self.publish = publish
+        self.alpha = alpha
+        self.warmup = warmup
+        self.cooldown = cooldown
+        self.rules = [rule for rule in rules if any(rule.key in limits for limits in thresholds.values())]
+
+        self._kinds = {sensor_type: kind for kind, sensor_type in enumerate(thresholds)}
+        # Threshold of each rule per sensor type, NaN (never breached) where unset
+        self._thresholds = np.array([[float(limits.get(rule.key, np.nan)) for limits in thresholds.values()]
+                                     for rule in self.rules]).reshape(len(self.rules), len(thresholds))
+
+        self._series = {}  # (device_id, sensor_type) -> slot
+        self._last_value = np.zeros(0)
+        self._last_time = np.zeros(0)
+        self._mean = np.zeros(0)
+        self._var = np.zeros(0)
+        self._count = np.zeros(0, dtype=np.int64)
+        self._last_alert = np.zeros((len(self.rules), 0))
+
+        self._rows = []  # buffered since the last take()
+        self._ready = []  # alerts not yet written
+        self._lock = threading.Lock()
+        self._sql = f"INSERT INTO {table} ({', '.join(ALERT_COLUMNS)}) VALUES %s"
+        # One row per statement for asyncpg's executemany
+        self.row_sql = (f"INSERT INTO {table} ({', '.join(ALERT_COLUMNS)}) "
+                        f"VALUES ({', '.join(f'${i + 1}' for i in range(len(ALERT_COLUMNS)))})")
+
+        self.rows_checked = 0
+        self.raised = 0
+        self.written = 0
+        self.batches = 0
+        self.total_seconds = 0.0
+
+    @classmethod
+    def from_config(cls, config, publish=None):
+        """Create an engine from the alerts section, or None if disabled"""
+        alerts_config = config.get('alerts', {})
+        if not alerts_config.get('enabled', False) or not alerts_config.get('sensors'):
+            return None
+        return cls(alerts_config['sensors'],
+                   table=alerts_config.get('table', 'alerts'),
+                   topic=alerts_config.get('topic', 'alerts/{device_id}'),
+                   publish=publish,
+                   alpha=alerts_config.get('ewma_alpha', 0.05),
+                   warmup=alerts_config.get('warmup_readings', 30),
+                   cooldown=alerts_config.get('cooldown_seconds', 300.0))
+
+    def add_rows(self, rows):
+        with self._lock:
+            self._rows.extend(rows)
+
+    def take(self, close_all=False):
+        """Evaluate the rows buffered since the last call, returns the alerts to write"""
+        with self._lock:
+            rows, self._rows = self._rows, []
+        if rows:
+            start = time.perf_counter()
+            alerts = self.evaluate(rows)
+            elapsed = time.perf_counter() - start
+            self.batches += 1
+            self.total_seconds += elapsed
+            metrics.RULES_SECONDS.observe(elapsed)
+        else:
+            alerts = []
+        with self._lock:
+            alerts, self._ready = self._ready + alerts, []
+        return alerts
+
+    def evaluate(self, rows):
+        """Run every rule over ``rows`` and update the series state, returns the alerts"""
+        # Column-wise with C-level zip/map, a per-row Python loop costs more than all the rules
+        timestamps, devices, sensor_types, values, _ = zip(*rows)
+        types = np.fromiter(map(self._kinds.get, sensor_types, itertools.repeat(-1)), dtype=np.int64,
+                            count=len(rows))
+        keys = list(zip(devices, sensor_types))
+        slots = list(map(self._series.get, keys))
+        series = self._series
+        for index in [i for i, slot in enumerate(slots) if slot is None]:
+            # A new series, or a sensor type without rules
+            if types[index] >= 0:
+                slot = series.get(keys[index])
+                slots[index] = slot if slot is not None else series.setdefault(keys[index], len(series))
+            else:
+                slots[index] = -1
+        slots = np.fromiter(slots, dtype=np.int64, count=len(rows))
+        values = np.array(values, dtype=np.float64)
+        times = np.fromiter(_epoch_seconds(timestamps), dtype=np.float64, count=len(rows))
+        picked = np.flatnonzero(types >= 0)
+        if len(picked) < len(rows):
+            slots, types, values, times = slots[picked], types[picked], values[picked], times[picked]
+        self.rows_checked += len(picked)
+        if not len(picked):
+            return []
+        if len(series) > len(self._count):
+            self._grow(len(series))
+
+        alerts = []
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for index in _rounds(slots):
+                self._evaluate_round(rows, alerts, picked[index], slots[index], types[index],
+                                     values[index], times[index])
+        self.raised += len(alerts)
+        return alerts
+
+    def _evaluate_round(self, rows, alerts, picked, slots, types, values, times):
+        count = self._count[slots]
+        mean = self._mean[slots]
+        var = self._var[slots]
+        seen = count > 0
+        dt = times - self._last_time[slots]
+        # The variance starts at 0 and only reaches its level over ~1/alpha readings, scale it up meanwhile
+        settled = 1.0 - (1.0 - self.alpha) ** np.maximum(count - 1, 1)
+        readings = Readings(values, seen, values - self._last_value[slots], dt, mean, np.sqrt(var / settled),
+                            count >= self.warmup)
+
+        for number, rule in enumerate(self.rules):
+            threshold = self._thresholds[number, types]
+            breached, observed = rule.check(readings, threshold)
+            fired = np.flatnonzero(breached & (times - self._last_alert[number, slots] >= self.cooldown))
+            if not len(fired):
+                continue
+            self._last_alert[number, slots[fired]] = times[fired]
+            for i in fired.tolist():
+                timestamp, device_id, sensor_type, value, location_id = rows[picked[i]]
+                alerts.append((timestamp, device_id, sensor_type, location_id, rule.name, value,
+                               float(observed[i]), float(threshold[i])))
+
+        # EWMA mean and variance, the first reading of a series starts both
+        diff = values - mean
+        self._mean[slots] = np.where(seen, mean + self.alpha * diff, values)
+        self._var[slots] = np.where(seen, (1 - self.alpha) * (var + self.alpha * diff * diff), 0.0)
+        self._count[slots] = count + 1
+        # Rates are measured from the newest reading, an older redelivery does not move it back
+        newer = ~seen | (dt >= 0)
+        self._last_value[slots[newer]] = values[newer]
+        self._last_time[slots[newer]] = times[newer]
+
+    def _grow(self, size):
+        size = max(size, 2 * len(self._count), 1024)
+        self._last_value = _resized(self._last_value, size, 0.0)
+        self._last_time = _resized(self._last_time, size, 0.0)
+        self._mean = _resized(self._mean, size, 0.0)
+        self._var = _resized(self._var, size, 0.0)
+        self._count = _resized(self._count, size, 0)
+        self._last_alert = _resized(self._last_alert, size, -np.inf)
+
+    def requeue(self, alerts):
+        """Give back taken alerts whose transaction was rolled back"""
+        with self._lock:
+            self._ready = alerts + self._ready
+
+    def write(self, cur, alerts):
+        """Insert taken alerts with a psycopg2 cursor, the caller commits"""
+        extras.execute_values(cur, self._sql, alerts, page_size=1000)
+
+    def committed(self, alerts):
+        self.written += len(alerts)
+        for alert in alerts:
+            logger.info(f"Alert {alert[4]} on {alert[1]} {alert[2]}: {alert[6]:.2f} "
+                        f"(threshold {alert[7]:g}) at {alert[0]}")
+        if self.publish is not None and self.topic:
+            try:
+                self.publish(self.messages(alerts))
+            except Exception as e:
+                logger.error(f"Error publishing {len(alerts)} alerts: {e}")
+
+    def messages(self, alerts):
+        """(topic, JSON payload) of each alert"""
+        messages = []
+        for alert in alerts:
+            message = dict(zip(ALERT_COLUMNS, alert))
+            message['time'] = alert[0].isoformat()
+            messages.append((self.topic.format(**message), json.dumps(message)))
+        return messages
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._ready)
+        return {
+            'alerts_rows_checked': self.rows_checked,
+            'alerts_raised': self.raised,
+            'alerts_written': self.written,
+            'alerts_pending': pending,
+            'alerts_series': len(self._series),
+            'alerts_eval_seconds': self.total_seconds,
+            'alerts_batches': self.batches,
+        }
+
+
+def _epoch_seconds(timestamps):
+    # The rows of one message share their timestamp object
+    previous = at = None
+    for timestamp in timestamps:
+        if timestamp is not previous:
+            previous = timestamp
+            at = timestamp.timestamp()
+        yield at
+
+
+def _rounds(slots):
+    """Index arrays splitting a batch so no series appears twice in one,
+    keeping each series' readings in batch order"""
+    order = np.argsort(slots, kind='stable')
+    ordered = slots[order]
+    first = np.empty(len(ordered), dtype=bool)
+    first[0] = True
+    np.not_equal(ordered[1:], ordered[:-1], out=first[1:])
+    if first.all():
+        return [order]
+    positions = np.arange(len(ordered))
+    rank = positions - np.maximum.accumulate(np.where(first, positions, 0))
+    return [order[rank == r] for r in range(rank.max() + 1)]
+
+
+def _resized(column, size, fill):
+    grown = np.full(column.shape[:-1] + (size,), fill, dtype=column.dtype)
+    grown[..., :column.shape[-1]] = column
+    return grown
+
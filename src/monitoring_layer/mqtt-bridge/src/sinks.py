@@ -0,0 +1,344 @@
+import logging
+import queue
+import random
+import threading
+import time
+import zlib
+
+import metrics
+
+logger = logging.getLogger('mqtt-bridge')
+
+# Sentinel telling a worker to drain and exit
+_STOP = object()
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter between reconnect attempts.
+
+    The delay after ``failures`` consecutive failures is drawn uniformly
+    from [0, min(maximum, base * 2**failures)], so writers that lost the
+    database at the same moment do not reconnect in lockstep.
+    """
+
+    def __init__(self, base=1.0, maximum=30.0):
+        self.base = base
+        self.maximum = maximum
+
+    @classmethod
+    def from_config(cls, retry_config):
+        return cls(base=retry_config.get('min_delay_seconds', 1.0),
+                   maximum=retry_config.get('max_delay_seconds', 30.0))
+
+    def delay(self, failures):
+        return random.uniform(0, min(self.maximum, self.base * 2 ** min(failures, 32)))
+
+
+class Sink:
+    """One database target with its own queues, connections, batchers and retries.
+
+    ``submit(key, items)`` puts items on one of ``workers`` bounded queues,
+    sharded by a hash of ``key`` (the device id) so one device's items are
+    always written by the same worker, in order. Each worker thread owns a
+    connection from ``connect()`` and a writer from ``make_writer()`` (a
+    BatchWriter or anything with the same add_rows/maybe_flush/flush
+    interface and flush_count, flushed with ``final=True`` on shutdown) and
+    reconnects following ``retry``, also after a failed flush. ``queue_size``
+    is split evenly between the workers. When a queue is full the ``block``
+    policy waits up to ``block_timeout`` seconds before dropping; the ``drop``
+    policy drops immediately, so a slow sink never holds up the caller.
+
+    Sinks share nothing, so the pipeline can fan one message out to several
+    databases and a stalled one only fills its own queue. ``resize`` swaps
+    the workers for a new set while running, for config reloads.
+    """
+
+    def __init__(self, name, connect, make_writer, queue_size=10000, workers=4, policy='block',
+                 block_timeout=0.5, flush_interval=1.0, retry=None):
+        if policy not in ('block', 'drop'):
+            raise ValueError(f"Unknown queue policy: {policy}")
+
+        self.name = name
+        self.connect = connect
+        self.make_writer = make_writer
+        self.queues = [queue.Queue(maxsize=max(queue_size // workers, 1)) for _ in range(workers)]
+        self.worker_count = workers
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.flush_interval = flush_interval
+        self.retry = retry or RetryPolicy()
+
+        self._workers = []
+        self._writers = []
+        self._retired = {}  # counters of writers replaced by resize()
+        # Enqueue time of the oldest item each worker has buffered but not committed
+        self._oldest = [None] * workers
+        self._counter_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._started = None
+
+        self.enqueued = 0
+        self.dropped = 0
+        self.connect_errors = 0
+        self.backpressure_waits = 0
+        self.max_queue_depth = 0
+
+    def start(self):
+        self._started = time.monotonic()
+        self._stopping.clear()
+        self._start_workers()
+        logger.info(f"Started {self.worker_count} {self.name} writer workers, "
+                    f"queue size {self.queue_capacity()}, policy {self.policy}")
+
+    def _start_workers(self):
+        for index in range(self.worker_count):
+            writer = self.make_writer()
+            thread = threading.Thread(target=self._worker, args=(index, writer, self.queues[index]),
+                                      name=f"{self.name}-writer-{index}", daemon=True)
+            self._writers.append(writer)
+            self._workers.append(thread)
+            thread.start()
+
+    def resize(self, workers=None, queue_size=None, make_writer=None):
+        """Replace the running workers with ``workers`` new ones sharing
+        ``queue_size``, with writers from ``make_writer`` (all default to the
+        current ones), returns the seconds the new workers waited to start.
+
+        Items are queued for the new workers from the moment this is called,
+        but the new workers only start once the old ones have written
+        everything they had queued and buffered, so nothing is dropped and
+        each device's items are still written in order (rollup windows are
+        written out early and alert rule state starts over). Meanwhile the
+        new queues fill up under the usual policy.
+        """
+        workers = workers or self.worker_count
+        queue_size = queue_size or self.queue_capacity()
+        if make_writer is not None:
+            self.make_writer = make_writer
+        start = time.monotonic()
+        old_queues, old_workers, old_writers = self.queues, self._workers, self._writers
+        self._oldest = self._oldest + [None] * max(workers - len(self._oldest), 0)
+        self.queues = [queue.Queue(maxsize=max(queue_size // workers, 1)) for _ in range(workers)]
+        self.worker_count = workers
+        for work_queue in old_queues:
+            work_queue.put(_STOP)
+        for thread in old_workers:
+            thread.join()
+        self._retire(old_writers)
+
+        self._oldest = [None] * workers
+        self._workers, self._writers = [], []
+        self._start_workers()
+        waited = time.monotonic() - start
+        # A submit that picked an old queue before the swap can still be
+        # waiting on it, for up to block_timeout
+        self._stopping.wait(max(start + self.block_timeout + 0.1 - time.monotonic(), 0))
+        forwarded = 0
+        for work_queue in old_queues:
+            while True:
+                try:
+                    entry = work_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is not _STOP:
+                    self.queue_for(entry[1]).put(entry)
+                    forwarded += 1
+        logger.info(f"Resized {self.name} to {workers} writer workers, queue size {self.queue_capacity()}, "
+                    f"new workers waited {waited:.2f}s for the old ones to drain"
+                    + (f", {forwarded} late messages forwarded" if forwarded else ""))
+        return waited
+
+    def _retire(self, writers):
+        # Keep the counters of replaced writers so totals never go backwards
+        for writer in writers:
+            for key, value in writer.stats().items():
+                if key in metrics.COUNTERS or key in metrics.ERROR_TYPES:
+                    self._retired[key] = self._retired.get(key, 0) + value
+
+    def configure_writers(self, **options):
+        """Set attributes such as batch_size on every running writer"""
+        for writer in self._writers:
+            for name, value in options.items():
+                setattr(writer, name, value)
+
+    def queue_for(self, key):
+        """The worker queue a key is pinned to"""
+        return self.queues[zlib.crc32(key.encode()) % len(self.queues)]
+
+    def queue_depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def queue_capacity(self):
+        return sum(q.maxsize for q in self.queues)
+
+    def submit(self, key, items):
+        """Queue items for writing, returns False if they were dropped"""
+        target = self.queue_for(key)
+        entry = (time.monotonic(), key, items)
+        try:
+            target.put_nowait(entry)
+        except queue.Full:
+            if self.policy == 'drop':
+                self._count_drop()
+                return False
+            with self._counter_lock:
+                self.backpressure_waits += 1
+            try:
+                target.put(entry, timeout=self.block_timeout)
+            except queue.Full:
+                self._count_drop()
+                return False
+
+        depth = self.queue_depth()
+        with self._counter_lock:
+            self.enqueued += 1
+            if depth > self.max_queue_depth:
+                self.max_queue_depth = depth
+        return True
+
+    def _count_drop(self):
+        with self._counter_lock:
+            self.dropped += 1
+            dropped = self.dropped
+        # Log the first drop and then every 1000th to keep the hot path cheap
+        if dropped == 1 or dropped % 1000 == 0:
+            logger.warning(f"{self.name} queue full, {dropped} messages dropped so far")
+
+    def _worker(self, index, writer, work_queue):
+        # Consecutive failed connects and flushes, reset once a flush commits
+        failures = 0
+        flushes = writer.flush_count
+        while True:
+            if writer.conn is None:
+                if self._stopping.is_set():
+                    self._abandon(writer, work_queue)
+                    return
+                if not self._reconnect(writer, failures):
+                    failures += 1
+                    continue
+
+            try:
+                item = work_queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self._close_writer(writer)
+                return
+
+            try:
+                if item:
+                    enqueued_at, _, items = item
+                    if self._oldest[index] is None:
+                        self._oldest[index] = enqueued_at
+                    writer.add_rows(items)
+                writer.maybe_flush()
+            except Exception as e:
+                # Items stay in the writer's buffer, reconnect and retry after
+                # a backoff so a database that keeps failing is not hammered
+                self._drop_connection(writer)
+                delay = self.retry.delay(failures)
+                failures += 1
+                logger.error(f"{threading.current_thread().name}: {self.name} flush failed ({e}), "
+                             f"retrying in {delay:.1f}s")
+                self._stopping.wait(delay)
+            else:
+                if writer.flush_count != flushes:
+                    flushes = writer.flush_count
+                    failures = 0
+            if writer.pending() == 0:
+                self._oldest[index] = None
+
+    def _reconnect(self, writer, failures):
+        try:
+            writer.conn = self.connect()
+            return True
+        except Exception as e:
+            delay = self.retry.delay(failures)
+            with self._counter_lock:
+                self.connect_errors += 1
+            logger.error(f"{threading.current_thread().name}: {self.name} unavailable ({e}), "
+                         f"retrying in {delay:.1f}s")
+            self._stopping.wait(delay)
+            return False
+
+    def _drop_connection(self, writer):
+        try:
+            writer.conn.close()
+        except Exception:
+            pass
+        writer.conn = None
+
+    def _close_writer(self, writer):
+        try:
+            if writer.conn is not None:
+                writer.flush(final=True)
+        except Exception as e:
+            logger.error(f"Lost {writer.pending()} {self.name} items on shutdown: {e}")
+        finally:
+            if writer.conn is not None:
+                self._drop_connection(writer)
+
+    def _abandon(self, writer, work_queue):
+        # Stopping without a database: what is queued cannot be written
+        lost = 0
+        while True:
+            item = work_queue.get()
+            if item is _STOP:
+                break
+            lost += 1
+        logger.error(f"Lost {writer.pending()} buffered {self.name} items and {lost} queued messages "
+                     f"on shutdown, database unavailable")
+
+    def stop(self):
+        """Let workers drain their queues, flush, and exit. Workers without a
+        database connection give up on what they hold instead of waiting."""
+        self._stopping.set()
+        for work_queue in self.queues:
+            work_queue.put(_STOP)
+        for thread in self._workers:
+            thread.join()
+        self._workers = []
+
+    def lag(self):
+        """Age in seconds of the oldest item queued or buffered but not yet committed"""
+        now = time.monotonic()
+        oldest = [t for t in self._oldest if t is not None]
+        for work_queue in self.queues:
+            with work_queue.mutex:
+                if work_queue.queue and work_queue.queue[0] is not _STOP:
+                    oldest.append(work_queue.queue[0][0])
+        return now - min(oldest) if oldest else 0.0
+
+    def writer_stats(self):
+        """stats() of every worker's writer, and the counters of replaced ones"""
+        stats = [writer.stats() for writer in self._writers]
+        if self._retired:
+            stats.append(dict(self._retired, pending_rows=0))
+        return stats
+
+    def stats(self):
+        """Queue, writer and connection statistics for this sink"""
+        with self._counter_lock:
+            stats = {
+                'enqueued': self.enqueued,
+                'dropped': self.dropped,
+                'connect_errors': self.connect_errors,
+                'backpressure_waits': self.backpressure_waits,
+                'queue_depth': self.queue_depth(),
+                'queue_capacity': self.queue_capacity(),
+                'max_queue_depth': self.max_queue_depth,
+            }
+        writer_stats = self.writer_stats()
+        stats['rows_written'] = sum(s['rows_written'] for s in writer_stats)
+        stats['rows_pending'] = sum(s['pending_rows'] for s in writer_stats)
+        stats['flush_errors'] = sum(s['flush_errors'] for s in writer_stats)
+        stats['flushes'] = sum(s['flushes'] for s in writer_stats)
+        stats['rows_duplicate'] = sum(s.get('rows_duplicate', 0) for s in writer_stats)
+        stats['rows_dropped'] = sum(s.get('rows_dropped', 0) for s in writer_stats)
+        stats['workers_connected'] = sum(1 for writer in self._writers if writer.conn is not None)
+        stats['workers'] = len(self._writers)
+        stats['lag_seconds'] = self.lag()
+        elapsed = time.monotonic() - self._started if self._started is not None else 0.0
+        stats['rows_per_sec'] = stats['rows_written'] / elapsed if elapsed > 0 else 0.0
+        return stats
@@ -0,0 +1,131 @@
+import logging
+import os
+
+from paho.mqtt import client as mqtt_client
+
+logger = logging.getLogger('mqtt-bridge')
+
+DEFAULT_CERT_DIR = '/app/certs'
+DEFAULT_TOPICS = ['sensors/+/data', 'sensors/+/motion', 'sensors/+/status']
+
+
+def broker_settings(config):
+    """Resolve broker host/port/TLS settings from the bridge config.
+
+    Falls back to the AWS IoT endpoint with the certificates mounted from the
+    aws-iot-credentials secret. Point ``bridge.broker`` at a local mosquitto
+    (``tls: false``, port 1883) for testing.
+    """
+    bridge_config = config.get('bridge', {})
+    broker = bridge_config.get('broker', {})
+    cert_dir = broker.get('cert_dir', DEFAULT_CERT_DIR)
+
+    host = broker.get('host') or bridge_config.get('aws', {}).get('endpoint', 'localhost')
+    return {
+        'host': os.path.expandvars(host),
+        'port': broker.get('port', 8883),
+        'tls': broker.get('tls', True),
+        'ca_certs': broker.get('ca_certs', os.path.join(cert_dir, 'root-ca.crt')),
+        'certfile': broker.get('certfile', os.path.join(cert_dir, 'certificate.pem.crt')),
+        'keyfile': broker.get('keyfile', os.path.join(cert_dir, 'private.pem.key')),
+        'keepalive': broker.get('keepalive', 60),
+        # Every replica needs its own id, e.g. "k8s-mqtt-bridge-${HOSTNAME}"
+        'client_id': os.path.expandvars(bridge_config.get('client_id', 'k8s-mqtt-bridge')),
+    }
+
+
+def subscription_topics(config):
+    """Topics to subscribe to, as MQTT v5 shared subscriptions when
+    ``bridge.shared_subscription_group`` is set.
+
+    With ``$share/<group>/<topic>`` the broker delivers each message to only
+    one subscriber in the group, so bridge replicas split the load instead
+    of each writing every message.
+    """
+    bridge_config = config.get('bridge', {})
+    topics = bridge_config.get('topics', DEFAULT_TOPICS)
+    group = bridge_config.get('shared_subscription_group')
+    if not group:
+        return list(topics)
+    return [f"$share/{group}/{topic}" for topic in topics]
+
+
+class MQTTSubscriber:
+    """Subscribes to the configured topics and hands each message to a callback.
+
+    The callback runs on paho's network thread, so it must be quick: decode
+    and enqueue, never touch the database.
+    """
+
+    def __init__(self, config, on_message):
+        bridge_config = config.get('bridge', {})
+        self.topics = subscription_topics(config)
+        self.qos = bridge_config.get('qos', 1)
+        self.settings = broker_settings(config)
+        self.client_id = self.settings['client_id']
+        self.handler = on_message
+        self.client = None
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties=None):
+        if reason_code.is_failure:
+            logger.error(f"MQTT connection refused: {reason_code}")
+            return
+        logger.info(f"Connected to MQTT broker {self.settings['host']}:{self.settings['port']}")
+        client.subscribe([(topic, self.qos) for topic in self.topics])
+        logger.info(f"Subscribed to {', '.join(self.topics)}")
+
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties=None):
+        logger.warning(f"Disconnected from MQTT broker: {reason_code}")
+
+    def _on_message(self, client, userdata, msg):
+        try:
+            self.handler(msg.topic, msg.payload)
+        except Exception as e:
+            # Never let a bad message kill the network thread
+            logger.error(f"Error handling message on {msg.topic}: {e}")
+
+    def start(self):
+        self.client = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2,
+                                         client_id=self.client_id, protocol=mqtt_client.MQTTv5)
+        if self.settings['tls']:
+            self.client.tls_set(
+                ca_certs=self.settings['ca_certs'],
+                certfile=self.settings['certfile'],
+                keyfile=self.settings['keyfile'])
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_message = self._on_message
+        self.client.reconnect_delay_set(min_delay=1, max_delay=60)
+
+        self.client.connect(self.settings['host'], self.settings['port'], keepalive=self.settings['keepalive'])
+        self.client.loop_start()
+
+    def set_topics(self, config):
+        """Switch to the topics and QoS of a reloaded config without
+        reconnecting, returns True if they changed"""
+        topics = subscription_topics(config)
+        qos = config.get('bridge', {}).get('qos', 1)
+        if topics == self.topics and qos == self.qos:
+            return False
+        removed = [topic for topic in self.topics if topic not in topics]
+        self.topics, self.qos = topics, qos
+        if self.client is not None:
+            if removed:
+                self.client.unsubscribe(removed)
+            self.client.subscribe([(topic, qos) for topic in topics])
+        logger.info(f"Subscribed to {', '.join(topics)}"
+                    + (f", unsubscribed from {', '.join(removed)}" if removed else ""))
+        return True
+
+    def publish(self, messages):
+        """Publish (topic, payload) pairs, paho queues them while reconnecting"""
+        if self.client is None:
+            return
+        for topic, payload in messages:
+            self.client.publish(topic, payload, qos=self.qos)
+
+    def stop(self):
+        if self.client:
+            self.client.disconnect()
+            self.client.loop_stop()
+            logger.info("MQTT subscriber stopped")
@@ -0,0 +1,191 @@
+import logging
+import threading
+
+from batch_writer import BatchWriter
+
+logger = logging.getLogger('mqtt-bridge')
+
+# sensor_type values that get their own typed column in sensor_readings
+WIDE_SENSOR_TYPES = ('temperature', 'humidity', 'pressure', 'altitude', 'volume')
+
+WIDE_COLUMNS = ('time', 'device_key') + WIDE_SENSOR_TYPES + ('location_id',)
+
+# One row per reading with typed columns, device_id dictionary-encoded
+WIDE_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS devices (
+  device_key SERIAL PRIMARY KEY,
+  device_id TEXT NOT NULL UNIQUE,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS sensor_readings (
+  time TIMESTAMPTZ NOT NULL,
+  device_key INTEGER NOT NULL REFERENCES devices (device_key),
+  temperature DOUBLE PRECISION,
+  humidity DOUBLE PRECISION,
+  pressure DOUBLE PRECISION,
+  altitude DOUBLE PRECISION,
+  volume DOUBLE PRECISION,
+  location_id TEXT
+);
+
+SELECT create_hypertable('sensor_readings', 'time', if_not_exists => TRUE);
+
+CREATE INDEX IF NOT EXISTS idx_sensor_readings_device_time ON sensor_readings (device_key, time DESC);
+"""
+
+# Narrow-shaped view over sensor_readings so existing Grafana panels and
+# scripts that read from or insert into sensor_data keep working
+COMPAT_VIEW_SQL = """
+CREATE OR REPLACE VIEW sensor_data AS
+SELECT r.time, d.device_id, v.sensor_type, v.value, r.location_id
+FROM sensor_readings r
+JOIN devices d ON d.device_key = r.device_key
+CROSS JOIN LATERAL (VALUES
+  ('temperature', r.temperature),
+  ('humidity', r.humidity),
+  ('pressure', r.pressure),
+  ('altitude', r.altitude),
+  ('volume', r.volume)
+) AS v (sensor_type, value)
+WHERE v.value IS NOT NULL;
+
+CREATE OR REPLACE FUNCTION sensor_data_insert() RETURNS TRIGGER AS $$
+DECLARE
+  key INTEGER;
+BEGIN
+  INSERT INTO devices (device_id) VALUES (NEW.device_id)
+  ON CONFLICT (device_id) DO UPDATE SET device_id = EXCLUDED.device_id
+  RETURNING device_key INTO key;
+
+  INSERT INTO sensor_readings (time, device_key, temperature, humidity, pressure, altitude, volume, location_id)
+  VALUES (
+    NEW.time, key,
+    CASE WHEN NEW.sensor_type = 'temperature' THEN NEW.value END,
+    CASE WHEN NEW.sensor_type = 'humidity' THEN NEW.value END,
+    CASE WHEN NEW.sensor_type = 'pressure' THEN NEW.value END,
+    CASE WHEN NEW.sensor_type = 'altitude' THEN NEW.value END,
+    CASE WHEN NEW.sensor_type = 'volume' THEN NEW.value END,
+    NEW.location_id);
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS sensor_data_insert ON sensor_data;
+CREATE TRIGGER sensor_data_insert
+INSTEAD OF INSERT ON sensor_data
+FOR EACH ROW EXECUTE FUNCTION sensor_data_insert();
+"""
+
+UPSERT_DEVICE_SQL = """
+INSERT INTO devices (device_id) VALUES (%s)
+ON CONFLICT (device_id) DO UPDATE SET device_id = EXCLUDED.device_id
+RETURNING device_key
+"""
+
+
+def ensure_wide_schema(conn):
+    """Create the devices dictionary and sensor_readings hypertable if missing"""
+    cur = conn.cursor()
+    cur.execute(WIDE_SCHEMA_SQL)
+    conn.commit()
+    cur.close()
+
+
+def pivot_rows(rows):
+    """Group narrow (time, device_id, sensor_type, value, location_id) rows into
+    one dict of values per (time, device_id, location_id), preserving order"""
+    readings = {}
+    for timestamp, device_id, sensor_type, value, location_id in rows:
+        if sensor_type not in WIDE_SENSOR_TYPES:
+            continue
+        key = (timestamp, device_id, location_id)
+        values = readings.get(key)
+        if values is None:
+            values = readings[key] = {}
+        values[sensor_type] = value
+    return readings
+
+
+def wide_row(timestamp, device_key, values, location_id):
+    return (timestamp, device_key) + tuple(values.get(t) for t in WIDE_SENSOR_TYPES) + (location_id,)
+
+
+class DeviceRegistry:
+    """Thread-safe device_id -> device_key cache backed by the devices table"""
+
+    def __init__(self):
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def get(self, device_id):
+        return self._keys.get(device_id)
+
+    def put(self, device_id, device_key):
+        with self._lock:
+            self._keys[device_id] = device_key
+
+    def lookup(self, conn, device_id):
+        """Return the key for device_id, registering the device on first sight"""
+        key = self._keys.get(device_id)
+        if key is not None:
+            return key
+
+        cur = conn.cursor()
+        try:
+            cur.execute(UPSERT_DEVICE_SQL, (device_id,))
+            key = cur.fetchone()[0]
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+
+        self.put(device_id, key)
+        logger.info(f"Registered device {device_id} as key {key}")
+        return key
+
+    def __len__(self):
+        return len(self._keys)
+
+
+# Shared by every writer in the process so each device is looked up once
+device_registry = DeviceRegistry()
+
+
+class WideBatchWriter(BatchWriter):
+    """BatchWriter for the wide sensor_readings layout.
+
+    Accepts the same narrow rows as BatchWriter and pivots them into one
+    row per reading before buffering, so callers do not need to know which
+    layout is in use.
+    """
+
+    def __init__(self, conn, registry=None, **kwargs):
+        kwargs.setdefault('table', 'sensor_readings')
+        kwargs.setdefault('columns', WIDE_COLUMNS)
+        # sensor_readings has no unique key for ON CONFLICT to act on, only
+        # the bridge's in-memory dedup applies to this layout
+        kwargs['deduplicate'] = False
+        super().__init__(conn, **kwargs)
+        self.registry = registry or device_registry
+
+    def add_rows(self, rows):
+        wide = [
+            wide_row(timestamp, self.registry.lookup(self.conn, device_id), values, location_id)
+            for (timestamp, device_id, location_id), values in pivot_rows(rows).items()
+        ]
+        for stage in self.stages:
+            stage.add_rows(rows)
+        self._buffer(wide)
+
+
+def writer_class(config):
+    """Return the writer class for database.layout ("narrow" or "wide")"""
+    layout = config.get('database', {}).get('layout', 'narrow')
+    if layout == 'wide':
+        return WideBatchWriter
+    if layout != 'narrow':
+        raise ValueError(f"Unknown database layout: {layout}")
+    return BatchWriter
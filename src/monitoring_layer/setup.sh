@@ -137,6 +137,9 @@ kubectl wait --namespace iot-monitoring --for=condition=ready pod --selector=app
 echo -ne "    ${CYAN}• MQTT Bridge...${NC} "
 kubectl wait --namespace iot-monitoring --for=condition=ready pod --selector=app=mqtt-bridge --timeout=60s > /dev/null 2>&1 && echo -e "${GREEN}ready${NC}" || echo -e "${YELLOW}pending${NC}"
 
+echo -ne "    ${CYAN}• Query API...${NC} "
+kubectl wait --namespace iot-monitoring --for=condition=ready pod --selector=app=query-api --timeout=60s > /dev/null 2>&1 && echo -e "${GREEN}ready${NC}" || echo -e "${YELLOW}pending${NC}"
+
 echo -ne "    ${CYAN}• Grafana...${NC} "
 kubectl wait --namespace iot-monitoring --for=condition=ready pod --selector=app=grafana --timeout=60s > /dev/null 2>&1 && echo -e "${GREEN}ready${NC}" || echo -e "${YELLOW}pending${NC}"
 
@@ -184,6 +187,7 @@ echo -e "\n${BOLD}Service Endpoints:${NC}"
 echo -e "  ${PURPLE}• ${BOLD}TimescaleDB:${NC} timescaledb:5432"
 echo -e "  ${PURPLE}• ${BOLD}PostGIS:${NC} postgis:5432"
 echo -e "  ${PURPLE}• ${BOLD}MQTT Broker:${NC} mqtt-bridge:8883"
+echo -e "  ${PURPLE}• ${BOLD}Query API:${NC} query-api:8080"
 echo -e "  ${PURPLE}• ${BOLD}Grafana:${NC} grafana:3000 (http://grafana.local)"
 
 # Grafana access
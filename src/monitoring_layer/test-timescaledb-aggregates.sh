@@ -0,0 +1,138 @@
+#!/bin/bash
+# This script verifies TimescaleDB compression, retention and continuous aggregates
+# Ensure proper cleanup on script exit
+cleanup() {
+  echo -e "${YELLOW}Cleaning up port forwarding...${NC}"
+  if [ ! -z "$PF_PID" ]; then
+    kill $PF_PID 2>/dev/null || true
+  fi
+}
+
+# Colors for output
+GREEN='\033[0;32m'
+YELLOW='\033[1;33m'
+RED='\033[0;31m'
+PURPLE='\033[0;35m'
+NC='\033[0m' # No Color
+
+FAILURES=0
+
+# Set up cleanup on script exit
+trap cleanup EXIT
+
+echo -e "${PURPLE}Testing TimescaleDB compression, retention and continuous aggregates...${NC}"
+
+# Run SQL with clear section headers
+run_query() {
+  local title="$1"
+  local query="$2"
+  echo ""
+  echo -e "${YELLOW}===== $title =====${NC}"
+  PGPASSWORD=timescaledbpassword PAGER=/bin/cat psql -h localhost -p 5432 -U postgres -d sensor_data -X -c "$query" || {
+    echo -e "${RED}Query failed: $title${NC}"
+    FAILURES=$((FAILURES + 1))
+  }
+  echo ""
+}
+
+# EXPLAIN a query and check the plan reads the materialized hypertable
+# behind the continuous aggregate rather than raw sensor_data chunks
+check_plan() {
+  local title="$1"
+  local query="$2"
+  echo -e "${YELLOW}===== Plan: $title =====${NC}"
+  PLAN=$(PGPASSWORD=timescaledbpassword psql -h localhost -p 5432 -U postgres -d sensor_data -X -A -t -c "EXPLAIN $query")
+  echo "$PLAN" | sed 's/^/    /'
+  if echo "$PLAN" | grep -q "_materialized_hypertable_"; then
+    echo -e "${GREEN}✓ $title reads the continuous aggregate${NC}"
+  else
+    echo -e "${RED}✘ $title does not read the continuous aggregate${NC}"
+    FAILURES=$((FAILURES + 1))
+  fi
+  echo ""
+}
+
+# Forward the PostgreSQL port to localhost
+echo -e "${YELLOW}Setting up port forwarding to TimescaleDB...${NC}"
+kubectl port-forward -n iot-monitoring svc/timescaledb 5432:5432 &
+PF_PID=$!
+
+# Wait for port forwarding to be established
+sleep 3
+timeout 5 bash -c 'until nc -z localhost 5432; do sleep 0.5; done' || {
+  echo -e "${RED}Error: Port forwarding to TimescaleDB failed!${NC}"
+  exit 1
+}
+
+run_query "Chunk Interval" "
+SELECT hypertable_name, column_name, time_interval
+FROM timescaledb_information.dimensions
+WHERE hypertable_name = 'sensor_data';
+"
+
+run_query "Indexes on sensor_data" "
+SELECT indexname, indexdef FROM pg_indexes WHERE tablename = 'sensor_data';
+"
+
+run_query "Compression Settings" "
+SELECT attname, segmentby_column_index, orderby_column_index, orderby_asc
+FROM timescaledb_information.compression_settings
+WHERE hypertable_name = 'sensor_data';
+"
+
+run_query "Continuous Aggregates" "
+SELECT view_name, materialized_only, materialization_hypertable_name
+FROM timescaledb_information.continuous_aggregates
+ORDER BY view_name;
+"
+
+run_query "Scheduled Policies" "
+SELECT job_id, proc_name, hypertable_name, schedule_interval, config
+FROM timescaledb_information.jobs
+WHERE proc_name IN ('policy_compression', 'policy_retention', 'policy_refresh_continuous_aggregate')
+ORDER BY hypertable_name, proc_name;
+"
+
+# Insert test data spread over the last few hours and materialize it
+run_query "Insert Test Data" "
+INSERT INTO sensor_data (time, device_id, sensor_type, value, location_id)
+SELECT NOW() - (n * INTERVAL '5 minutes'), 'cagg-test', 'temperature', 20 + (n % 10), 'test-location'
+FROM generate_series(1, 48) AS n;
+"
+
+run_query "Refresh 1m Aggregate" "CALL refresh_continuous_aggregate('sensor_data_1m', NOW() - INTERVAL '1 day', NOW());"
+run_query "Refresh 1h Aggregate" "CALL refresh_continuous_aggregate('sensor_data_1h', NOW() - INTERVAL '1 day', NOW());"
+run_query "Refresh 1d Aggregate" "CALL refresh_continuous_aggregate('sensor_data_1d', NOW() - INTERVAL '7 days', NOW());"
+
+run_query "Hourly Aggregate for Test Device" "
+SELECT bucket, avg_value, min_value, max_value, reading_count
+FROM sensor_data_1h
+WHERE device_id = 'cagg-test'
+ORDER BY bucket DESC;
+"
+
+check_plan "1m panel query" "
+SELECT bucket, avg_value FROM sensor_data_1m
+WHERE device_id = 'cagg-test' AND sensor_type = 'temperature' AND bucket > NOW() - INTERVAL '3 hours'
+ORDER BY bucket;
+"
+
+check_plan "1h panel query" "
+SELECT bucket, avg_value, min_value, max_value FROM sensor_data_1h
+WHERE device_id = 'cagg-test' AND bucket > NOW() - INTERVAL '1 day'
+ORDER BY bucket;
+"
+
+check_plan "1d panel query" "
+SELECT device_id, sensor_type, avg_value FROM sensor_data_1d
+WHERE bucket > NOW() - INTERVAL '30 days';
+"
+
+run_query "Remove Test Data" "DELETE FROM sensor_data WHERE device_id = 'cagg-test';"
+
+if [ "$FAILURES" -eq 0 ]; then
+  echo -e "${GREEN}All TimescaleDB aggregate checks passed.${NC}"
+else
+  echo -e "${RED}$FAILURES TimescaleDB aggregate checks failed.${NC}"
+  exit 1
+fi
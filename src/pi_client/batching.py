@@ -0,0 +1,201 @@
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+# Batched payloads start with this magic, then a format version byte and a
+# codec byte, so the bridge can tell them from plain JSON events ("{...")
+MAGIC = b"PB"
+FORMAT_VERSION = 1
+CODECS = {"msgpack": 1, "json": 2}
+CONTENT_TYPES = {
+    1: "application/vnd.panopticon.batch+msgpack",
+    2: "application/vnd.panopticon.batch+json",
+}
+
+
+def _epoch_ms(timestamp):
+    if isinstance(timestamp, (int, float)):
+        return int(timestamp * 1000)
+    try:
+        parsed = datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return int(time.time() * 1000)
+    # Times without an offset are UTC, as the bridge reads them
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def encode_batch(events, device_id, codec="msgpack"):
+    """Pack events into one compact payload.
+
+    Field and event names are interned in a string table ``k`` and each
+    event becomes a flat list ``[dt_ms, event_index, field_index, value, ...]``
+    where dt_ms is the delay since the previous event (the first is
+    relative to ``t``). The location is sent once per batch, and so is the
+    boot id, with the events' sequence numbers in ``s``.
+
+    Body: {"d": device_id, "t": first_epoch_ms, "k": [...], "l": location,
+           "b": boot_id, "s": [seq, ...], "e": [...]}
+    """
+    strings = {}
+
+    def intern(name):
+        if name not in strings:
+            strings[name] = len(strings)
+        return strings[name]
+
+    encoded = []
+    location = None
+    first = previous = None
+    for event in events:
+        ms = _epoch_ms(event.get("timestamp"))
+        if first is None:
+            first = previous = ms
+        row = [ms - previous, intern(event.get("event", "reading"))]
+        previous = ms
+        for field, value in (event.get("sensor_data") or {}).items():
+            row.append(intern(field))
+            row.append(value)
+        encoded.append(row)
+        if location is None and event.get("location"):
+            location = event["location"]
+
+    body = {"d": device_id, "t": first or 0, "k": list(strings), "e": encoded}
+    if location is not None:
+        body["l"] = location
+    if events and all("seq" in event for event in events):
+        body["b"] = events[0].get("boot_id")
+        body["s"] = [event["seq"] for event in events]
+
+    if codec == "msgpack":
+        import msgpack
+        data = msgpack.packb(body)
+    else:
+        data = json.dumps(body, separators=(",", ":")).encode()
+    return MAGIC + bytes((FORMAT_VERSION, CODECS[codec])) + data
+
+
+def decode_batch(payload):
+    """Inverse of encode_batch, returns (device_id, events)"""
+    if payload[:2] != MAGIC or payload[2] != FORMAT_VERSION:
+        raise ValueError("Not a version 1 batch payload")
+    codec, data = payload[3], payload[4:]
+    if codec == CODECS["msgpack"]:
+        import msgpack
+        body = msgpack.unpackb(data)
+    else:
+        body = json.loads(data)
+
+    strings = body["k"]
+    events = []
+    ms = body["t"]
+    for index, row in enumerate(body["e"]):
+        ms += row[0]
+        sensor_data = {strings[row[i]]: row[i + 1] for i in range(2, len(row), 2)}
+        event = {"timestamp": ms / 1000, "event": strings[row[1]],
+                 "location": body.get("l"), "sensor_data": sensor_data}
+        if "s" in body:
+            event["boot_id"] = body.get("b")
+            event["seq"] = body["s"][index]
+        events.append(event)
+    return body["d"], events
+
+
+def content_type(payload):
+    """MQTT v5 content type advertising the payload's encoding and version"""
+    if payload[:2] == MAGIC and len(payload) > 3:
+        return f"{CONTENT_TYPES.get(payload[3], 'application/octet-stream')}; v={payload[2]}"
+    return "application/json"
+
+
+class BatchPublisher:
+    """Collects events and hands them on as one encoded message.
+
+    A batch is flushed when it holds ``max_events`` events or the oldest
+    event has waited ``max_delay`` seconds, whichever comes first. ``sink``
+    is called with the encoded payload from the caller's thread (size
+    flush) or the batcher's timer thread (time flush).
+    """
+
+    def __init__(self, sink, device_id, max_events=50, max_delay=1.0, codec="msgpack"):
+        if codec == "msgpack":
+            try:
+                import msgpack  # noqa: F401
+            except ImportError:
+                logging.warning("msgpack is not installed, batching with the JSON codec")
+                codec = "json"
+        self.sink = sink
+        self.device_id = device_id
+        self.max_events = max_events
+        self.max_delay = max_delay
+        self.codec = codec
+
+        self._events = []
+        self._deadline = None
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="batch-publisher", daemon=True)
+        self._thread.start()
+
+        # Metrics
+        self.batches = 0
+        self.events = 0
+        self.bytes = 0
+
+    def add(self, event):
+        with self._cond:
+            self._events.append(event)
+            if self._deadline is None:
+                self._deadline = time.monotonic() + self.max_delay
+                self._cond.notify()
+            if len(self._events) < self.max_events:
+                return
+            events = self._take()
+        self._emit(events)
+
+    def _take(self):
+        events, self._events, self._deadline = self._events, [], None
+        return events
+
+    def _emit(self, events):
+        if not events:
+            return
+        payload = encode_batch(events, self.device_id, self.codec)
+        self.batches += 1
+        self.events += len(events)
+        self.bytes += len(payload)
+        self.sink(payload)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and (self._deadline is None or self._deadline > time.monotonic()):
+                    timeout = None if self._deadline is None else self._deadline - time.monotonic()
+                    self._cond.wait(timeout)
+                if self._closed:
+                    return
+                events = self._take()
+            self._emit(events)
+
+    def flush(self):
+        with self._cond:
+            events = self._take()
+        self._emit(events)
+
+    def close(self):
+        """Flush what is pending and stop the timer thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout=5)
+        self.flush()
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "events_per_batch": self.events / self.batches if self.batches else 0.0,
+            "bytes_per_event": self.bytes / self.events if self.events else 0.0,
+        }
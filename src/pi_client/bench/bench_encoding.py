@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Bytes per reading and message rates: per-event JSON vs batched encodings.
+
+Generates events shaped like SensorManager.take_reading() output from the
+simulated BME280 driver, encodes them the current way (one JSON message per
+event) and as batches, and decodes every payload with the bridge's decoder
+to check the rows match:
+
+    python3 bench/bench_encoding.py --events 20000 --batch-sizes 10,50,200
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'monitoring_layer', 'mqtt-bridge', 'src'))
+
+import drivers  # noqa: E402
+from batching import encode_batch  # noqa: E402
+from decoder import decode_payload  # noqa: E402
+
+
+def make_events(count, interval):
+    driver = drivers.create("bme280", simulated=True, seed=1)
+    start = time.time() - count * interval
+    events = []
+    for i in range(count):
+        ts = start + i * interval
+        data = {key: round(value, 2 if key == "altitude_m" else 1) for key, value in driver.sample(i).items()}
+        data["temperature_f"] = round(data["temperature_c"] * 9/5 + 32, 1)
+        events.append({
+            "timestamp": datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S"),
+            "event": "regular_reading",
+            "location": {"city": "Portland", "region": "Oregon", "country": "US", "loc": "45.5,-122.6"},
+            "sensor_data": data,
+        })
+    return events
+
+
+def run(name, encode, events, topic):
+    start = time.perf_counter()
+    payloads = encode(events)
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rows = sum(len(decode_payload(topic, payload)) for payload in payloads)
+    decode_time = time.perf_counter() - start
+
+    total = sum(len(p) for p in payloads)
+    print(f"{name:<18} {len(payloads):>9} {total / len(events):>10.1f} {len(events) / encode_time:>12.0f} "
+          f"{len(payloads) / decode_time:>12.0f} {rows:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--interval", type=float, default=5.0, help="Seconds between readings")
+    parser.add_argument("--batch-sizes", default="10,50,200")
+    args = parser.parse_args()
+
+    events = make_events(args.events, args.interval)
+    topic = "sensors/bench-pi/data"
+    codecs = ["json"]
+    try:
+        import msgpack  # noqa: F401
+        codecs.insert(0, "msgpack")
+    except ImportError:
+        print("msgpack not installed, skipping the msgpack codec\n")
+
+    print(f"{'encoding':<18} {'messages':>9} {'B/reading':>10} {'enc ev/s':>12} {'dec msg/s':>12} {'rows':>9}")
+    run("json per event", lambda evs: [json.dumps(dict(e, device_id="bench-pi")).encode() for e in evs],
+        events, topic)
+    for codec in codecs:
+        for size in (int(s) for s in args.batch_sizes.split(",")):
+            run(f"{codec} x{size}",
+                lambda evs: [encode_batch(evs[i:i + size], "bench-pi", codec) for i in range(0, len(evs), size)],
+                events, topic)
+
+
+if __name__ == "__main__":
+    main()
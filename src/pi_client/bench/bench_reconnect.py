@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Simulate a fleet reconnecting after a broker blip.
+
+Every device loses its connection at t=0. The broker accepts at most
+--capacity connection attempts per second and refuses the rest, and
+refused devices retry using either plain exponential backoff (what paho's
+built-in reconnect does) or the full-jitter Backoff from connection.py.
+Reports the connection attempts the broker has to turn away and how long
+until the whole fleet is back:
+
+    python3 bench/bench_reconnect.py --devices 5000 --capacity 500
+"""
+import argparse
+import heapq
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from connection import Backoff  # noqa: E402
+
+
+class FixedBackoff(Backoff):
+    """Doubling delay without jitter"""
+
+    def next(self):
+        self.current = min(self.maximum, self.base * (2 ** self.attempt))
+        self.attempt += 1
+        return self.current
+
+
+def simulate(backoff_cls, devices, capacity, seed):
+    rng = random.Random(seed)
+    backoffs = [backoff_cls(base=1.0, maximum=120.0, rng=rng) for _ in range(devices)]
+    # Devices notice the drop within a keepalive tick of each other
+    events = [(rng.uniform(0, 0.05), d) for d in range(devices)]
+    heapq.heapify(events)
+
+    accepted_in_second = {}
+    attempts = 0
+    reconnect_times = []
+    while events:
+        when, device = heapq.heappop(events)
+        second = int(when)
+        attempts += 1
+        if accepted_in_second.get(second, 0) < capacity:
+            accepted_in_second[second] = accepted_in_second.get(second, 0) + 1
+            reconnect_times.append(when)
+        else:
+            heapq.heappush(events, (when + backoffs[device].next(), device))
+
+    reconnect_times.sort()
+    return attempts - devices, reconnect_times[len(reconnect_times) // 2], reconnect_times[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=5000)
+    parser.add_argument("--capacity", type=int, default=500, help="Connection attempts the broker accepts per second")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{'backoff':<14} {'refused':>10} {'half back (s)':>14} {'all back (s)':>13}")
+    for name, cls in (("exponential", FixedBackoff), ("full jitter", Backoff)):
+        refused, median, recovered = simulate(cls, args.devices, args.capacity, args.seed)
+        print(f"{name:<14} {refused:>10} {median:>14.1f} {recovered:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
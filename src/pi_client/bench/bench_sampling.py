@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Bus transactions and time per reading: property reads vs one burst read.
+
+Uses a register-level fake BMP280 where each transaction takes
+``--bus-delay`` seconds (~0.4 ms is typical for a 3-6 byte read at 100 kHz
+I2C), and also shows how decimation cuts the number of published points:
+
+    python3 bench/bench_sampling.py --reads 500 --decimation 5
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from drivers import BMP280Driver  # noqa: E402
+from fake_hw import FakeBMP280Chip  # noqa: E402
+from sampling import Decimator  # noqa: E402
+
+
+def property_read(chip):
+    # What read_temperature did before the sampling layer
+    return {
+        "temperature_c": round(chip.temperature, 1),
+        "temperature_f": round((chip.temperature * 9/5) + 32, 1),
+        "pressure_hpa": round(chip.pressure, 1),
+        "altitude_m": round(chip.altitude, 2),
+    }
+
+
+def measure(name, read, chip, reads):
+    chip.transactions = 0
+    start = time.perf_counter()
+    for _ in range(reads):
+        read()
+    elapsed = time.perf_counter() - start
+    print(f"{name:<12} {chip.transactions / reads:>10.1f} {elapsed / reads * 1000:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reads", type=int, default=200)
+    parser.add_argument("--bus-delay", type=float, default=0.0004)
+    parser.add_argument("--window", type=int, default=5)
+    parser.add_argument("--decimation", type=int, default=5)
+    args = parser.parse_args()
+
+    chip = FakeBMP280Chip(read_delay=args.bus_delay)
+    driver = BMP280Driver(sensor=chip)
+    driver.open()
+
+    print(f"{'method':<12} {'tx/read':>10} {'ms/read':>10}")
+    measure("properties", lambda: property_read(chip), chip, args.reads)
+    measure("burst", driver.read, chip, args.reads)
+
+    decimator = Decimator(args.window, args.decimation)
+    published = sum(1 for _ in range(args.reads) if decimator.add(driver.read()) is not None)
+    print(f"\ndecimation {args.decimation} (window {args.window}): {args.reads} samples -> {published} published")
+
+
+if __name__ == "__main__":
+    main()
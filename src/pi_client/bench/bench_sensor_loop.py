@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""Compare the old 100 ms polling loop with the event-driven SensorLoop.
+
+Runs both against fake GPIO and BMP280 backends, fires motion edges at
+random intervals, and reports process CPU usage and motion-to-publish
+latency percentiles:
+
+    python3 bench/bench_sensor_loop.py --motions 100
+"""
+import argparse
+import bisect
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fake_hw import FakeBMP280, FakeGPIO  # noqa: E402
+from scheduler import SensorLoop  # noqa: E402
+from sensor_utils import SensorManager  # noqa: E402
+
+PIR_PIN = 17
+
+
+class Recorder:
+    """Publish function that timestamps motion events"""
+
+    def __init__(self):
+        self.motion_publish_times = []
+
+    def __call__(self, event):
+        if event.get("event") == "motion_detected":
+            self.motion_publish_times.append(time.perf_counter())
+        return True
+
+
+def make_sensors(gpio):
+    sensors = SensorManager(gpio=gpio, temp_sensor=FakeBMP280(read_delay=0.002), pir_warmup=0)
+    sensors.get_location = lambda: {"city": "Bench"}
+    sensors.temp_interval = 1
+    sensors.initialize()
+    return sensors
+
+
+def fire_motions(gpio, count, seed, edge_times, hold):
+    # A real PIR holds its output high for a while after triggering
+    rng = random.Random(seed)
+    for _ in range(count):
+        time.sleep(rng.uniform(0.1, 0.4))
+        edge_times.append(time.perf_counter())
+        gpio.set_input(PIR_PIN, 1)
+        time.sleep(hold)
+        gpio.set_input(PIR_PIN, 0)
+
+
+def motion_latencies(edge_times, publish_times):
+    # Pair each publish with the most recent edge before it
+    latencies = []
+    for published in publish_times:
+        index = bisect.bisect_right(edge_times, published) - 1
+        if index >= 0:
+            latencies.append((published - edge_times[index]) * 1000)
+    return sorted(latencies)
+
+
+def run_polling(sensors, publish, done):
+    # The original main_app loop
+    while not done.is_set():
+        motion_event = sensors.check_motion()
+        if motion_event:
+            publish(motion_event)
+        temp_event = sensors.check_temperature()
+        if temp_event:
+            publish(temp_event)
+        time.sleep(0.1)
+
+
+def measure(mode, motions, seed, hold):
+    gpio = FakeGPIO()
+    sensors = make_sensors(gpio)
+    recorder = Recorder()
+    edge_times = []
+    done = threading.Event()
+
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    wall_start = time.perf_counter()
+
+    if mode == "polling":
+        runner = threading.Thread(target=run_polling, args=(sensors, recorder, done))
+        stop = done.set
+    else:
+        loop = SensorLoop(sensors, recorder, stats_interval=3600)
+        runner = threading.Thread(target=loop.run)
+        stop = loop.stop
+    runner.start()
+
+    fire_motions(gpio, motions, seed, edge_times, hold)
+    time.sleep(0.3)
+    stop()
+    runner.join()
+
+    wall = time.perf_counter() - wall_start
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    sensors.cleanup()
+
+    latencies = motion_latencies(edge_times, recorder.motion_publish_times)
+    return {
+        "cpu_pct": cpu / wall * 100,
+        "published": len(recorder.motion_publish_times),
+        "p50_ms": latencies[len(latencies) // 2] if latencies else float("nan"),
+        "p99_ms": latencies[int(len(latencies) * 0.99)] if latencies else float("nan"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--motions", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--hold", type=float, default=0.3, help="Seconds the PIR output stays high")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    os.chdir(tempfile.mkdtemp(prefix="bench-sensor-loop-"))
+
+    print(f"{'mode':<10} {'cpu %':>8} {'motions':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for mode in ("polling", "event"):
+        r = measure(mode, args.motions, args.seed, args.hold)
+        print(f"{mode:<10} {r['cpu_pct']:>8.2f} {r['published']:>8} {r['p50_ms']:>8.1f} {r['p99_ms']:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Run many simulated Pis in one process through the full client pipeline.
+
+Each virtual Pi gets its own SensorManager with seeded simulated drivers,
+its own data logs and its own SensorLoop; all publish into one counting
+sink. Reports readings and motion events per second, CPU and motion
+latency, e.g. on x86 CI:
+
+    python3 bench/bench_virtual_fleet.py --pis 50 --duration 30 --sample-rate 2
+"""
+import argparse
+import logging
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import drivers  # noqa: E402
+from scheduler import SensorLoop  # noqa: E402
+from sensor_utils import SensorManager  # noqa: E402
+
+
+class CountingSink:
+    """Thread-safe publish function counting events by type"""
+
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            key = event.get("event", "unknown")
+            self.counts[key] = self.counts.get(key, 0) + 1
+        return True
+
+
+def make_pi(index, args, sink, directory):
+    sensor_drivers = [drivers.create(name, simulated=True, seed=args.seed + index, sample_rate=args.sample_rate)
+                      for name in args.drivers.split(",")]
+    sensor_drivers.append(drivers.create("pir", simulated=True, seed=args.seed + index,
+                                         events_per_minute=args.motion_rate, hold=1.0))
+    sensors = SensorManager(drivers=sensor_drivers, pir_warmup=0,
+                            data_dir=os.path.join(directory, f"pi-{index:04d}"))
+    sensors.get_location = lambda: {"city": f"Virtual {index}"}
+    sensors.temp_interval = 1.0 / args.sample_rate
+    sensors.initialize()
+    return sensors, SensorLoop(sensors, sink, stats_interval=3600)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pis", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--drivers", default="bme280,max9814", help="Simulated environmental drivers per Pi")
+    parser.add_argument("--sample-rate", type=float, default=1.0, help="Readings per second per Pi")
+    parser.add_argument("--motion-rate", type=float, default=6.0, help="Motion events per minute per Pi")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    directory = tempfile.mkdtemp(prefix="bench-fleet-")
+    sink = CountingSink()
+
+    pis = [make_pi(i, args, sink, directory) for i in range(args.pis)]
+    runners = [threading.Thread(target=loop.run, daemon=True) for _, loop in pis]
+
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    for runner in runners:
+        runner.start()
+    time.sleep(args.duration)
+    for sensors, loop in pis:
+        loop.stop()
+    elapsed = time.perf_counter() - start
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+
+    latencies = sorted(l for _, loop in pis for l in loop.motion_latencies)
+    for sensors, _ in pis:
+        sensors.cleanup()
+
+    readings = sink.counts.get("regular_reading", 0)
+    motions = sink.counts.get("motion_detected", 0)
+    print(f"virtual pis:      {args.pis} ({args.drivers},pir) for {elapsed:.1f}s")
+    print(f"readings:         {readings} ({readings / elapsed:.0f}/s, "
+          f"expected ~{args.pis * args.sample_rate:.0f}/s)")
+    print(f"motion events:    {motions} ({motions / elapsed:.1f}/s)")
+    print(f"cpu:              {cpu / elapsed * 100:.1f}% of one core")
+    if latencies:
+        print(f"motion latency:   p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import logging
+import random
+import ssl
+import threading
+import time
+
+from paho.mqtt import client as mqtt_client
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+
+class Backoff:
+    """Exponential backoff with full jitter.
+
+    Each delay is drawn uniformly between ``minimum`` and
+    min(``maximum``, ``base`` * 2^attempt). Spreading retries over the whole
+    window keeps a fleet that lost the broker at the same moment from
+    reconnecting in lockstep.
+    """
+
+    def __init__(self, base=1.0, maximum=120.0, minimum=0.1, rng=None):
+        self.base = base
+        self.maximum = maximum
+        self.minimum = minimum
+        self.rng = rng or random.Random()
+        self.attempt = 0
+        self.current = 0.0
+
+    def next(self):
+        cap = min(self.maximum, self.base * (2 ** self.attempt))
+        self.attempt += 1
+        self.current = self.rng.uniform(self.minimum, max(cap, self.minimum))
+        return self.current
+
+    def reset(self):
+        self.attempt = 0
+        self.current = 0.0
+
+
+def build_tls_context(ca_certs, certfile, keyfile):
+    """TLS context for AWS IoT mutual auth, built once and reused on every reconnect"""
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=ca_certs)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    return context
+
+
+class ConnectionManager:
+    """Keeps a paho client connected, running its network loop on a thread.
+
+    Connects with clean_start=False and a session expiry interval so the
+    broker keeps the session across short outages. The same client object
+    is reused for every reconnect, so QoS 1 messages paho has in flight are
+    retransmitted after reconnecting rather than lost. Failed attempts and
+    dropped connections are retried with jittered exponential backoff.
+
+    The owner forwards its on_connect/on_disconnect callbacks to
+    ``connected()``/``disconnected()``.
+    """
+
+    def __init__(self, client, host, port, keepalive=120, session_expiry=3600, backoff=None):
+        self.client = client
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.session_expiry = session_expiry
+        self.backoff = backoff or Backoff()
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._socket_open = False
+        self._first_attempt = True
+        self._disconnected_at = time.monotonic()
+
+        # Metrics
+        self.connects = 0
+        self.connect_failures = 0
+        self.session_present = False
+        self.last_reconnect_seconds = None
+        self.disconnected_seconds = 0.0
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="mqtt-connection", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def _connect_properties(self):
+        properties = Properties(PacketTypes.CONNECT)
+        properties.SessionExpiryInterval = self.session_expiry
+        return properties
+
+    def _try_connect(self):
+        try:
+            if self._first_attempt:
+                self.client.connect(self.host, self.port, keepalive=self.keepalive, clean_start=False,
+                                    properties=self._connect_properties())
+                self._first_attempt = False
+            else:
+                self.client.reconnect()
+            self._socket_open = True
+            return True
+        except Exception as e:
+            self.connect_failures += 1
+            logging.warning(f"Connection to MQTT broker failed: {str(e)}")
+            return False
+
+    def _wait_backoff(self):
+        delay = self.backoff.next()
+        logging.info(f"Reconnecting to MQTT broker in {delay:.1f}s (attempt {self.backoff.attempt})")
+        self._stop.wait(delay)
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self._socket_open and not self._try_connect():
+                self._wait_backoff()
+                continue
+
+            rc = self.client.loop(timeout=1.0)
+            if rc != mqtt_client.MQTT_ERR_SUCCESS and not self._stop.is_set():
+                self._socket_open = False
+                self._wait_backoff()
+
+        if self._socket_open:
+            self.client.disconnect()
+            self.client.loop(timeout=1.0)
+            self._socket_open = False
+
+    def connected(self, flags, reason_code):
+        """Call from on_connect"""
+        if reason_code.is_failure:
+            self.connect_failures += 1
+            return
+        now = time.monotonic()
+        if self._disconnected_at is not None:
+            outage = now - self._disconnected_at
+            self.disconnected_seconds += outage
+            if self.connects:
+                self.last_reconnect_seconds = outage
+            self._disconnected_at = None
+        self.connects += 1
+        self.session_present = bool(flags.session_present)
+        self.backoff.reset()
+
+    def disconnected(self):
+        """Call from on_disconnect"""
+        if self._disconnected_at is None:
+            self._disconnected_at = time.monotonic()
+
+    def is_connected(self):
+        return self.client.is_connected()
+
+    def stats(self):
+        outage = time.monotonic() - self._disconnected_at if self._disconnected_at is not None else 0.0
+        return {
+            "reconnects": max(self.connects - 1, 0),
+            "connect_failures": self.connect_failures,
+            "session_present": self.session_present,
+            "last_reconnect_s": self.last_reconnect_seconds,
+            "disconnected_s_total": self.disconnected_seconds + outage,
+            "reconnect_backoff_s": self.backoff.current,
+        }
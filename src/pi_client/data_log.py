@@ -0,0 +1,179 @@
+import glob
+import gzip
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+
+class DataLog:
+    """Append-only NDJSON log with daily rotation.
+
+    Records are written as one compact JSON object per line to
+    ``{directory}/{prefix}_YYYY-MM-DD.ndjson`` through a buffered file
+    handle. Data is fsynced at most every ``fsync_interval`` seconds (and on
+    rotation/close) instead of on every record, which keeps SD card writes
+    small and sequential. When the day changes the closed file is compressed
+    in the background with gzip, or zstd if the zstandard package is
+    installed and ``compression="zstd"``.
+    """
+
+    def __init__(self, directory="sensor_data", prefix="daily", fsync_interval=30, compression="gzip",
+                 buffer_size=64 * 1024):
+        self.directory = directory
+        self.prefix = prefix
+        self.fsync_interval = fsync_interval
+        self.compression = compression
+        self.buffer_size = buffer_size
+
+        self._file = None
+        self._day = None
+        self._last_sync = time.monotonic()
+        self._lock = threading.Lock()
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # Compress anything left uncompressed by a previous run, except today's file
+        self._compress_in_background(keep=self.path_for(datetime.now().strftime("%Y-%m-%d")))
+
+    def path_for(self, day):
+        return os.path.join(self.directory, f"{self.prefix}_{day}.ndjson")
+
+    def append(self, record):
+        """Append one record, rotating to a new file when the day changes"""
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        day = datetime.now().strftime("%Y-%m-%d")
+
+        with self._lock:
+            if day != self._day:
+                self._rotate(day)
+            self._file.write(line)
+
+            if time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync()
+
+    def _rotate(self, day):
+        closed = self._file
+        if closed is not None:
+            self._sync()
+            closed.close()
+        self._day = day
+        self._file = open(self.path_for(day), "a", buffering=self.buffer_size)
+        if closed is not None:
+            self._compress_in_background(keep=self.path_for(day))
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_sync = time.monotonic()
+
+    def flush(self):
+        """Flush buffered records to disk now"""
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
+                self._day = None
+
+    def _compress_in_background(self, keep):
+        if self.compression:
+            threading.Thread(target=self._compress_closed_files, args=(keep,), name=f"{self.prefix}-compress",
+                             daemon=True).start()
+
+    def _compress_closed_files(self, keep):
+        if not self.compression:
+            return
+        # ``keep`` is the file being appended to, chosen by the caller: reading
+        # self._day from this thread could race with a rotation
+        for path in sorted(glob.glob(os.path.join(self.directory, f"{self.prefix}_*.ndjson"))):
+            if path == keep:
+                continue
+            try:
+                compress_file(path, self.compression)
+            except Exception as e:
+                logging.error(f"Error compressing {path}: {str(e)}")
+
+
+def compress_file(path, compression="gzip"):
+    """Compress a closed NDJSON file next to itself and remove the original"""
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            logging.warning("zstandard is not installed, falling back to gzip")
+            compression = "gzip"
+
+    if compression == "zstd":
+        target = path + ".zst"
+        with open(path, "rb") as src, open(target + ".tmp", "wb") as dst:
+            zstandard.ZstdCompressor(level=10).copy_stream(src, dst)
+    else:
+        target = path + ".gz"
+        with open(path, "rb") as src, gzip.open(target + ".tmp", "wb") as dst:
+            while True:
+                chunk = src.read(1024 * 1024)
+                if not chunk:
+                    break
+                dst.write(chunk)
+
+    os.replace(target + ".tmp", target)
+    os.remove(path)
+    logging.info(f"Compressed {path} to {target}")
+    return target
+
+
+def _open_text(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt")
+    if path.endswith(".zst"):
+        import zstandard
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, "rb")))
+    return open(path, "r")
+
+
+def read_records(path):
+    """Stream records back from one .ndjson, .ndjson.gz or .ndjson.zst file.
+
+    A truncated last line, e.g. after a power cut before the last fsync, is
+    skipped rather than failing the whole file.
+    """
+    with _open_text(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                logging.warning(f"Skipping corrupt line in {path}")
+
+
+def log_files(directory="sensor_data", prefix="daily"):
+    """All log files for a prefix in chronological order, compressed or not"""
+    paths = glob.glob(os.path.join(directory, f"{prefix}_*.ndjson*"))
+    return sorted(p for p in paths if not p.endswith(".tmp"))
+
+
+def read_all(directory="sensor_data", prefix="daily"):
+    """Stream every record for a prefix, oldest file first"""
+    for path in log_files(directory, prefix):
+        yield from read_records(path)
+
+
+if __name__ == "__main__":
+    # Usage: python data_log.py [directory] [prefix]  -> NDJSON on stdout
+    directory = sys.argv[1] if len(sys.argv) > 1 else "sensor_data"
+    prefix = sys.argv[2] if len(sys.argv) > 2 else "daily"
+    for record in read_all(directory, prefix):
+        sys.stdout.write(json.dumps(record) + "\n")
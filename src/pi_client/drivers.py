@@ -0,0 +1,433 @@
+import logging
+import math
+import os
+import random
+import threading
+import time
+
+# name -> driver class, filled in by @register
+_REGISTRY = {}
+
+
+def register(name):
+    """Class decorator adding a driver to the registry under ``name``"""
+    def decorator(cls):
+        cls.name = name
+        _REGISTRY[name] = cls
+        return cls
+    return decorator
+
+
+def available():
+    return sorted(_REGISTRY)
+
+
+def create(name, simulated=False, **options):
+    """Create a driver by name. With ``simulated=True`` a deterministic
+    SimulatedDriver producing the same fields is returned instead."""
+    try:
+        cls = _REGISTRY[name]
+    except KeyError:
+        raise ValueError(f"Unknown sensor driver '{name}', available: {', '.join(available())}")
+    if simulated and cls is not PIRDriver:
+        return SimulatedDriver(kind=name, fields=cls.fields, **options)
+    if simulated:
+        return SimulatedPIR(**options)
+    return cls(**options)
+
+
+def parse_spec(spec):
+    """Parse a SENSOR_DRIVERS string such as "bme280:address=0x76,pir:pin=17"
+    into (name, options) tuples. Options are separated by ";", values are
+    converted to int or float where possible."""
+    drivers = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, rest = item.partition(":")
+        options = {}
+        for pair in filter(None, rest.split(";")):
+            key, _, value = pair.partition("=")
+            try:
+                options[key] = int(value, 0)
+            except ValueError:
+                try:
+                    options[key] = float(value)
+                except ValueError:
+                    options[key] = value
+        drivers.append((name, options))
+    return drivers
+
+
+def from_env(default="bmp280:address=0x77,pir:pin=17"):
+    """Build drivers from SENSOR_DRIVERS and SENSOR_BACKEND ("hardware" or "simulated")"""
+    simulated = os.getenv("SENSOR_BACKEND", "hardware") == "simulated"
+    spec = os.getenv("SENSOR_DRIVERS", default)
+    return [create(name, simulated=simulated, **options) for name, options in parse_spec(spec)]
+
+
+class SensorDriver:
+    """Base class for sensor drivers.
+
+    Hardware libraries are imported in ``open()``, not at module import, so
+    the client starts quickly and runs off-Pi with the simulated backend.
+    ``read()`` returns a dict of payload fields, e.g. {"temperature_c": 21.3}.
+    """
+
+    name = None
+    fields = ()
+
+    def open(self):
+        pass
+
+    def read(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+# First data register; pressure, temperature (and humidity on the BME280)
+# follow in one block so a single burst read gets a consistent sample
+_REGISTER_DATA = 0xF7
+
+
+def altitude_from_pressure(pressure_hpa, sea_level_pressure=1013.25):
+    return 44330 * (1.0 - math.pow(pressure_hpa / sea_level_pressure, 0.1903))
+
+
+@register("bmp280")
+class BMP280Driver(SensorDriver):
+    """Bosch BMP280 temperature/pressure sensor over I2C.
+
+    The adafruit properties each cost a bus transaction and ``pressure`` and
+    ``altitude`` re-read the temperature, so ``read()`` instead burst-reads
+    the data registers once and compensates with the chip's calibration.
+    Altitude is derived from that same pressure sample. Oversampling, IIR
+    filter, standby time and mode are written to the chip in ``open()``.
+    Sensors without register access (e.g. FakeBMP280) are read through the
+    properties, once each.
+    """
+
+    fields = ("temperature_c", "pressure_hpa", "altitude_m")
+    burst_length = 6
+
+    def __init__(self, address=0x77, sea_level_pressure=1013.25, sensor=None, oversampling_temperature=2,
+                 oversampling_pressure=16, iir_filter=4, standby_ms="62_5", mode="normal"):
+        self.address = address
+        self.sea_level_pressure = sea_level_pressure
+        self.sensor = sensor
+        self.oversampling_temperature = oversampling_temperature
+        self.oversampling_pressure = oversampling_pressure
+        self.iir_filter = iir_filter
+        self.standby_ms = standby_ms
+        self.mode = mode
+        self._library = None
+        self._burst_capable = False
+
+    def open(self):
+        if self.sensor is None:
+            import board
+            import adafruit_bmp280
+            self._library = adafruit_bmp280
+            self.sensor = adafruit_bmp280.Adafruit_BMP280_I2C(board.I2C(), address=self.address)
+        self.sensor.sea_level_pressure = self.sea_level_pressure
+        if self._library is not None:
+            self.configure()
+        self._burst_capable = hasattr(self.sensor, "_read_register") and hasattr(self.sensor, "_temp_calib")
+
+    def configure(self):
+        """Write oversampling, filter and mode settings to the chip"""
+        lib = self._library
+        self.sensor.mode = lib.MODE_SLEEP  # settings only stick while sleeping
+        self.sensor.overscan_temperature = self._oversampling(self.oversampling_temperature)
+        self.sensor.overscan_pressure = self._oversampling(self.oversampling_pressure)
+        self.sensor.iir_filter = (getattr(lib, f"IIR_FILTER_X{self.iir_filter}") if self.iir_filter
+                                  else lib.IIR_FILTER_DISABLE)
+        self.sensor.standby_period = getattr(lib, f"STANDBY_TC_{self.standby_ms}")
+        self.sensor.mode = lib.MODE_NORMAL if self.mode == "normal" else lib.MODE_SLEEP
+        logging.info(f"{self.name} configured: oversampling T x{self.oversampling_temperature} "
+                     f"P x{self.oversampling_pressure}, IIR {self.iir_filter}, mode {self.mode}")
+
+    def _oversampling(self, factor):
+        lib = self._library
+        return getattr(lib, f"OVERSCAN_X{factor}") if factor else lib.OVERSCAN_DISABLE
+
+    def _burst(self):
+        """One bus transaction returning the raw data registers"""
+        if self.mode != "normal" and self._library is not None:
+            # Forced mode: trigger a conversion and wait for it to finish
+            self.sensor.mode = self._library.MODE_FORCE
+            while self.sensor._get_status() & 0x08:
+                time.sleep(0.002)
+        return self.sensor._read_register(_REGISTER_DATA, self.burst_length)
+
+    def _compensate(self, data):
+        """Temperature (C) and pressure (hPa) from a burst, per the BMP280 datasheet.
+        Sets the sensor's t_fine for the humidity compensation of the BME280."""
+        t1, t2, t3 = self.sensor._temp_calib
+        raw_pressure = ((data[0] << 16) | (data[1] << 8) | data[2]) / 16
+        raw_temperature = ((data[3] << 16) | (data[4] << 8) | data[5]) / 16
+
+        var1 = (raw_temperature / 16384.0 - t1 / 1024.0) * t2
+        var2 = ((raw_temperature / 131072.0 - t1 / 8192.0) ** 2) * t3
+        t_fine = int(var1 + var2)
+        self.sensor._t_fine = t_fine
+
+        p1, p2, p3, p4, p5, p6, p7, p8, p9 = self.sensor._pressure_calib
+        var1 = t_fine / 2.0 - 64000.0
+        var2 = var1 * var1 * p6 / 32768.0
+        var2 = var2 + var1 * p5 * 2.0
+        var2 = var2 / 4.0 + p4 * 65536.0
+        var1 = (p3 * var1 * var1 / 524288.0 + p2 * var1) / 524288.0
+        var1 = (1.0 + var1 / 32768.0) * p1
+        if not var1:
+            raise ArithmeticError("Invalid pressure calibration data")
+        pressure = ((1048576.0 - raw_pressure - var2 / 4096.0) * 6250.0) / var1
+        var1 = p9 * pressure * pressure / 2147483648.0
+        var2 = pressure * p8 / 32768.0
+        pressure = pressure + (var1 + var2 + p7) / 16.0
+        return t_fine / 5120.0, pressure / 100
+
+    def read(self):
+        if self._burst_capable:
+            temperature, pressure = self._compensate(self._burst())
+        else:
+            temperature, pressure = self.sensor.temperature, self.sensor.pressure
+        return {
+            "temperature_c": temperature,
+            "pressure_hpa": pressure,
+            "altitude_m": altitude_from_pressure(pressure, self.sea_level_pressure),
+        }
+
+
+@register("bme280")
+class BME280Driver(BMP280Driver):
+    """Bosch BME280, a BMP280 with a humidity sensor. The humidity registers
+    follow the pressure and temperature ones, so the burst is 8 bytes."""
+
+    fields = ("temperature_c", "pressure_hpa", "altitude_m", "humidity")
+    burst_length = 8
+
+    def __init__(self, address=0x77, oversampling_humidity=1, **options):
+        super().__init__(address, **options)
+        self.oversampling_humidity = oversampling_humidity
+
+    def open(self):
+        if self.sensor is None:
+            import board
+            from adafruit_bme280 import basic as adafruit_bme280
+            self._library = adafruit_bme280
+            self.sensor = adafruit_bme280.Adafruit_BME280_I2C(board.I2C(), address=self.address)
+        self.sensor.sea_level_pressure = self.sea_level_pressure
+        if self._library is not None:
+            self.sensor.overscan_humidity = self._oversampling(self.oversampling_humidity)
+            self.configure()
+        self._burst_capable = hasattr(self.sensor, "_read_register") and hasattr(self.sensor, "_humidity_calib")
+
+    def _compensate_humidity(self, data):
+        h1, h2, h3, h4, h5, h6 = self.sensor._humidity_calib
+        raw_humidity = (data[6] << 8) | data[7]
+        var1 = float(self.sensor._t_fine) - 76800.0
+        var2 = h4 * 64.0 + (h5 / 16384.0) * var1
+        var3 = raw_humidity - var2
+        var4 = h2 / 65536.0
+        var5 = 1.0 + (h3 / 67108864.0) * var1
+        var6 = 1.0 + (h6 / 67108864.0) * var1 * var5
+        var6 = var3 * var4 * (var5 * var6)
+        humidity = var6 * (1.0 - h1 * var6 / 524288.0)
+        return min(max(humidity, 0.0), 100.0)
+
+    def read(self):
+        if not self._burst_capable:
+            values = super().read()
+            values["humidity"] = self.sensor.relative_humidity
+            return values
+        data = self._burst()
+        temperature, pressure = self._compensate(data)
+        return {
+            "temperature_c": temperature,
+            "pressure_hpa": pressure,
+            "altitude_m": altitude_from_pressure(pressure, self.sea_level_pressure),
+            "humidity": self._compensate_humidity(data),
+        }
+
+
+@register("dht22")
+class DHT22Driver(SensorDriver):
+    """DHT22/AM2302 temperature/humidity sensor on a single GPIO pin.
+
+    The DHT22 protocol is timing sensitive and reads fail regularly, so a
+    failed read returns the last good values (if recent) instead of raising.
+    """
+
+    fields = ("temperature_c", "humidity")
+
+    def __init__(self, pin=4, max_age=10):
+        self.pin = pin
+        self.max_age = max_age
+        self.device = None
+        self._last = None
+        self._last_time = 0
+
+    def open(self):
+        import board
+        import adafruit_dht
+        self.device = adafruit_dht.DHT22(getattr(board, f"D{self.pin}"), use_pulseio=False)
+
+    def read(self):
+        try:
+            self._last = {"temperature_c": self.device.temperature, "humidity": self.device.humidity}
+            self._last_time = time.monotonic()
+        except RuntimeError as e:
+            if self._last is None or time.monotonic() - self._last_time > self.max_age:
+                raise
+            logging.debug(f"DHT22 read failed ({str(e)}), using last reading")
+        return dict(self._last)
+
+    def close(self):
+        if self.device is not None:
+            self.device.exit()
+
+
+@register("max9814")
+class MAX9814Driver(SensorDriver):
+    """MAX9814 microphone amplifier read through an ADS1115 ADC.
+
+    Samples the analog output for ``window`` seconds and reports the
+    peak-to-peak amplitude as a level in dB relative to ``reference_volts``.
+    """
+
+    fields = ("volume_db",)
+
+    def __init__(self, channel=0, adc_address=0x48, window=0.05, reference_volts=0.00631):
+        self.channel = channel
+        self.adc_address = adc_address
+        self.window = window
+        self.reference_volts = reference_volts
+        self.analog_in = None
+
+    def open(self):
+        import board
+        import adafruit_ads1x15.ads1115 as ADS
+        from adafruit_ads1x15.analog_in import AnalogIn
+        adc = ADS.ADS1115(board.I2C(), address=self.adc_address, data_rate=860)
+        self.analog_in = AnalogIn(adc, getattr(ADS, f"P{self.channel}"))
+
+    def read(self):
+        low, high = float("inf"), float("-inf")
+        deadline = time.monotonic() + self.window
+        while time.monotonic() < deadline:
+            volts = self.analog_in.voltage
+            low = min(low, volts)
+            high = max(high, volts)
+        peak_to_peak = max(high - low, 1e-6)
+        return {"volume_db": 20 * math.log10(peak_to_peak / self.reference_volts)}
+
+
+@register("pir")
+class PIRDriver(SensorDriver):
+    """HC-SR501 style PIR motion sensor on a GPIO pin"""
+
+    fields = ("motion",)
+
+    def __init__(self, pin=17, gpio=None):
+        self.pin = pin
+        self.gpio = gpio
+
+    def open(self):
+        if self.gpio is None:
+            import RPi.GPIO as GPIO
+            self.gpio = GPIO
+        self.gpio.setmode(self.gpio.BCM)
+        self.gpio.setup(self.pin, self.gpio.IN)
+
+    def read(self):
+        return {"motion": bool(self.gpio.input(self.pin))}
+
+    def watch(self, callback):
+        """Call ``callback(channel)`` on every edge. Raises RuntimeError if
+        the GPIO library cannot add edge detection."""
+        self.gpio.add_event_detect(self.pin, self.gpio.BOTH, callback=callback, bouncetime=50)
+
+    def close(self):
+        if self.gpio is not None:
+            self.gpio.cleanup()
+
+
+# Baseline, daily swing and noise used by the simulated backend per field
+SIMULATED_PROFILES = {
+    "temperature_c": (21.0, 3.0, 0.1),
+    "humidity": (45.0, 10.0, 0.5),
+    "pressure_hpa": (1001.0, 2.0, 0.05),
+    "altitude_m": (100.0, 0.0, 0.2),
+    "volume_db": (35.0, 10.0, 4.0),
+}
+
+
+class SimulatedDriver(SensorDriver):
+    """Deterministic stand-in for any environmental driver.
+
+    Values are a function of the seed and the sample index only (a daily
+    sine plus seeded noise), so two runs with the same seed produce the same
+    series however often read() is called. ``sample_rate`` (Hz) emulates the
+    sensor's conversion rate: reads between samples return the last sample.
+    ``read_delay`` emulates bus latency.
+    """
+
+    def __init__(self, kind="bmp280", fields=None, seed=0, sample_rate=1.0, read_delay=0.0, clock=time.time):
+        self.kind = kind
+        self.fields = tuple(fields or SIMULATED_PROFILES)
+        self.seed = seed
+        self.sample_rate = sample_rate
+        self.read_delay = read_delay
+        self.clock = clock
+
+    def sample(self, index):
+        rng = random.Random(self.seed * 1000003 + index)
+        day_phase = (index / self.sample_rate) % 86400 / 86400 * 2 * math.pi
+        values = {}
+        for field in self.fields:
+            base, swing, noise = SIMULATED_PROFILES.get(field, (0.0, 0.0, 1.0))
+            values[field] = base + swing * math.sin(day_phase - math.pi / 2) + rng.gauss(0, noise)
+        return values
+
+    def read(self):
+        if self.read_delay:
+            time.sleep(self.read_delay)
+        return self.sample(int(self.clock() * self.sample_rate))
+
+
+class SimulatedPIR(PIRDriver):
+    """PIR driver on a fake GPIO pin that fires seeded, randomly spaced motion.
+
+    Motion starts follow an exponential distribution with
+    ``events_per_minute`` mean rate and stay high for ``hold`` seconds.
+    """
+
+    def __init__(self, pin=17, seed=0, events_per_minute=2.0, hold=2.0):
+        from fake_hw import FakeGPIO
+        super().__init__(pin=pin, gpio=FakeGPIO())
+        self.rng = random.Random(seed)
+        self.events_per_minute = events_per_minute
+        self.hold = hold
+        self._stop = threading.Event()
+        self._thread = None
+
+    def open(self):
+        super().open()
+        if self.events_per_minute > 0:
+            self._thread = threading.Thread(target=self._run, name=f"sim-pir-{self.pin}", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.rng.expovariate(self.events_per_minute / 60.0)):
+            self.gpio.set_input(self.pin, 1)
+            if self._stop.wait(self.hold):
+                break
+            self.gpio.set_input(self.pin, 0)
+
+    def close(self):
+        self._stop.set()
+        super().close()
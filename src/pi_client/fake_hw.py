@@ -0,0 +1,160 @@
+import math
+import queue
+import threading
+import time
+
+
+class FakeGPIO:
+    """Stand-in for the RPi.GPIO module for running the client off-Pi.
+
+    Supports the calls SensorManager makes. ``set_input`` changes a pin
+    level and, like the real library, fires edge callbacks from a separate
+    thread.
+    """
+
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self.mode = None
+        self.levels = {}
+        self.callbacks = {}
+        self._events = queue.Queue()
+        self._dispatcher = threading.Thread(target=self._dispatch, name="fake-gpio", daemon=True)
+        self._dispatcher.start()
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, pin, direction, pull_up_down=None):
+        self.levels.setdefault(pin, 0)
+
+    def input(self, pin):
+        return self.levels.get(pin, 0)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self.callbacks[pin] = (edge, callback)
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def cleanup(self):
+        self.callbacks.clear()
+        self.levels.clear()
+
+    def set_input(self, pin, level):
+        """Drive a pin high or low, firing any matching edge callback"""
+        previous = self.levels.get(pin, 0)
+        self.levels[pin] = level
+        if level == previous or pin not in self.callbacks:
+            return
+        edge, callback = self.callbacks[pin]
+        rising = level and not previous
+        if callback and (edge == self.BOTH or (edge == self.RISING) == bool(rising)):
+            self._events.put((callback, pin))
+
+    def _dispatch(self):
+        while True:
+            callback, pin = self._events.get()
+            callback(pin)
+
+
+class FakeBMP280:
+    """Deterministic BMP280 stand-in following a slow sine wave.
+
+    ``read_delay`` emulates the I2C transaction time of each property access.
+    """
+
+    def __init__(self, base_temperature=21.0, base_pressure=1001.0, read_delay=0.0):
+        self.base_temperature = base_temperature
+        self.base_pressure = base_pressure
+        self.read_delay = read_delay
+        self.sea_level_pressure = 1013.25
+        self._start = time.monotonic()
+
+    def _phase(self):
+        if self.read_delay:
+            time.sleep(self.read_delay)
+        return (time.monotonic() - self._start) / 600.0 * 2 * math.pi
+
+    @property
+    def temperature(self):
+        return self.base_temperature + 2.0 * math.sin(self._phase())
+
+    @property
+    def pressure(self):
+        return self.base_pressure + 3.0 * math.cos(self._phase())
+
+    @property
+    def altitude(self):
+        return 44330 * (1.0 - math.pow(self.pressure / self.sea_level_pressure, 0.1903))
+
+
+class FakeBMP280Chip:
+    """BMP280 stand-in at the register level, shaped like the adafruit driver.
+
+    Uses the calibration and raw values of the datasheet's worked example
+    (25.08 C, 1006.53 hPa). The properties behave like the adafruit ones,
+    including re-reading temperature for pressure and altitude, and every
+    ``_read_register`` call counts as one bus transaction taking
+    ``read_delay`` seconds.
+    """
+
+    def __init__(self, read_delay=0.0):
+        self.read_delay = read_delay
+        self.transactions = 0
+        self.sea_level_pressure = 1013.25
+        self._temp_calib = [27504, 26435, -1000]
+        self._pressure_calib = [36477, -10685, 3024, 2855, 140, -7, 15500, -14600, 6000]
+        self._t_fine = 0
+        raw = b""
+        for value in (415148, 519888):
+            value <<= 4
+            raw += bytes(((value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF))
+        self._registers = {0xF7 + i: byte for i, byte in enumerate(raw)}
+
+    def _read_register(self, register, length):
+        self.transactions += 1
+        if self.read_delay:
+            time.sleep(self.read_delay)
+        return bytes(self._registers[register + i] for i in range(length))
+
+    def _raw(self, register):
+        data = self._read_register(register, 3)
+        return ((data[0] << 16) | (data[1] << 8) | data[2]) / 16
+
+    def _read_temperature(self):
+        t1, t2, t3 = self._temp_calib
+        raw = self._raw(0xFA)
+        var1 = (raw / 16384.0 - t1 / 1024.0) * t2
+        var2 = ((raw / 131072.0 - t1 / 8192.0) ** 2) * t3
+        self._t_fine = int(var1 + var2)
+
+    @property
+    def temperature(self):
+        self._read_temperature()
+        return self._t_fine / 5120.0
+
+    @property
+    def pressure(self):
+        self._read_temperature()
+        p1, p2, p3, p4, p5, p6, p7, p8, p9 = self._pressure_calib
+        var1 = self._t_fine / 2.0 - 64000.0
+        var2 = var1 * var1 * p6 / 32768.0 + var1 * p5 * 2.0
+        var2 = var2 / 4.0 + p4 * 65536.0
+        var1 = (p3 * var1 * var1 / 524288.0 + p2 * var1) / 524288.0
+        var1 = (1.0 + var1 / 32768.0) * p1
+        pressure = ((1048576.0 - self._raw(0xF7) - var2 / 4096.0) * 6250.0) / var1
+        pressure += (p9 * pressure * pressure / 2147483648.0 + pressure * p8 / 32768.0 + p7) / 16.0
+        return pressure / 100
+
+    @property
+    def altitude(self):
+        return 44330 * (1.0 - math.pow(self.pressure / self.sea_level_pressure, 0.1903))
@@ -0,0 +1,151 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+
+
+def fetch_ipinfo(timeout=5):
+    """Approximate location from the public IP address, raises on failure"""
+    response = requests.get("https://ipinfo.io/json", timeout=timeout)
+    response.raise_for_status()
+    data = response.json()
+    return {
+        "city": data.get("city", "Unknown"),
+        "region": data.get("region", "Unknown"),
+        "country": data.get("country", "Unknown"),
+        "loc": data.get("loc", "Unknown"),
+    }
+
+
+class LocationCache:
+    """Device location kept on disk and refreshed in the background.
+
+    ``get()`` never touches the network: it returns the static location from
+    ``.env``, or the last looked-up one from ``path`` (even past its TTL),
+    or None before the first lookup has finished. Unless a static location
+    is set, start() runs a thread that calls ``fetch`` whenever the cached
+    value is older than ``ttl`` seconds, retrying every ``retry_delay``
+    seconds while offline. Callbacks passed to subscribe() are called with
+    the new location when it changes.
+    """
+
+    def __init__(self, path="sensor_data/location.json", ttl=24 * 3600, static=None, fetch=fetch_ipinfo,
+                 retry_delay=300):
+        self.path = path
+        self.ttl = ttl
+        self.static = static
+        self.fetch = fetch
+        self.retry_delay = retry_delay
+        self.refresh_failures = 0
+
+        self._location = static
+        self._fetched_at = None
+        self._listeners = []
+        self._stop_event = threading.Event()
+        self._thread = None
+        if static is None:
+            self._load()
+
+    @classmethod
+    def from_env(cls, path="sensor_data/location.json", fetch=fetch_ipinfo):
+        """LOCATION="lat,lon" (with optional LOCATION_CITY/REGION/COUNTRY) pins
+        the location; LOCATION_TTL_HOURS sets how often it is looked up otherwise"""
+        static = None
+        if os.getenv("LOCATION"):
+            static = {"loc": os.getenv("LOCATION")}
+            for field in ("city", "region", "country"):
+                if os.getenv(f"LOCATION_{field.upper()}"):
+                    static[field] = os.getenv(f"LOCATION_{field.upper()}")
+        return cls(path=os.getenv("LOCATION_CACHE_PATH", path),
+                   ttl=float(os.getenv("LOCATION_TTL_HOURS", 24)) * 3600,
+                   static=static, fetch=fetch)
+
+    def get(self):
+        return self._location
+
+    def subscribe(self, callback):
+        """Call ``callback(location)`` now if known and on every change"""
+        self._listeners.append(callback)
+        if self._location is not None:
+            callback(self._location)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                cached = json.load(f)
+            self._location = cached["location"]
+            self._fetched_at = cached["fetched_at"]
+            logging.info(f"Cached location from {self.path}: {self._location}")
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Ignoring unreadable location cache {self.path}: {e}")
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # Write then rename so a power cut never leaves a truncated file
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"location": self._location, "fetched_at": self._fetched_at}, f)
+        os.replace(tmp_path, self.path)
+
+    def start(self):
+        """Start refreshing in the background, returns immediately"""
+        if self.static is not None:
+            logging.info(f"Using static location {self.static}")
+            return
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="location-refresh", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            age = time.time() - self._fetched_at if self._fetched_at is not None else self.ttl
+            if self._stop_event.wait(max(0.0, self.ttl - age)):
+                return
+            self.refresh()
+            if self._fetched_at is None or time.time() - self._fetched_at >= self.ttl:
+                # Still stale because the lookup failed, try again later
+                if self._stop_event.wait(self.retry_delay):
+                    return
+
+    def refresh(self):
+        """Look the location up now, returns True on success"""
+        try:
+            location = self.fetch()
+        except Exception as e:
+            self.refresh_failures += 1
+            logging.warning(f"Could not look up location ({e}), using {self._location}")
+            return False
+
+        changed = location != self._location
+        self._location = location
+        self._fetched_at = time.time()
+        try:
+            self._save()
+        except OSError as e:
+            logging.warning(f"Could not write location cache {self.path}: {e}")
+        if changed:
+            logging.info(f"System location: {location}")
+            for callback in self._listeners:
+                callback(location)
+        return True
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def stats(self):
+        return {
+            "location_age_s": time.time() - self._fetched_at if self._fetched_at is not None else None,
+            "location_refresh_failures": self.refresh_failures,
+        }
@@ -1,8 +1,9 @@
-import time
 import logging
-from datetime import datetime
+import os
+import metrics
 from mqtt_client import MQTTClient
 from sensor_utils import SensorManager
+from scheduler import SensorLoop
 
 # Setup logging
 logging.basicConfig(
@@ -23,23 +24,22 @@ def main():
     if not mqtt.connect():
         logging.error("Failed to start MQTT client. Continuing without messaging capability.")
     
-    # Initialize sensors
+    # Initialize sensors, the location is looked up in the background and
+    # published in the retained status message whenever it changes
     sensors = SensorManager()
+    sensors.locations.subscribe(mqtt.set_location)
     sensors.initialize()
     
+    # Motion via GPIO interrupts, periodic reads on a scheduler, publishing on its own thread
+    loop = SensorLoop(sensors, mqtt.send, extra_stats=mqtt.stats)
+    
+    # Prometheus /metrics, METRICS_PORT=0 turns it off
+    metrics_port = int(os.getenv("METRICS_PORT", metrics.DEFAULT_PORT))
+    if metrics_port:
+        metrics.serve(loop.stats, metrics_port)
+    
     try:
-        while True:
-            # Check for motion events
-            motion_event = sensors.check_motion()
-            if motion_event:
-                mqtt.send(motion_event)
-            
-            # Check for scheduled temperature readings
-            temp_event = sensors.check_temperature()
-            if temp_event:
-                mqtt.send(temp_event)
-            
-            time.sleep(0.1)  # Small delay between checks
+        loop.run()
             
     except KeyboardInterrupt:
         logging.info("Program terminated by user")
@@ -47,6 +47,7 @@ def main():
         logging.error(f"Unexpected error: {str(e)}")
     finally:
         # Clean up
+        loop.stop()
         sensors.cleanup()
         mqtt.disconnect()
         logging.info("Cleanup completed, program exited")
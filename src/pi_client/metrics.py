@@ -0,0 +1,70 @@
+import logging
+
+try:
+    import prometheus_client
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+except ImportError:
+    prometheus_client = None
+
+DEFAULT_PORT = 9109
+
+READ_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5)
+PUBLISH_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Stats keys that only ever increase; every other numeric stat is a gauge
+COUNTERS = (
+    "readings", "motion_events", "publish_failures", "published", "acked",
+    "outbox_evicted", "reconnects", "connect_failures", "buffered_while_disconnected",
+    "batches", "location_refresh_failures",
+)
+
+
+class _Disabled:
+    """Stands in for a histogram when prometheus_client is not installed"""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+
+def _histogram(name, documentation, buckets, labelnames=()):
+    if prometheus_client is None:
+        return _Disabled()
+    return prometheus_client.Histogram(name, documentation, labelnames, buckets=buckets)
+
+
+SENSOR_READ_SECONDS = _histogram("pi_client_sensor_read_seconds", "Time for one sensor driver read",
+                                 READ_BUCKETS, ["sensor"])
+PUBLISH_SECONDS = _histogram("pi_client_publish_seconds", "Time from publishing a message to its PUBACK",
+                             PUBLISH_BUCKETS)
+
+
+class StatsCollector:
+    """Exports the sensor loop's stats() dict (sensors, outbox, connection,
+    batching) as Prometheus metrics on every scrape"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def collect(self):
+        for key, value in self.stats().items():
+            if value is None or not isinstance(value, (int, float)):
+                continue
+            name = f"pi_client_{key}"
+            if key in COUNTERS:
+                yield CounterMetricFamily(name, key.replace("_", " "), value=value)
+            else:
+                yield GaugeMetricFamily(name, key.replace("_", " "), value=float(value))
+
+
+def serve(stats, port=DEFAULT_PORT):
+    """Expose /metrics on ``port``; returns False if prometheus_client is missing"""
+    if prometheus_client is None:
+        logging.warning("prometheus_client is not installed, /metrics disabled")
+        return False
+    prometheus_client.REGISTRY.register(StatsCollector(stats))
+    prometheus_client.start_http_server(port)
+    logging.info(f"Serving Prometheus metrics on :{port}/metrics")
+    return True
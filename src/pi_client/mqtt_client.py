@@ -1,20 +1,38 @@
+import itertools
 import json
 import logging
+import time
+import uuid
 from dotenv import load_dotenv
 import os
 from paho.mqtt import client as mqtt_client
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from outbox import Outbox, OutboxDrainer
+from batching import BatchPublisher, content_type
+from connection import Backoff, ConnectionManager, build_tls_context
 
 
 class MQTTClient:
-    def __init__(self, broker='mqtt.eclipseprojects.io', port=8883, topic="test/test", client_id='TEST_PI_CLIENT'):
+    def __init__(self, broker='mqtt.eclipseprojects.io', port=8883, topic=None, client_id='TEST_PI_CLIENT'):
         
         #TODO: read in from env 
         load_dotenv()
         
         self.BROKER = os.getenv("BROKER")
         self.PORT = port
-        self.TOPIC = topic
         self.CLIENT_ID = os.getenv("CLIENTID")
+        
+        # Each Pi publishes under sensors/{device_id}/data|motion|status. Passing
+        # ``topic`` sends everything to that one topic instead (legacy test setup).
+        self.DEVICE_ID = os.getenv("DEVICE_ID") or self.CLIENT_ID
+        self.fixed_topic = topic
+        self.TOPIC = self.topic_for("data")
+
+        # Every event is stamped (device_id, boot_id, seq) so the bridge can
+        # drop redeliveries; boot_id changes each start as seq restarts at 0
+        self.BOOT_ID = uuid.uuid4().hex[:8]
+        self._seq = itertools.count()
 
         self.ca_cert_path = os.getenv("CA_CERT")
         self.client_cert_path = os.getenv("CLIENT_CERT")
@@ -27,67 +45,175 @@ class MQTTClient:
         logging.info("====Starting MQTT Client====")
         logging.info(f"Client ID: {self.CLIENT_ID}")
         logging.info(f"Broker: {self.BROKER}")
-        logging.info(f"Topic: {self.TOPIC}")
+        logging.info(f"Topic: {self.topic_for('+')}")
         logging.info("===========================")
         
         self.client = None
+        self.connection = None
+        self.buffered_while_disconnected = 0
+        self.location = None
+        
+        # Every message goes to the durable outbox first and is published by the drainer
+        self.outbox = Outbox(
+            path=os.getenv("OUTBOX_PATH", "sensor_data/outbox.db"),
+            max_messages=int(os.getenv("OUTBOX_MAX_MESSAGES", 100000)),
+            max_bytes=int(float(os.getenv("OUTBOX_MAX_MB", 50)) * 1024 * 1024))
+        self.drainer = OutboxDrainer(self.outbox, self._publish_raw, self.is_connected)
+        
+        # Optionally pack several events into one message (fewer billed messages on AWS IoT)
+        self.batcher = None
+        batch_size = int(os.getenv("MQTT_BATCH_SIZE", 1))
+        if batch_size > 1:
+            self.batcher = BatchPublisher(
+                lambda payload: self._queue(self.TOPIC, payload),
+                device_id=self.DEVICE_ID,
+                max_events=batch_size,
+                max_delay=int(os.getenv("MQTT_BATCH_MS", 1000)) / 1000,
+                codec=os.getenv("MQTT_ENCODING", "msgpack"))
+            logging.info(f"Batching up to {batch_size} events per message ({self.batcher.codec})")
     
+    def topic_for(self, kind):
+        """sensors/{device_id}/{kind} topic for data, motion or status messages"""
+        if self.fixed_topic:
+            return self.fixed_topic
+        return f"sensors/{self.DEVICE_ID}/{kind}"
+
+    def _status(self, state):
+        status = {"device_id": self.DEVICE_ID, "state": state, "timestamp": time.time()}
+        if self.location is not None:
+            status["location"] = self.location
+        return json.dumps(status)
+
+    def set_location(self, location):
+        """Send the location once, in the retained status message"""
+        self.location = location
+        if self.client is None:
+            return
+        # The last will was set before the location was known
+        self.client.will_set(self.topic_for("status"), self._status("offline"), qos=1, retain=True)
+        if self.is_connected():
+            self.client.publish(self.topic_for("status"), self._status("online"), qos=1, retain=True)
+
     def on_connect(self, client, userdata, flags, rc, properties=None):
-        logging.info("Connected to MQTT Broker!")
-        self.client.subscribe(self.TOPIC)
+        self.connection.connected(flags, rc)
+        if rc.is_failure:
+            logging.error(f"MQTT broker refused connection: {rc}")
+            return
+        logging.info(f"Connected to MQTT Broker! (session present: {flags.session_present})")
+        self.drainer.reconnected()
+        # Retained, so the bridge and dashboards see the current state on subscribe
+        self.client.publish(self.topic_for("status"), self._status("online"), qos=1, retain=True)
        
 
+    def on_disconnect(self, client, userdata, flags, rc, properties=None):
+        logging.warning(f"Disconnected from MQTT broker: {rc}")
+        # In-flight messages stay with paho and are retransmitted after reconnecting
+        self.connection.disconnected()
+
+    def on_publish(self, client, userdata, mid, rc=None, properties=None):
+        # For QoS 1 this fires on PUBACK, only then is the outbox row deleted
+        self.drainer.ack(mid)
+
     def on_message(self,client, userdata, msg):
-        print(msg.payload)
-        logging.info('received message: topic: %s payload: %s', msg.topic, msg.payload)
+        logging.debug('received message: topic: %s payload: %s', msg.topic, msg.payload)
         #additonal logic for on message behavior here 
     
     def connect(self):
-
-        #TODO: refactor to work with aws deployment
-
+        """Start connecting in the background. Returns False only if the client
+        could not be set up (e.g. unreadable certificates); broker outages are
+        retried with backoff and readings wait in the outbox meanwhile."""
         self.client = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2, protocol=mqtt_client.MQTTv5, client_id=self.CLIENT_ID)
-        self.client.tls_set(
-            ca_certs=self.ca_cert_path,
-            certfile=self.client_cert_path,
-            keyfile=self.client_priv_key_path,
-            tls_version=2)
+        # MQTT_TLS=false talks plain MQTT to a local broker (benchmarks, lab setups)
+        if os.getenv("MQTT_TLS", "true").lower() != "false":
+            try:
+                self.client.tls_set_context(build_tls_context(
+                    self.ca_cert_path, self.client_cert_path, self.client_priv_key_path))
+            except Exception as e:
+                logging.error(f"Could not load MQTT TLS certificates: {str(e)}")
+                return False
+        # The broker publishes this if the Pi drops off without disconnecting
+        self.client.will_set(self.topic_for("status"), self._status("offline"), qos=1, retain=True)
         self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_publish = self.on_publish
         self.client.on_message = self.on_message
-      
+        
+        self.connection = ConnectionManager(
+            self.client, self.BROKER, self.PORT,
+            keepalive=120,
+            session_expiry=int(os.getenv("MQTT_SESSION_EXPIRY", 3600)),
+            backoff=Backoff(base=float(os.getenv("MQTT_RECONNECT_MIN_DELAY", 1)),
+                            maximum=float(os.getenv("MQTT_RECONNECT_MAX_DELAY", 120))))
+        self.connection.start()
+        self.drainer.start()
+        return True
+    
+    def is_connected(self):
+        return self.client is not None and self.client.is_connected()
+
+    def _publish_raw(self, topic, payload):
+        """Publish one outbox message, returns its mid or None if paho refused it"""
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.ContentType = content_type(payload)
         try:
-            self.client.connect(self.BROKER, self.PORT, keepalive=120)
-            print(self.client)
-            self.client.loop_start()
-            return True
+            result = self.client.publish(topic, payload=payload, qos=1, properties=properties)
         except Exception as e:
-            logging.error(f"Connection to MQTT broker failed: {str(e)}")
-            return False
-    
+            logging.error(f"Error publishing MQTT message: {str(e)}")
+            return None
+        # NO_CONN still queues a QoS 1 message in paho, which sends it on reconnect
+        if result.rc not in (mqtt_client.MQTT_ERR_SUCCESS, mqtt_client.MQTT_ERR_NO_CONN):
+            return None
+        return result.mid
+
     def send(self, payload):
-        if not self.client or not self.client.is_connected():
-            logging.error("INSIDE SEND MQTT client is not connected!")
-            return False
-        
+        """Queue a message in the outbox, it is published once connected"""
         try:
+            if isinstance(payload, dict):
+                payload = dict(payload, device_id=self.DEVICE_ID, boot_id=self.BOOT_ID, seq=next(self._seq))
+            # Motion goes out on its own topic straight away, readings may be batched
+            if isinstance(payload, dict) and payload.get("event") == "motion_detected":
+                self._queue(self.topic_for("motion"), json.dumps(payload))
+                return True
+            if self.batcher is not None and isinstance(payload, dict):
+                self.batcher.add(payload)
+                return True
+            
             # Convert dict to JSON string if payload is a dict
             if isinstance(payload, dict):
                 payload = json.dumps(payload)
-                
-            result = self.client.publish(self.TOPIC, payload=payload, qos=1)
-            status = result[0]
-            if status == 0:
-                logging.info(f"Successfully sent message to topic {self.TOPIC}")
-                return True
-            else:
-                logging.error(f"Failed to send message to topic {self.TOPIC}")
-                return False
+            self._queue(self.TOPIC, payload)
+            return True
         except Exception as e:
-            logging.error(f"Error sending MQTT message: {str(e)}")
+            logging.error(f"Error queueing MQTT message: {str(e)}")
             return False
     
+    def _queue(self, topic, payload):
+        self.outbox.put(topic, payload)
+        self.drainer.notify()
+        if not self.is_connected():
+            self.buffered_while_disconnected += 1
+            # Warn on the first message and then every 100th, not once per message
+            if self.buffered_while_disconnected % 100 == 1:
+                logging.warning(f"MQTT client not connected, {len(self.outbox)} messages waiting in outbox")
+    
+    def stats(self):
+        """Outbox depth, replay, connection and batching metrics"""
+        stats = self.drainer.stats()
+        stats["buffered_while_disconnected"] = self.buffered_while_disconnected
+        if self.connection is not None:
+            stats.update(self.connection.stats())
+        if self.batcher is not None:
+            stats.update(self.batcher.stats())
+        return stats
+    
     def disconnect(self):
-        if self.client:
-            self.client.loop_stop()
-            self.client.disconnect()
-            logging.info("Disconnected from MQTT broker")
\ No newline at end of file
+        if self.batcher is not None:
+            self.batcher.close()
+        self.drainer.stop()
+        if self.connection:
+            if self.is_connected():
+                self.client.publish(self.topic_for("status"), self._status("offline"), qos=1, retain=True)
+            self.connection.stop()
+            logging.info("Disconnected from MQTT broker")
+        logging.info(f"{len(self.outbox)} messages left in outbox for next start")
+        self.outbox.close()
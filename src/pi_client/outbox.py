@@ -0,0 +1,267 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import metrics
+
+# Queued on the ack queue to mark a reconnect
+_RECONNECTED = object()
+
+
+class Outbox:
+    """Durable queue of outgoing MQTT messages stored in SQLite (WAL mode).
+
+    Every message is written here before it is published and only deleted
+    once the broker has acknowledged it, so readings taken while the Pi is
+    offline are kept until the connection comes back. Disk usage is bounded
+    by ``max_messages`` and ``max_bytes``; when either is exceeded the oldest
+    messages are evicted first.
+    """
+
+    def __init__(self, path="sensor_data/outbox.db", max_messages=100000, max_bytes=50 * 1024 * 1024):
+        self.path = path
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.evicted = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # NORMAL is durable across application crashes and much cheaper on SD cards than FULL
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                topic TEXT NOT NULL,
+                payload BLOB NOT NULL,
+                created REAL NOT NULL
+            )""")
+
+        self._count, self._bytes = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM messages").fetchone()
+        if self._count:
+            logging.info(f"Outbox has {self._count} unsent messages ({self._bytes} bytes) from a previous run")
+
+    def put(self, topic, payload):
+        """Store a message, evicting the oldest if the outbox is full. Returns its id."""
+        if isinstance(payload, str):
+            payload = payload.encode()
+
+        with self._lock:
+            cur = self.db.execute("INSERT INTO messages (topic, payload, created) VALUES (?, ?, ?)",
+                                  (topic, payload, time.time()))
+            self._count += 1
+            self._bytes += len(payload)
+            self._enforce_limits()
+            return cur.lastrowid
+
+    def _enforce_limits(self):
+        while self._count > self.max_messages or (self._bytes > self.max_bytes and self._count > 1):
+            excess = max(self._count - self.max_messages, 1)
+            rows = self.db.execute("SELECT id, LENGTH(payload) FROM messages ORDER BY id LIMIT ?",
+                                   (excess,)).fetchall()
+            self.db.execute("DELETE FROM messages WHERE id <= ?", (rows[-1][0],))
+            self._count -= len(rows)
+            self._bytes -= sum(size for _, size in rows)
+            previous, self.evicted = self.evicted, self.evicted + len(rows)
+            # Warn on the first eviction and then every 1000th, not once per message
+            if previous == 0 or previous // 1000 != self.evicted // 1000:
+                logging.warning(f"Outbox full, {self.evicted} oldest messages evicted so far")
+
+    def oldest(self, limit, exclude=()):
+        """Return up to ``limit`` (id, topic, payload) tuples, oldest first"""
+        return self._select("ORDER BY id ASC", limit, exclude)
+
+    def newest(self, limit, exclude=()):
+        """Return up to ``limit`` (id, topic, payload) tuples, newest first"""
+        return self._select("ORDER BY id DESC", limit, exclude)
+
+    def _select(self, order, limit, exclude):
+        with self._lock:
+            # Over-fetch so rows already in flight can be skipped without a NOT IN clause
+            rows = self.db.execute(f"SELECT id, topic, payload FROM messages {order} LIMIT ?",
+                                   (limit + len(exclude),)).fetchall()
+        return [row for row in rows if row[0] not in exclude][:limit]
+
+    def delete(self, ids):
+        """Remove acknowledged messages"""
+        if not ids:
+            return
+        ids = list(ids)
+        with self._lock:
+            placeholders = ",".join("?" * len(ids))
+            removed = self.db.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM messages WHERE id IN ({placeholders})",
+                ids).fetchone()
+            self.db.execute(f"DELETE FROM messages WHERE id IN ({placeholders})", ids)
+            self._count -= removed[0]
+            self._bytes -= removed[1]
+
+    def oldest_age(self):
+        """Seconds since the oldest unsent message was queued"""
+        with self._lock:
+            row = self.db.execute("SELECT MIN(created) FROM messages").fetchone()
+        return time.time() - row[0] if row[0] else 0.0
+
+    def __len__(self):
+        return self._count
+
+    def size_bytes(self):
+        return self._bytes
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+class OutboxDrainer:
+    """Background thread that publishes outbox messages and deletes them on PUBACK.
+
+    ``publish`` is called with (topic, payload) and must return the MQTT
+    message id, or None if the message could not be queued. The owner calls
+    ``ack(mid)`` from its on_publish callback. At most ``max_inflight``
+    messages are unacknowledged at once. Each round reserves part of the
+    window for the newest messages so a large backlog replaying after an
+    outage does not delay live readings; each round is still published in
+    the order the messages were queued.
+    """
+
+    def __init__(self, outbox, publish, is_connected, batch_size=50, max_inflight=100,
+                 live_share=0.5, idle_interval=0.2):
+        self.outbox = outbox
+        self.publish = publish
+        self.is_connected = is_connected
+        self.batch_size = batch_size
+        self.max_inflight = max_inflight
+        self.live_share = live_share
+        self.idle_interval = idle_interval
+
+        self._inflight = {}  # mid -> (outbox row id, publish time)
+        self._acks = queue.SimpleQueue()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        # Metrics
+        self.published = 0
+        self.acked = 0
+        self.replay_started = None
+        self.replayed_since_reconnect = 0
+        self.last_replay_rate = 0.0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="outbox-drainer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def notify(self):
+        """Wake the drainer because a new message was queued"""
+        self._wake.set()
+
+    def ack(self, mid):
+        """Record a PUBACK, safe to call from the MQTT network thread"""
+        self._acks.put(mid)
+        self._wake.set()
+
+    def connection_lost(self):
+        """Forget in-flight messages so they are re-published, for when the
+        MQTT client (and the messages it was retrying) is thrown away"""
+        self._acks.put(None)
+        self._wake.set()
+
+    def reconnected(self):
+        """Restart the replay-rate measurement; in-flight messages are kept
+        because the MQTT client retransmits them on the resumed connection"""
+        self._acks.put(_RECONNECTED)
+        self._wake.set()
+
+    def _process_acks(self):
+        acked_ids = []
+        while True:
+            try:
+                mid = self._acks.get_nowait()
+            except queue.Empty:
+                break
+            if mid is None:
+                self._inflight.clear()
+                self.replay_started = None
+                continue
+            if mid is _RECONNECTED:
+                self.replay_started = None
+                continue
+            entry = self._inflight.pop(mid, None)
+            if entry is not None:
+                acked_ids.append(entry[0])
+                metrics.PUBLISH_SECONDS.observe(time.monotonic() - entry[1])
+        if acked_ids:
+            self.outbox.delete(acked_ids)
+            self.acked += len(acked_ids)
+            self.replayed_since_reconnect += len(acked_ids)
+            if self.replay_started:
+                elapsed = time.monotonic() - self.replay_started
+                if elapsed > 0:
+                    self.last_replay_rate = self.replayed_since_reconnect / elapsed
+
+    def _next_batch(self):
+        room = min(self.batch_size, self.max_inflight - len(self._inflight))
+        if room <= 0:
+            return []
+        exclude = {row_id for row_id, _ in self._inflight.values()}
+        live = self.outbox.newest(max(int(room * self.live_share), 1), exclude)
+        exclude.update(row[0] for row in live)
+        backlog = self.outbox.oldest(room - len(live), exclude) if room > len(live) else []
+        # The newest ids are picked first, but go out in ascending id order
+        return sorted(live + backlog)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._process_acks()
+
+            if not self.is_connected():
+                self._wake.wait(self.idle_interval)
+                self._wake.clear()
+                continue
+
+            if self.replay_started is None:
+                self.replay_started = time.monotonic()
+                self.replayed_since_reconnect = 0
+
+            batch = self._next_batch()
+            stalled = False
+            for row_id, topic, payload in batch:
+                mid = self.publish(topic, payload)
+                if mid is None:
+                    stalled = True
+                    break
+                self._inflight[mid] = (row_id, time.monotonic())
+                self.published += 1
+
+            if not batch or stalled:
+                self._wake.wait(self.idle_interval)
+                self._wake.clear()
+
+    def stats(self):
+        return {
+            "outbox_messages": len(self.outbox),
+            "outbox_bytes": self.outbox.size_bytes(),
+            "outbox_oldest_age_s": self.outbox.oldest_age(),
+            "outbox_evicted": self.outbox.evicted,
+            "inflight": len(self._inflight),
+            "published": self.published,
+            "acked": self.acked,
+            "replay_rate_msg_s": self.last_replay_rate,
+        }
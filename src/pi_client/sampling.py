@@ -0,0 +1,64 @@
+import time
+from collections import deque
+
+import metrics
+
+
+class LatencyTracker:
+    """Per-sensor read latency, to see what each bus transaction costs"""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.samples = {}
+        self.errors = {}
+
+    def timed(self, name, read):
+        """Call ``read()``, recording how long it took under ``name``"""
+        start = time.perf_counter()
+        try:
+            return read()
+        except Exception:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.samples.setdefault(name, deque(maxlen=self.window)).append(elapsed)
+            metrics.SENSOR_READ_SECONDS.labels(sensor=name).observe(elapsed)
+
+    def stats(self):
+        stats = {}
+        for name, samples in self.samples.items():
+            latencies = sorted(samples)
+            stats[f"{name}_read_p50_ms"] = round(latencies[len(latencies) // 2] * 1000, 2)
+            stats[f"{name}_read_p99_ms"] = round(latencies[int(len(latencies) * 0.99)] * 1000, 2)
+            stats[f"{name}_read_errors"] = self.errors.get(name, 0)
+        return stats
+
+
+class Decimator:
+    """Moving average over the last ``window`` samples, emitted every
+    ``decimation`` samples.
+
+    Sampling faster than we publish and averaging smooths sensor noise while
+    cutting the number of points sent. With window=1, decimation=1 every
+    sample passes through unchanged.
+    """
+
+    def __init__(self, window=1, decimation=1):
+        self.window = max(1, window)
+        self.decimation = max(1, decimation)
+        self.samples = deque(maxlen=self.window)
+        self.count = 0
+
+    def add(self, sample):
+        """Add a sample dict; returns the averaged sample when one is due, else None"""
+        self.samples.append(sample)
+        self.count += 1
+        if self.count % self.decimation:
+            return None
+
+        averaged = {}
+        for key in sample:
+            values = [s[key] for s in self.samples if isinstance(s.get(key), (int, float))]
+            averaged[key] = sum(values) / len(values) if values else sample[key]
+        return averaged
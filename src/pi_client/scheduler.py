@@ -0,0 +1,168 @@
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+
+class Scheduler:
+    """Heap-based scheduler running jobs on the thread that calls run().
+
+    Periodic jobs are rescheduled from their previous deadline rather than
+    from when they finished, so they do not drift. If a job falls more than
+    one interval behind, missed runs are skipped instead of bunching up.
+    The thread sleeps until the next deadline or until a job is added from
+    another thread, so an idle scheduler costs no CPU.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._running = False
+
+    def call_at(self, when, fn, *args, interval=None):
+        with self._cond:
+            heapq.heappush(self._heap, (when, next(self._counter), fn, args, interval))
+            self._cond.notify()
+
+    def call_soon(self, fn, *args):
+        """Run fn as soon as possible, safe to call from any thread (e.g. GPIO callbacks)"""
+        self.call_at(time.monotonic(), fn, *args)
+
+    def every(self, interval, fn, *args, first_delay=None):
+        delay = interval if first_delay is None else first_delay
+        self.call_at(time.monotonic() + delay, fn, *args, interval=interval)
+
+    def run(self):
+        """Run jobs until stop() is called"""
+        self._running = True
+        while True:
+            with self._cond:
+                while self._running:
+                    now = time.monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    timeout = self._heap[0][0] - now if self._heap else None
+                    self._cond.wait(timeout)
+                if not self._running:
+                    return
+                when, _, fn, args, interval = heapq.heappop(self._heap)
+                if interval is not None:
+                    next_run = when + interval
+                    now = time.monotonic()
+                    if next_run <= now:
+                        next_run = now + interval - ((now - when) % interval)
+                    heapq.heappush(self._heap, (next_run, next(self._counter), fn, args, interval))
+
+            try:
+                fn(*args)
+            except Exception as e:
+                logging.error(f"Scheduled job {getattr(fn, '__name__', fn)} failed: {str(e)}")
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+
+class SensorLoop:
+    """Event-driven sensor loop replacing the 100 ms polling loop.
+
+    Motion is detected with GPIO edge interrupts, the callback only hands
+    the work to the scheduler thread, which does the sensor I/O. Periodic
+    temperature reads are scheduler jobs. Finished events go on a queue
+    drained by a separate publisher thread, so a slow publish never delays
+    sensor reads. If edge detection is unavailable the PIR is polled as a
+    scheduler job instead.
+    """
+
+    def __init__(self, sensors, publish, stats_interval=60, extra_stats=None, poll_interval=0.1):
+        self.sensors = sensors
+        self.publish = publish
+        self.stats_interval = stats_interval
+        self.extra_stats = extra_stats
+        self.poll_interval = poll_interval
+
+        self.scheduler = Scheduler()
+        self.outgoing = queue.Queue()
+        self._publisher = None
+
+        self.motion_events = 0
+        self.readings = 0
+        self.publish_failures = 0
+        self.motion_latencies = deque(maxlen=1000)  # seconds from edge to publish
+
+    def start(self):
+        try:
+            self.sensors.watch_motion(self._on_motion_edge)
+            logging.info("Watching PIR with GPIO edge detection")
+        except RuntimeError as e:
+            logging.warning(f"Edge detection unavailable ({str(e)}), polling PIR every {self.poll_interval}s")
+            self.scheduler.every(self.poll_interval, self._handle_motion, None)
+
+        self.scheduler.every(self.sensors.temp_interval, self._read_temperature)
+        self.scheduler.every(self.stats_interval, self.log_stats)
+
+        self._publisher = threading.Thread(target=self._publish_loop, name="publisher", daemon=True)
+        self._publisher.start()
+
+    def run(self):
+        """Start and block running sensor jobs until stop()"""
+        self.start()
+        self.scheduler.run()
+
+    def stop(self):
+        self.scheduler.stop()
+        self.outgoing.put(None)
+        if self._publisher is not None:
+            self._publisher.join(timeout=5)
+
+    def _on_motion_edge(self, channel):
+        # Runs on the GPIO library's thread: timestamp and hand off
+        self.scheduler.call_soon(self._handle_motion, time.perf_counter())
+
+    def _handle_motion(self, edge_time):
+        event = self.sensors.check_motion()
+        if event:
+            self.motion_events += 1
+            self.outgoing.put((event, edge_time))
+
+    def _read_temperature(self):
+        reading = self.sensors.take_reading()
+        if reading is None:
+            return  # still averaging samples
+        self.readings += 1
+        self.outgoing.put((reading, None))
+
+    def _publish_loop(self):
+        while True:
+            item = self.outgoing.get()
+            if item is None:
+                return
+            event, edge_time = item
+            if not self.publish(event):
+                self.publish_failures += 1
+            if edge_time is not None:
+                self.motion_latencies.append(time.perf_counter() - edge_time)
+
+    def stats(self):
+        latencies = sorted(self.motion_latencies)
+        stats = {
+            "motion_events": self.motion_events,
+            "readings": self.readings,
+            "publish_failures": self.publish_failures,
+            "publish_queue": self.outgoing.qsize(),
+            "motion_to_publish_p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else None,
+            "motion_to_publish_p99_ms": latencies[int(len(latencies) * 0.99)] * 1000 if latencies else None,
+        }
+        if hasattr(self.sensors, "stats"):
+            stats.update(self.sensors.stats())
+        if self.extra_stats is not None:
+            stats.update(self.extra_stats())
+        return stats
+
+    def log_stats(self):
+        logging.info(f"Sensor loop stats: {self.stats()}")
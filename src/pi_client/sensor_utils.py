@@ -1,50 +1,79 @@
-import RPi.GPIO as GPIO
-import board
-import adafruit_bmp280
-import requests
 import logging
 import time
-import json
 import os
-from datetime import datetime
+from datetime import datetime, timezone
+from data_log import DataLog
+import drivers as sensor_drivers
+from location import LocationCache, fetch_ipinfo
+from sampling import Decimator, LatencyTracker
+
+# Decimal places kept per reading field
+READING_PRECISION = {"altitude_m": 2}
 
 class SensorManager:
-    def __init__(self, pir_pin=17, temp_sensor_address=0x77):
-        """Initialize sensor manager with specified pins and addresses"""
-        self.PIR_PIN = pir_pin
-        self.temp_sensor_address = temp_sensor_address
-        self.temp_sensor = None
+    def __init__(self, pir_pin=17, temp_sensor_address=0x77, gpio=None, temp_sensor=None, pir_warmup=2,
+                 drivers=None, data_dir="sensor_data"):
+        """Initialize sensor manager with specified pins and addresses.
+
+        ``drivers`` is a list of sensor drivers (see drivers.py). By default
+        they are built from SENSOR_DRIVERS/SENSOR_BACKEND, falling back to a
+        BMP280 at ``temp_sensor_address`` and a PIR on ``pir_pin``. ``gpio``
+        and ``temp_sensor`` inject fakes (see fake_hw.py) into those defaults.
+        """
+        if drivers is None:
+            if gpio is not None or temp_sensor is not None:
+                drivers = [sensor_drivers.BMP280Driver(temp_sensor_address, sensor=temp_sensor),
+                           sensor_drivers.PIRDriver(pir_pin, gpio=gpio)]
+            else:
+                drivers = sensor_drivers.from_env(f"bmp280:address={temp_sensor_address},pir:pin={pir_pin}")
+        self.drivers = drivers
+        self.pir = next((d for d in drivers if isinstance(d, sensor_drivers.PIRDriver)), None)
+        self.PIR_PIN = self.pir.pin if self.pir else pir_pin
+        self.pir_warmup = pir_warmup
         self.motion_detected = False
         self.last_temp_reading = 0
-        self.temp_interval = 5  # seconds between regular temp readings
-        self.location = None
+        self.temp_interval = float(os.getenv("SENSOR_SAMPLE_INTERVAL", 5))  # seconds between regular temp readings
+        # Looked up in the background and sent in the status message, not with every reading
+        self.locations = LocationCache.from_env(os.path.join(data_dir, "location.json"),
+                                                fetch=lambda: self.get_location())
+        
+        # Optional on-device smoothing: average the last N samples, publish every Mth
+        self.decimator = Decimator(int(os.getenv("SENSOR_AVERAGE_WINDOW", 1)), int(os.getenv("SENSOR_DECIMATION", 1)))
+        self.latency = LatencyTracker()
         
-        # Set up storage
-        if not os.path.exists("sensor_data"):
-            os.makedirs("sensor_data")
+        # Set up storage: append-only NDJSON logs, rotated daily
+        if not os.path.exists(data_dir):
+            os.makedirs(data_dir)
+        self.daily_log = DataLog(data_dir, "daily")
+        self.event_log = DataLog(data_dir, "events")
+    
+    @property
+    def environment_drivers(self):
+        return [d for d in self.drivers if d is not self.pir]
+    
+    @property
+    def location(self):
+        return self.locations.get()
     
     def initialize(self):
-        """Initialize all sensors and get location"""
-        # Get location
-        self.location = self.get_location()
+        """Initialize all sensors and start the background location lookup"""
+        self.locations.start()
         logging.info(f"System location: {self.location}")
         
-        # Set up GPIO for motion sensor
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self.PIR_PIN, GPIO.IN)
+        # Open drivers, hardware libraries are only imported here
+        for driver in list(self.drivers):
+            try:
+                driver.open()
+                logging.info(f"{driver.name} sensor initialized")
+            except Exception as e:
+                logging.error(f"Error initializing {driver.name} sensor: {str(e)}")
+                self.drivers.remove(driver)
+                if driver is self.pir:
+                    self.pir = None
         
-        # Set up BMP280 temperature/pressure sensor
-        i2c = board.I2C()
-        try:
-            self.temp_sensor = adafruit_bmp280.Adafruit_BMP280_I2C(i2c, address=self.temp_sensor_address)
-            self.temp_sensor.sea_level_pressure = 1013.25
-            logging.info("Temperature sensor initialized")
-        except Exception as e:
-            logging.error(f"Error initializing temperature sensor: {str(e)}")
-            self.temp_sensor = None
-        
-        logging.info("Motion sensor initializing...")
-        time.sleep(2)  # Give PIR sensor time to initialize
+        if self.pir is not None:
+            logging.info("Motion sensor initializing...")
+            time.sleep(self.pir_warmup)  # Give PIR sensor time to initialize
         logging.info("All sensors ready!")
         
         self.last_temp_reading = time.time()
@@ -52,7 +81,9 @@ class SensorManager:
     
     def check_motion(self):
         """Check motion sensor and return event data if motion is detected"""
-        motion_detected_now = GPIO.input(self.PIR_PIN)
+        if self.pir is None:
+            return None
+        motion_detected_now = self.pir.read()["motion"]
         
         # Only trigger when motion is first detected
         if motion_detected_now and not self.motion_detected:
@@ -62,20 +93,17 @@ class SensorManager:
             
             # Read temperature when motion is detected
             temp_data = self.read_temperature()
-            logging.info(f"Motion triggered temperature reading: {temp_data}")
+            logging.debug(f"Motion triggered temperature reading: {temp_data}")
             
             # Create event record
             event = {
                 "timestamp": current_time,
                 "event": "motion_detected",
-                "location": self.location,
                 "sensor_data": temp_data
             }
             
-            # Save to JSON file
-            filename = f"sensor_data/event_{int(time.time())}.json"
-            with open(filename, 'w') as f:
-                json.dump(event, f, indent=2)
+            # Append to the daily event log
+            self.event_log.append(event)
                 
             return event
         
@@ -85,88 +113,100 @@ class SensorManager:
             
         return None
     
+    def watch_motion(self, callback):
+        """Call ``callback(channel)`` on every PIR edge instead of polling.
+        Raises RuntimeError if the GPIO library cannot add edge detection."""
+        if self.pir is None:
+            raise RuntimeError("No motion sensor configured")
+        self.pir.watch(callback)
+    
     def check_temperature(self):
         """Check if it's time for a regular temperature reading"""
         current_time = time.time()
         
         if current_time - self.last_temp_reading > self.temp_interval:
-            self.last_temp_reading = current_time
-            temp_data = self.read_temperature()
-            time_str = self.get_time()
-            logging.info(f"Temperature reading: {temp_data}")
-            
-            # Create regular reading record
-            reading = {
-                "timestamp": time_str,
-                "event": "regular_reading",
-                "location": self.location,
-                "sensor_data": temp_data
-            }
-            
-            # Append to daily log file
-            day_filename = f"sensor_data/daily_{datetime.now().strftime('%Y-%m-%d')}.json"
-            
-            # Check if file exists and has content
-            if os.path.exists(day_filename) and os.path.getsize(day_filename) > 0:
-                try:
-                    with open(day_filename, 'r') as f:
-                        day_data = json.load(f)
-                        if not isinstance(day_data, list):
-                            day_data = [day_data]
-                except:
-                    day_data = []
-            else:
-                day_data = []
-            
-            day_data.append(reading)
-            
-            with open(day_filename, 'w') as f:
-                json.dump(day_data, f, indent=2)
-                
-            return reading
+            return self.take_reading()
         
         return None
     
+    def take_reading(self):
+        """Take a regular temperature reading now, log and return it.
+        Returns None while the decimator is still collecting samples."""
+        self.last_temp_reading = time.time()
+        temp_data = self._sample()
+        if "error" not in temp_data:
+            temp_data = self.decimator.add(temp_data)
+            if temp_data is None:
+                return None
+            temp_data = self._round(temp_data)
+        time_str = self.get_time()
+        logging.debug(f"Temperature reading: {temp_data}")
+        
+        # Create regular reading record
+        reading = {
+            "timestamp": time_str,
+            "event": "regular_reading",
+            "sensor_data": temp_data
+        }
+        
+        # Append to daily log file
+        self.daily_log.append(reading)
+            
+        return reading
+    
     def cleanup(self):
-        """Clean up GPIO resources"""
-        GPIO.cleanup()
+        """Clean up GPIO resources and flush the data logs"""
+        self.locations.stop()
+        self.daily_log.close()
+        self.event_log.close()
+        for driver in self.drivers:
+            try:
+                driver.close()
+            except Exception as e:
+                logging.error(f"Error closing {driver.name} sensor: {str(e)}")
         logging.info("GPIO resources cleaned up")
     
     def get_time(self):
-        """Get current system time in formatted string"""
-        return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        """Get current UTC time in formatted string, e.g. 2026-10-18 20:15:02.123+00:00"""
+        # Milliseconds keep readings taken within the same second distinct
+        # under the database's unique (device_id, sensor_type, time) index.
+        # The offset makes the time unambiguous whatever zone the Pi is in.
+        return datetime.now(timezone.utc).isoformat(sep=" ", timespec="milliseconds")
 
     def get_location(self):
-        """Get approximate location based on IP address"""
-        try:
-            response = requests.get("https://ipinfo.io/json", timeout=5)
-            if response.status_code == 200:
-                data = response.json()
-                location = {
-                    "city": data.get("city", "Unknown"),
-                    "region": data.get("region", "Unknown"),
-                    "country": data.get("country", "Unknown"),
-                    "loc": data.get("loc", "Unknown")
-                }
-                return location
-            else:
-                return {"error": "Could not retrieve location data"}
-        except Exception as e:
-            logging.error(f"Error getting location: {str(e)}")
-            return {"error": "Connection error"}
+        """Look up the approximate location from the IP address. Blocks for up
+        to 5 s and raises when offline, so only the location cache calls it"""
+        return fetch_ipinfo()
 
     def read_temperature(self):
-        """Read data from temperature/pressure sensor"""
-        if self.temp_sensor is None:
+        """Read data from all environmental sensors (temperature, pressure, humidity, volume)"""
+        data = self._sample()
+        return data if "error" in data else self._round(data)
+    
+    def _sample(self):
+        """One read per driver; derived values come from that same sample"""
+        drivers = self.environment_drivers
+        if not drivers:
             return {"error": "Temperature sensor not available"}
         
-        try:
-            return {
-                "temperature_c": round(self.temp_sensor.temperature, 1),
-                "temperature_f": round((self.temp_sensor.temperature * 9/5) + 32, 1),
-                "pressure_hpa": round(self.temp_sensor.pressure, 1),
-                "altitude_m": round(self.temp_sensor.altitude, 2)
-            }
-        except Exception as e:
-            logging.error(f"Error reading temperature sensor: {str(e)}")
-            return {"error": "Could not read temperature data"}
\ No newline at end of file
+        data = {}
+        for driver in drivers:
+            try:
+                data.update(self.latency.timed(driver.name, driver.read))
+            except Exception as e:
+                logging.error(f"Error reading {driver.name} sensor: {str(e)}")
+        if not data:
+            return {"error": "Could not read temperature data"}
+        
+        if "temperature_c" in data:
+            data["temperature_f"] = (data["temperature_c"] * 9/5) + 32
+        return data
+    
+    def _round(self, data):
+        return {key: round(value, READING_PRECISION.get(key, 1)) for key, value in data.items()}
+    
+    def stats(self):
+        """Sensor read latency per driver and location cache age"""
+        stats = self.latency.stats()
+        stats.update(self.locations.stats())
+        return stats